@@ -4,71 +4,139 @@ import pandas as pd
 import plotly.express as px
 import polars as pl
 import streamlit as st
-from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score
+
+from dataset import list_data_files, load_sample
+from result_cache import dataset_fingerprint
+from score_histogram import ScoreHistogram, score_counts
+from threshold_sweep import (
+    OBJECTIVE_COST,
+    OBJECTIVE_F1,
+    average_precision,
+    best_threshold,
+    roc_auc,
+    threshold_sweep,
+    with_metrics,
+)
 
 st.set_page_config(layout="wide")
 st.title("不正取引分析ダッシュボード")
 
 
+# 分析に使う列（他の列はファイルから読み込まない）
+ANALYSIS_COLS = ["SCORE", "is_fraud", "score_level"]
+
+# score_level の表示順
+SCORE_LEVELS = ["low", "mid", "high"]
+
+
 # --- データ読み込み ---
-@st.cache_data
-def load_data(data_dir: Path) -> pl.DataFrame:
+def scan_data(data_dir: Path) -> pl.LazyFrame | None:
     """
-    指定されたディレクトリからParquetファイルを読み込み、単一のPolars DataFrameに結合する。
+    指定されたディレクトリのParquetファイルを遅延読み込みする（まだ何も読み込まない）。
     """
     if not data_dir.exists():
         st.error(f"データディレクトリが見つかりません: {data_dir}")
-        return pl.DataFrame()
+        return None
 
-    parquet_files = list(data_dir.glob("**/*.parquet"))
+    parquet_files = list_data_files(data_dir)
     if not parquet_files:
         st.warning(f"データディレクトリ内にParquetファイルが見つかりません: {data_dir}")
+        return None
+    return pl.scan_parquet(parquet_files)
+
+
+@st.cache_data
+def load_counts(data_dir: Path, fingerprint: str) -> pl.DataFrame:
+    """
+    SCORE・is_fraud・score_level の値の組み合わせごとの件数（count）を求める。
+
+    ファイルからは ANALYSIS_COLS の列だけを読み、ストリーミングで集計するため、
+    全行をメモリに載せずに済み、残るのは集計結果（スコアの値の種類数 × 2 × score_level の
+    種類数の行）だけになる。混同行列・ヒストグラム・誤分類の内訳は全てこの集計結果から求める。
+    fingerprint はデータセットの指紋で、ファイルが更新されるとキャッシュが無効になる。
+    """
+    lazy_df = scan_data(data_dir)
+    if lazy_df is None:
         return pl.DataFrame()
 
     try:
-        # scan_parquetを使い、全てのparquetファイルを効率的にスキャン
-        lazy_df = pl.scan_parquet(parquet_files)
-        df = lazy_df.collect()
-        return df
+        columns = [c for c in ANALYSIS_COLS if c in lazy_df.collect_schema()]
+        return (
+            lazy_df.select(columns)
+            .group_by(columns)
+            .agg(pl.len().alias("count"))
+            .collect(engine="streaming")
+        )
     except Exception as e:
         st.error(f"データの読み込み中にエラーが発生しました: {e}")
         return pl.DataFrame()
 
 
+@st.cache_data
+def describe_data(data_dir: Path, fingerprint: str) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    層別サンプルがない場合に使う、先頭の数行と全体の基本統計量。
+    先頭の数行は最初のファイルの先頭だけを読み、基本統計量は集計結果だけを返す。
+    """
+    lazy_df = scan_data(data_dir)
+    if lazy_df is None:
+        return pl.DataFrame(), pl.DataFrame()
+    return lazy_df.head().collect(), lazy_df.describe()
+
+
 # --- メイン処理 ---
 prepared_data_dir = Path("prepared_data")
-df = load_data(prepared_data_dir)
+data_fingerprint = (
+    dataset_fingerprint(list_data_files(prepared_data_dir))
+    if prepared_data_dir.exists()
+    else ""
+)
+counts = load_counts(prepared_data_dir, data_fingerprint)
 
-if df.is_empty():
+if counts.is_empty():
     st.info("分析対象のデータがありません。まずはデータローダーを実行してください。")
 else:
+    # スコアの値ごとの正例・負例の件数。任意の閾値の混同行列と評価指標を累積件数から求める
+    score_histogram = ScoreHistogram(score_counts(counts, weight="count"))
+
     st.header("分析設定")
 
     # --- サイドバー ---
     st.sidebar.header("設定")
     score_threshold = st.sidebar.slider(
         "不正と判断するSCOREの閾値",
-        min_value=int(df["SCORE"].min()),
-        max_value=int(df["SCORE"].max()),
+        min_value=int(score_histogram.scores.min()),
+        max_value=int(score_histogram.scores.max()),
         value=1500,
         step=50,
     )
 
+    st.sidebar.header("最適な閾値の探索")
+    objective = st.sidebar.selectbox(
+        "最適な閾値の基準", options=[OBJECTIVE_F1, OBJECTIVE_COST]
+    )
+    fp_cost = st.sidebar.number_input(
+        "誤検出1件あたりのコスト", min_value=0.0, value=1.0, step=1.0
+    )
+    fn_cost = st.sidebar.number_input(
+        "見逃し1件あたりのコスト", min_value=0.0, value=10.0, step=1.0
+    )
+
     # --- メインの分析処理 ---
     st.header(f"SCORE閾値: {score_threshold} での分析結果")
 
-    # 予測ラベルと正解ラベルを準備
-    y_true = df["is_fraud"]
-    y_pred = df["SCORE"] >= score_threshold
-
     # 混同行列の計算
-    cm = confusion_matrix(y_true, y_pred)
-    tn, fp, fn, tp = cm.ravel()
+    confusion = score_histogram.confusion(score_threshold)
+    tn, fp, fn, tp = (confusion[k] for k in ("tn", "fp", "fn", "tp"))
+    cm = [[tn, fp], [fn, tp]]
 
     # 評価指標の計算
-    precision = precision_score(y_true, y_pred, zero_division=0)
-    recall = recall_score(y_true, y_pred, zero_division=0)
-    f1 = f1_score(y_true, y_pred, zero_division=0)
+    current = with_metrics(pl.DataFrame([confusion]), fp_cost, fn_cost).row(
+        0, named=True
+    )
+    precision = current["precision"] or 0
+    recall = current["recall"] or 0
+    f1 = current["f1"] or 0
 
     # --- 結果の表示 ---
     col1, col2 = st.columns(2)
@@ -94,21 +162,73 @@ else:
             """
         )
 
+    # --- 閾値ごとの評価 ---
+    st.header("閾値ごとの評価（ROC曲線・PR曲線）")
+    # 全ての閾値の評価指標を累積件数から一度に求める
+    sweep = threshold_sweep(score_histogram, fp_cost=fp_cost, fn_cost=fn_cost)
+    best = best_threshold(sweep, objective)
+
+    auc = roc_auc(sweep)
+    ap = average_precision(sweep)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("ROC AUC", f"{auc:.3f}" if auc is not None else "-")
+    col2.metric("平均適合率 (AP)", f"{ap:.3f}" if ap is not None else "-")
+    if best is not None:
+        col3.metric(
+            f"推奨閾値（{objective}）",
+            f"{best['threshold']:g}",
+            help="SCOREがこの値以上を不正と判定します。inf は全件を正常と判定する場合です。",
+        )
+        col4.metric(
+            "推奨閾値でのF1 / コスト",
+            f"{best['f1'] or 0:.3f} / {best['cost']:,.0f}",
+            delta=f"現在: {f1:.3f} / {current['cost']:,.0f}",
+            delta_color="off",
+        )
+
+    curve = sweep.filter(pl.col("threshold").is_finite()).to_pandas()
+    col1, col2 = st.columns(2)
+    with col1:
+        fig_roc = px.line(
+            curve,
+            x="fpr",
+            y="recall",
+            hover_data=["threshold", "precision", "f1", "cost"],
+            title="ROC曲線",
+            labels={"fpr": "偽陽性率 (FPR)", "recall": "再現率 (Recall)"},
+        )
+        st.plotly_chart(fig_roc, use_container_width=True)
+    with col2:
+        fig_pr = px.line(
+            curve,
+            x="recall",
+            y="precision",
+            hover_data=["threshold", "fpr", "f1", "cost"],
+            title="PR曲線",
+            labels={"recall": "再現率 (Recall)", "precision": "適合率 (Precision)"},
+        )
+        st.plotly_chart(fig_pr, use_container_width=True)
+
     # --- スコア分布の可視化 ---
     st.header("不正・正常取引のSCORE分布")
     log_y_axis = st.checkbox("Y軸を対数スケールで表示", value=True)
-    fig_hist = px.histogram(
-        df.to_pandas(),
-        x="SCORE",
+    # ヒストグラムはスコアの値ごとの件数からビンごとの件数を求め、集計済みの棒グラフとして描く
+    hist_df = score_histogram.binned(bins=100).with_columns(
+        ((pl.col("bin_start") + pl.col("bin_end")) / 2).alias("bin_center")
+    )
+    fig_hist = px.bar(
+        hist_df.to_pandas(),
+        x="bin_center",
+        y="count",
         color="is_fraud",
         barmode="overlay",
-        nbins=100,
         title="SCORE分布（青: 正常, 赤: 不正）",
-        labels={"is_fraud": "不正フラグ"},
+        labels={"is_fraud": "不正フラグ", "bin_center": "SCORE", "count": "件数"},
         opacity=0.6,
         color_discrete_map={True: "red", False: "blue"},
         log_y=log_y_axis,
     )
+    fig_hist.update_layout(bargap=0)
     fig_hist.add_vline(
         x=score_threshold, line_width=3, line_dash="dash", line_color="green"
     )
@@ -117,39 +237,52 @@ else:
     # --- 誤分類データの詳細分析 ---
     st.header("誤分類データの詳細分析")
 
-    # 誤分類データを抽出
-    fn_df = df.filter((y_true == True) & (y_pred == False))
-    fp_df = df.filter((y_true == False) & (y_pred == True))
+    # 誤分類データの score_level ごとの件数
+    def level_counts(condition: pl.Expr) -> pl.DataFrame:
+        return (
+            counts.filter(condition)
+            .group_by("score_level")
+            .agg(pl.sum("count"))
+            .filter(pl.col("count") > 0)
+        )
+
+    predicted = pl.col("SCORE") >= score_threshold
+    misclassified = [
+        ("見逃し (FN)", fn, pl.col("is_fraud") & ~predicted, "見逃し"),
+        ("誤検出 (FP)", fp, ~pl.col("is_fraud") & predicted, "誤検出"),
+    ]
 
-    col1, col2 = st.columns(2)
-    with col1:
-        st.subheader(f"見逃し (FN) データ: {len(fn_df)}件")
-        if not fn_df.is_empty():
-            fig = px.histogram(
-                fn_df.to_pandas(),
-                x="score_level",
-                title="見逃しデータのScore Level分布",
-                category_orders={"score_level": ["low", "mid", "high"]},
-            )
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-            st.info("見逃しデータはありません。")
+    for col, (title, count, condition, name) in zip(st.columns(2), misclassified):
+        with col:
+            st.subheader(f"{title} データ: {count}件")
+            if count == 0:
+                st.info(f"{name}データはありません。")
+            elif "score_level" not in counts.columns:
+                st.info("データに score_level 列がありません。")
+            else:
+                fig = px.bar(
+                    level_counts(condition).to_pandas(),
+                    x="score_level",
+                    y="count",
+                    title=f"{name}データのScore Level分布",
+                    category_orders={"score_level": SCORE_LEVELS},
+                )
+                st.plotly_chart(fig, use_container_width=True)
 
-    with col2:
-        st.subheader(f"誤検出 (FP) データ: {len(fp_df)}件")
-        if not fp_df.is_empty():
-            fig = px.histogram(
-                fp_df.to_pandas(),
-                x="score_level",
-                title="誤検出データのScore Level分布",
-                category_orders={"score_level": ["low", "mid", "high"]},
-            )
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-            st.info("誤検出データはありません。")
+    # 取り込み時に作成した層別サンプルがあれば、プレビューと統計量はサンプルから計算する
+    sample_df = load_sample(prepared_data_dir)
+    if sample_df is None:
+        preview_df, describe_df = describe_data(prepared_data_dir, data_fingerprint)
+    else:
+        preview_df, describe_df = sample_df.head(), sample_df.describe()
 
     st.header("読み込みデータサンプル")
-    st.dataframe(df.head().to_pandas())
+    if sample_df is not None:
+        st.caption(
+            f"取り込み時に作成した層別サンプル（{sample_df.height:,}行）を表示しています。"
+            "is_fraud × event_month ごとに抽出しているため、不正取引の比率は全体と異なります。"
+        )
+    st.dataframe(preview_df.to_pandas())
 
     st.header("基本統計量")
-    st.dataframe(df.describe().to_pandas())
+    st.dataframe(describe_df.to_pandas())
@@ -0,0 +1,109 @@
+import polars as pl
+
+# 近似モードのサンプル率（表示名 -> 率）
+SAMPLE_FRACTIONS = {"0.1%": 0.001, "1%": 0.01, "10%": 0.1}
+
+# サンプルの抽出に使う固定シード。同じ条件では同じサンプルになるため、結果をキャッシュできる
+SAMPLE_SEED = 42
+
+# 95%信頼区間の係数
+Z_95 = 1.96
+
+
+def sample_lazy(
+    lf: pl.LazyFrame, fraction: float, seed: int = SAMPLE_SEED
+) -> pl.LazyFrame:
+    """
+    各行を確率 fraction で独立に抽出する（ベルヌーイ抽出）。
+    行番号のハッシュで抽出するため、同じデータ・同じシードでは同じ行が選ばれる。
+    """
+    if fraction >= 1:
+        return lf
+    threshold = pl.lit(int(fraction * 2**64), dtype=pl.UInt64)
+    return lf.filter(pl.int_range(pl.len(), dtype=pl.UInt64).hash(seed) < threshold)
+
+
+def estimate_aggs(
+    fraction: float, count_alias: str, sums: dict[str, str] | None = None
+) -> list[pl.Expr]:
+    """
+    サンプル率 fraction で抽出した行から、全体の件数・合計の推定値とその分散を求める集計式。
+    件数は count_alias、sums の {別名: 列名} は合計として集計し、分散は「別名_var」列に入れる。
+
+    ベルヌーイ抽出の Horvitz-Thompson 推定量を使う:
+    件数 n/p（分散 n(1-p)/p²）、合計 Σx/p（分散 Σx²(1-p)/p²）。
+    推定値と分散はどちらもグループについて加法的なため、集計結果をさらに
+    まとめ直す（group_by して sum する）場合も、両方を合計すればよい。
+    fraction=1 の場合は正確な件数・合計（分散0）になる。
+    """
+    sums = sums or {}
+    if fraction >= 1:
+        exprs = [pl.len().alias(count_alias), pl.lit(0.0).alias(f"{count_alias}_var")]
+        for alias, column in sums.items():
+            exprs += [pl.sum(column).alias(alias), pl.lit(0.0).alias(f"{alias}_var")]
+        return exprs
+
+    scale = 1 / fraction
+    var_scale = (1 - fraction) / fraction**2
+    exprs = [
+        (pl.len() * scale).alias(count_alias),
+        (pl.len() * var_scale).alias(f"{count_alias}_var"),
+    ]
+    for alias, column in sums.items():
+        exprs += [
+            (pl.sum(column) * scale).alias(alias),
+            ((pl.col(column).cast(pl.Float64) ** 2).sum() * var_scale).alias(
+                f"{alias}_var"
+            ),
+        ]
+    return exprs
+
+
+def ci_expr(var_column: str) -> pl.Expr:
+    """
+    分散の列から95%信頼区間の半幅（±）を求める。
+    """
+    return pl.col(var_column).sqrt() * Z_95
+
+
+def sample_clause_sql(fraction: float, seed: int = SAMPLE_SEED) -> str:
+    """
+    DuckDB でベルヌーイ抽出する TABLESAMPLE 句（FROM のテーブル・ビューの直後に置く）。
+    fraction=1 の場合は空文字列。
+    """
+    if fraction >= 1:
+        return ""
+    return f"TABLESAMPLE {fraction * 100:g}% (bernoulli, {seed})"
+
+
+def count_estimate_sql(fraction: float) -> tuple[str, str]:
+    """
+    件数の推定値と分散を求める SQL の集計式（estimate_aggs の SQL 版）。
+    """
+    if fraction >= 1:
+        return "COUNT(*)", "0.0"
+    return (
+        f"COUNT(*) / {fraction}",
+        f"COUNT(*) * {(1 - fraction) / fraction**2}",
+    )
+
+
+def sum_estimate_sql(column: str, fraction: float) -> tuple[str, str]:
+    """
+    合計の推定値と分散を求める SQL の集計式（estimate_aggs の SQL 版）。
+    """
+    if fraction >= 1:
+        return f"SUM({column})", "0.0"
+    return (
+        f"SUM({column}) / {fraction}",
+        f"SUM(POW(CAST({column} AS DOUBLE), 2)) * {(1 - fraction) / fraction**2}",
+    )
+
+
+def fraction_label(fraction: float) -> str:
+    """
+    結果の種類（サンプルからの推定値か、全データの確定値か）を表す表示用のラベル。
+    """
+    if fraction >= 1:
+        return "確定値（全データ）"
+    return f"近似値（{fraction * 100:g}%サンプルから推定、誤差棒は95%信頼区間）"
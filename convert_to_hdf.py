@@ -4,71 +4,22 @@ import tarfile
 from pathlib import Path
 from typing import List
 
-import numpy as np
 import pandas as pd
+import pyarrow as pa
 import typer
 
+from preprocess_rules import apply_arrow, default_rules
+
 app = typer.Typer(help="tar.gz内のTSVファイルを前処理し、HDF5形式に変換するCLIツール。")
 
 
 def preprocess_pandas(df: pd.DataFrame, score_thresholds: List[int]) -> pd.DataFrame:
     """
     Pandas DataFrameに対して、data_loader.pyのpreprocess相当の処理を適用する。
+    前処理ルールは preprocess_rules に宣言されており、Arrowの計算カーネルで一括適用する。
     """
-    # 1. 全列が欠損値の行を削除
-    df.dropna(how="all", inplace=True)
-
-    # 2. 欠損値処理
-    # SCORE, EVENT_VALUE: 0で補完
-    if "SCORE" in df.columns:
-        df["SCORE"] = df["SCORE"].fillna(0)
-    if "EVENT_VALUE" in df.columns:
-        df["EVENT_VALUE"] = df["EVENT_VALUE"].fillna(0)
-
-    # is_fraud: Falseで補完し、bool型に変換
-    if "is_fraud" in df.columns:
-        # 文字列の"False"がbool()でTrueになるのを防ぐため、明示的にマッピング
-        map_dict = {
-            "True": True,
-            "False": False,
-            "1": True,
-            "0": False,
-            1: True,
-            0: False,
-            True: True,
-            False: False,
-        }
-        df["is_fraud"] = df["is_fraud"].map(map_dict)
-        df["is_fraud"] = df["is_fraud"].fillna(False).astype(bool)
-
-    # 文字列型の列を"unknown"で補完
-    string_cols = df.select_dtypes(include=["object"]).columns
-    for col in string_cols:
-        if col not in ["is_fraud", "EVENT_TIME"]:
-            df[col] = df[col].fillna("unknown")
-
-    # EVENT_TIME: 日付型に変換し、前後の値で補完
-    if "EVENT_TIME" in df.columns:
-        df["EVENT_TIME"] = pd.to_datetime(df["EVENT_TIME"], errors="coerce")
-        df["EVENT_TIME"] = df["EVENT_TIME"].ffill()
-        df["EVENT_TIME"] = df["EVENT_TIME"].bfill()
-
-    # 3. 特徴量生成
-    t1, t2 = sorted(score_thresholds)
-    if "SCORE" in df.columns:
-        conditions = [
-            df["SCORE"] < t1,
-            (df["SCORE"] >= t1) & (df["SCORE"] < t2),
-        ]
-        choices = ["low", "mid"]
-        df["score_level"] = np.select(conditions, choices, default="high")
-
-    if "EVENT_TIME" in df.columns and pd.api.types.is_datetime64_any_dtype(
-        df["EVENT_TIME"]
-    ):
-        df["event_month"] = df["EVENT_TIME"].dt.to_period("M").dt.to_timestamp()
-
-    return df
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return apply_arrow(default_rules(score_thresholds), table).to_pandas()
 
 
 def convert_tar_to_hdf(file_path: Path, output_dir: Path, score_thresholds: List[int]):
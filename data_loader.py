@@ -1,15 +1,136 @@
 import os
+import multiprocessing
 import shutil
 import tarfile
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import Generator, List
+from typing import Generator, Iterator, List
+from urllib.parse import quote
 
+import click
 import duckdb
 import polars as pl
 import pyarrow as pa
 import pyarrow.parquet as pq
 import typer
 
+from dataset import (
+    MANIFEST_NAME,
+    SAMPLE_NAME,
+    TIME_COL,
+    list_partition_files,
+    write_manifest,
+)
+from preprocess_rules import apply_polars, default_rules
+from sampling import StratifiedReservoir
+from work_queue import LeaseQueue, default_worker_id
+
+# パーティション分割に使用する列
+PARTITION_COLS = ["event_month", "score_level"]
+
+# 値域が既知の列の型定義（スキーマレジストリ）。
+# 型の縮小はレジストリに定義された列のみに適用し、入力ファイルごとに型が変わって
+# 出力ファイル同士を結合できなくなるのを防ぐ。
+SCHEMA_REGISTRY: dict[str, pl.DataType] = {
+    "SCORE": pl.Int16,  # -1000..2500
+    "EVENT_VALUE": pl.UInt32,  # 0..1,000,000
+    "is_fraud": pl.Boolean,
+}
+
+# 列名の接頭辞で型を定義する列
+SCHEMA_REGISTRY_PREFIXES: dict[str, pl.DataType] = {
+    "numeric_col_": pl.UInt32,  # 0..1,000,000
+}
+
+# --time-precision で指定できる日時列の精度
+TIME_PRECISIONS = ["s", "ms"]
+
+
+def registry_dtype(name: str) -> pl.DataType | None:
+    """
+    スキーマレジストリに定義された列の型を返す。未定義の列はNoneを返す。
+    """
+    if name in SCHEMA_REGISTRY:
+        return SCHEMA_REGISTRY[name]
+    for prefix, dtype in SCHEMA_REGISTRY_PREFIXES.items():
+        if name.startswith(prefix):
+            return dtype
+    return None
+
+
+# 縮小候補の整数型とビット幅（狭い順）
+SIGNED_INT_DTYPES = [(pl.Int8, 8), (pl.Int16, 16), (pl.Int32, 32), (pl.Int64, 64)]
+UNSIGNED_INT_DTYPES = [
+    (pl.UInt8, 8),
+    (pl.UInt16, 16),
+    (pl.UInt32, 32),
+    (pl.UInt64, 64),
+]
+
+
+def int_dtype_fits(dtype: pl.DataType, lo: int, hi: int) -> bool:
+    """
+    [lo, hi] の値域が整数型 dtype で損失なく表現できるかどうかを返す。
+    """
+    for candidate, bits in UNSIGNED_INT_DTYPES:
+        if dtype == candidate:
+            return lo >= 0 and hi < 2**bits
+    for candidate, bits in SIGNED_INT_DTYPES:
+        if dtype == candidate:
+            return -(2 ** (bits - 1)) <= lo and hi < 2 ** (bits - 1)
+    return False
+
+
+def narrowest_int_dtype(lo: int, hi: int) -> pl.DataType:
+    """
+    [lo, hi] の値域を損失なく表現できる最も狭い整数型を返す。
+    """
+    if lo >= 0:
+        for dtype, bits in UNSIGNED_INT_DTYPES:
+            if hi < 2**bits:
+                return dtype
+    else:
+        for dtype, bits in SIGNED_INT_DTYPES:
+            if -(2 ** (bits - 1)) <= lo and hi < 2 ** (bits - 1):
+                return dtype
+    return pl.Int64
+
+
+def new_part_name() -> str:
+    """
+    パーティション内のファイル名を生成する。
+    時刻の接頭辞により、名前順がそのまま書き込み順になる。
+    """
+    return f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def hive_segment(col: str, value) -> str:
+    """
+    パーティション列と値から Hive 形式のディレクトリ名（列名=値）を作る。
+    """
+    if value is None:
+        return f"{col}=__HIVE_DEFAULT_PARTITION__"
+    return f"{col}={quote(str(value), safe='')}"
+
+
+def find_partition_dirs(root: Path) -> list[Path]:
+    """
+    root 配下のパーティションディレクトリ（データファイルまたはマニフェストを持つ）を返す。
+    "_" や "." で始まる作業用ディレクトリは除外する。
+    """
+    candidates = {p.parent for p in root.glob("**/*.parquet")} | {
+        p.parent for p in root.glob(f"**/{MANIFEST_NAME}")
+    }
+    return sorted(
+        d
+        for d in candidates
+        if not any(
+            part.startswith(("_", ".")) for part in d.relative_to(root).parts
+        )
+    )
+
 
 class DataLoader:
     """
@@ -25,17 +146,54 @@ class DataLoader:
         to_duckdb: bool,
         duckdb_path: Path,
         temp_dir: Path = Path("temp_extracted_data"),
+        compact_types: bool = False,
+        time_precision: str = "ms",
+        merge: bool = False,
+        dedup_key: List[str] | None = None,
+        queue_dir: Path | None = None,
+        worker_id: str | None = None,
+        lease_ttl: float = 300.0,
+        retry_failed: bool = False,
+        sample_size: int = 1000,
     ):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.score_thresholds = sorted(score_thresholds)
+        self.rules = default_rules(self.score_thresholds)
         self.partitioned = partitioned
         self.to_duckdb = to_duckdb
         self.duckdb_path = duckdb_path
         self.temp_dir = temp_dir
+        self.compact_types = compact_types
+        if time_precision not in TIME_PRECISIONS:
+            raise ValueError(
+                f"time_precision は {TIME_PRECISIONS} のいずれかを指定してください: {time_precision}"
+            )
+        self.time_precision = time_precision
+        self.merge = merge
+        self.dedup_key = dedup_key or []
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_ttl = lease_ttl
+        self.retry_failed = retry_failed
+        # プレビュー用の層別サンプル（全体と、処理中の入力ファイルの分）
+        self.sample_size = sample_size
+        self.sample = self.new_reservoir()
+        self.file_sample: StratifiedReservoir | None = None
+        # ワークキューモードで使用するキューと、処理中のアイテムのキー
+        self.queue: LeaseQueue | None = None
+        self.current_key: str | None = None
+        # 処理中にエラーが発生したファイル（ワークキューモードでの失敗判定に使用）
+        self.failed_files: list[Path] = []
+
+        if self.queue_dir is not None:
+            if self.to_duckdb:
+                raise ValueError("ワークキューモードはDuckDBへの保存と併用できません。")
+            # 一時ファイルの衝突と他ワーカーによる削除を防ぐため、ワーカーごとに分ける
+            self.temp_dir = self.temp_dir / self.worker_id
 
         self.output_dir.mkdir(exist_ok=True)
-        self.temp_dir.mkdir(exist_ok=True)
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
         if self.to_duckdb:
             self.duckdb_path.parent.mkdir(exist_ok=True)
 
@@ -62,35 +220,72 @@ class DataLoader:
     def preprocess(self, lf: pl.LazyFrame) -> pl.LazyFrame:
         """
         欠損値処理、カテゴリ分類、日付情報の追加などの前処理を適用する。
+        ルールは preprocess_rules に宣言されており、HDF5変換（convert_to_hdf）と共通。
         """
-        # 1. 全列が欠損値の行を削除
-        lf = lf.filter(~pl.all_horizontal(pl.all().is_null()))
-
-        # 2. 欠損値処理
-        lf = lf.with_columns(
-            # SCORE, EVENT_VALUE: 0で補完
-            pl.col("SCORE").fill_null(0),
-            pl.col("EVENT_VALUE").fill_null(0),
-            # 文字列型(pl.Utf8)の列を"unknown"で補完
-            pl.col(pl.Utf8).fill_null("unknown"),
-            # is_fraud: Falseで補完
-            pl.col("is_fraud").fill_null(False),
-            # EVENT_TIME: 前後の値で補完
-            pl.col("EVENT_TIME").forward_fill(),
-        )
-        # numeric_col_* は null のまま
-
-        # 3. 元の前処理
-        t1, t2 = self.score_thresholds
-        return lf.with_columns(
-            pl.when(pl.col("SCORE") < t1)
-            .then(pl.lit("low"))
-            .when(pl.col("SCORE") < t2)
-            .then(pl.lit("mid"))
-            .otherwise(pl.lit("high"))
-            .alias("score_level"),
-            pl.col("EVENT_TIME").dt.truncate("1mo").alias("event_month"),
-        )
+        return apply_polars(self.rules, lf)
+
+    def compact_dtypes(self, lf: pl.LazyFrame, observe: bool = True) -> pl.LazyFrame:
+        """
+        スキーマレジストリに定義された列を、定義された狭い型に変換する。
+        レジストリにない列は元の型のままとし、データセット内で型を揃える。
+        observe=True の場合は実データの値域を1回の集計で確認し、レジストリの型に
+        収まらない列は警告を出して値域に合う最も狭い整数型にフォールバックする。
+        日時列はミリ秒精度（time_precision="s" の場合は秒単位に切り捨て）に変換する。
+        """
+        schema = lf.collect_schema()
+        targets: dict[str, pl.DataType] = {}
+        for name, current in schema.items():
+            dtype = registry_dtype(name)
+            if dtype is None or dtype == current:
+                continue
+            # 浮動小数点 -> 整数の変換は値を失うため行わない
+            if dtype.is_integer() and not current.is_integer():
+                continue
+            targets[name] = dtype
+
+        int_targets = [name for name, dtype in targets.items() if dtype.is_integer()]
+        if observe and int_targets:
+            stats = (
+                lf.select(
+                    *[pl.col(c).min().alias(f"{c}__min") for c in int_targets],
+                    *[pl.col(c).max().alias(f"{c}__max") for c in int_targets],
+                )
+                .collect()
+                .row(0, named=True)
+            )
+            for c in int_targets:
+                lo, hi = stats[f"{c}__min"], stats[f"{c}__max"]
+                if lo is None:
+                    continue  # 全て欠損値
+                dtype = targets[c]
+                if int_dtype_fits(dtype, lo, hi):
+                    continue
+                fallback = narrowest_int_dtype(lo, hi)
+                typer.secho(
+                    f"警告: 列 {c} の値域 [{lo}, {hi}] が {dtype} に収まらないため "
+                    f"{fallback} で保存します。",
+                    fg=typer.colors.YELLOW,
+                )
+                targets[c] = fallback
+
+        casts = [pl.col(name).cast(dtype, strict=True) for name, dtype in targets.items()]
+
+        # 日時列の精度を落とす
+        time_expr = pl.col(pl.Datetime)
+        if self.time_precision == "s":
+            time_expr = time_expr.dt.truncate("1s")
+        casts.append(time_expr.dt.cast_time_unit("ms"))
+
+        return lf.with_columns(casts)
+
+    def sort_by_time(self, frame: pl.LazyFrame | pl.DataFrame):
+        """
+        行を EVENT_TIME 順に並べる。Parquetの行グループごとの最小値・最大値が短い期間に
+        まとまるため、期間を指定した読み込みで範囲外の行グループを読み飛ばせる。
+        """
+        if TIME_COL not in frame.collect_schema().names():
+            return frame
+        return frame.sort(TIME_COL, nulls_last=True, maintain_order=True)
 
     def process_file(self, file_path: Path, output_dir: Path | None = None):
         """
@@ -114,38 +309,224 @@ class DataLoader:
             processed_lf = self.preprocess(lf)
 
             if self.partitioned:
-                output_partition_dir = output_dir / file_path.stem
-                if output_partition_dir.exists():
-                    typer.echo(f"スキップ: {output_partition_dir} は既に存在します。")
-                    return
-                typer.echo(f"パーティション分割して保存: {output_partition_dir}")
-                df = processed_lf.collect()
-                df.write_parquet(
-                    output_partition_dir,
-                    partition_by=["event_month", "score_level"],
-                    use_pyarrow=True,
-                )
-                typer.echo(f"保存完了: {output_partition_dir}")
+                self.save_partitioned(processed_lf, output_dir / file_path.stem)
             else:
                 output_path = output_dir / f"{file_path.stem}.parquet"
-                if output_path.exists():
+                if output_path.exists() and not self.merge:
                     typer.echo(f"スキップ: {output_path} は既に存在します。")
                     return
-                typer.echo(f"単一ファイルとして保存: {output_path}")
-                processed_lf.sink_parquet(output_path)
+                if self.compact_types:
+                    # 値域の観測のため入力ファイルを追加で1回スキャンする
+                    processed_lf = self.compact_dtypes(processed_lf)
+                processed_lf = self.sort_by_time(processed_lf)
+                with self.output_lock(output_path):
+                    if output_path.exists():
+                        typer.echo(f"既存ファイルにマージ: {output_path}")
+                        self.merge_single_file(processed_lf, output_path)
+                    else:
+                        typer.echo(f"単一ファイルとして保存: {output_path}")
+                        # 途中で失敗しても不完全なファイルが残らないよう、一時ファイル経由で保存する
+                        tmp_path = output_path.with_name(
+                            f"{output_path.name}.{uuid.uuid4().hex}.tmp"
+                        )
+                        try:
+                            processed_lf.sink_parquet(tmp_path)
+                            os.replace(tmp_path, output_path)
+                        finally:
+                            tmp_path.unlink(missing_ok=True)
+                        # 入力を再スキャンしないよう、書き出したファイルから抽出する
+                        processed_lf = pl.scan_parquet(output_path)
+                    self.sample_rows(processed_lf)
                 typer.echo(f"保存完了: {output_path}")
 
         except Exception as e:
+            self.failed_files.append(file_path)
             typer.secho(
                 f"エラー: {file_path} の処理中にエラーが発生しました: {e}",
                 fg=typer.colors.RED,
             )
 
-    def process_tar_gz(self, file_path: Path):
+    def save_partitioned(self, processed_lf: pl.LazyFrame, output_partition_dir: Path):
+        """
+        前処理済みデータを event_month / score_level でパーティション分割して保存する。
+        出力先が既に存在する場合、マージモードであれば該当パーティションへ追記し、
+        そうでなければスキップする。
+        """
+        if output_partition_dir.exists() and not self.merge:
+            typer.echo(f"スキップ: {output_partition_dir} は既に存在します。")
+            return
+        df = processed_lf.collect()
+        if self.compact_types:
+            df = self.compact_dtypes(df.lazy()).collect()
+        self.sample_rows(df.lazy())
+        with self.output_lock(output_partition_dir):
+            if output_partition_dir.exists():
+                typer.echo(f"既存パーティションにマージ: {output_partition_dir}")
+                self.merge_partitions(df, output_partition_dir)
+            else:
+                typer.echo(f"パーティション分割して保存: {output_partition_dir}")
+                # 作業用ディレクトリに書き出してから rename し、不完全な出力を残さない
+                staging_dir = output_partition_dir.with_name(
+                    f"_staging-{output_partition_dir.name}-{uuid.uuid4().hex}"
+                )
+                try:
+                    self.write_partitions(df, staging_dir)
+                    if staging_dir.exists():
+                        os.rename(staging_dir, output_partition_dir)
+                finally:
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+        typer.echo(f"保存完了: {output_partition_dir}")
+
+    def write_partitions(self, df: pl.DataFrame, root: Path) -> list[Path]:
+        """
+        DataFrameをHive形式（列名=値）のディレクトリに分割して書き出し、
+        書き出したファイルのパスを返す。
+        パーティション列はファイル内にも残し、ファイル単体で読み込んでも列が欠けないようにする。
+        """
+        written: list[Path] = []
+        name = new_part_name()
+        for values, part in df.partition_by(
+            PARTITION_COLS, as_dict=True, maintain_order=True
+        ).items():
+            partition_dir = root.joinpath(
+                *[
+                    hive_segment(col, value)
+                    for col, value in zip(PARTITION_COLS, values)
+                ]
+            )
+            partition_dir.mkdir(parents=True, exist_ok=True)
+            path = partition_dir / name
+            self.sort_by_time(part).write_parquet(path)
+            written.append(path)
+        return written
+
+    def merge_partitions(self, df: pl.DataFrame, root: Path):
+        """
+        遅れて到着したデータを既存のパーティションへ追加ファイルとしてマージする。
+        新しいデータは作業用ディレクトリに書き出してから各パーティションへ移動し、
+        マニフェスト（パーティションのファイル一覧）を原子的に更新する。
+
+        dedup_key が指定されている場合は、新しいデータと同じキーを持つ行を
+        root 配下の全パーティションから取り除く（同じキーは新しいデータを優先）。
+        SCOREやEVENT_TIMEの訂正で行が別のパーティションへ移る場合にも重複が残らない。
+        キーの照合には全パーティションのキー列を読み込むが、書き直すのは
+        該当するキーを含むパーティションのみ。
+        """
+        key = self.dedup_key
+        if key:
+            df = df.unique(subset=key, keep="last", maintain_order=True)
+
+        staging_dir = root / f"_staging-{uuid.uuid4().hex}"
+        try:
+            staged_files = self.write_partitions(df, staging_dir)
+            new_files_by_partition: dict[Path, list[Path]] = {}
+            for staged in staged_files:
+                partition_dir = root / staged.parent.relative_to(staging_dir)
+                new_files_by_partition.setdefault(partition_dir, []).append(staged)
+
+            # 1. 同じキーを含む既存パーティションを特定する
+            stale_by_partition: dict[Path, list[Path]] = {}
+            if key:
+                new_keys = df.select(key).unique()
+                for partition_dir in find_partition_dirs(root):
+                    files = list_partition_files(partition_dir)
+                    if files and self.count_key_matches(files, new_keys) > 0:
+                        stale_by_partition[partition_dir] = files
+
+            affected = list(
+                dict.fromkeys([*stale_by_partition, *new_files_by_partition])
+            )
+
+            # 2. 書き換え前のファイル一覧を固定し、途中の状態が読み手に見えないようにする
+            current_by_partition: dict[Path, list[Path]] = {}
+            for partition_dir in affected:
+                partition_dir.mkdir(parents=True, exist_ok=True)
+                current = list_partition_files(partition_dir)
+                write_manifest(partition_dir, [p.name for p in current])
+                current_by_partition[partition_dir] = current
+
+            # 3. キーが一致する行を除いたファイルを書き出し、新しいデータを移動する
+            for partition_dir in affected:
+                current = current_by_partition[partition_dir]
+                kept = current
+                if partition_dir in stale_by_partition:
+                    kept = self.rewrite_without_keys(current, new_keys, partition_dir)
+                moved = []
+                for staged in new_files_by_partition.get(partition_dir, []):
+                    target = partition_dir / staged.name
+                    os.replace(staged, target)
+                    moved.append(target)
+
+                # 4. マニフェストを書き込み順で置き換え、不要になったファイルを削除する
+                write_manifest(partition_dir, [p.name for p in kept + moved])
+                for old in current:
+                    if old not in kept:
+                        old.unlink(missing_ok=True)
+                typer.echo(f"  -> マージ: {partition_dir}")
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def count_key_matches(self, files: list[Path], new_keys: pl.DataFrame) -> int:
+        """
+        ファイル群に含まれる行のうち、new_keys と同じキーを持つ行数を返す。
+        """
+        lf = pl.concat([pl.scan_parquet(p) for p in files], how="diagonal_relaxed")
+        schema = lf.collect_schema()
+        keys = new_keys.cast({c: schema[c] for c in new_keys.columns}, strict=False)
+        return (
+            lf.select(new_keys.columns)
+            .join(keys.lazy(), on=new_keys.columns, how="semi")
+            .select(pl.len())
+            .collect()
+            .item()
+        )
+
+    def rewrite_without_keys(
+        self, files: list[Path], new_keys: pl.DataFrame, partition_dir: Path
+    ) -> list[Path]:
+        """
+        パーティションのファイルから new_keys と同じキーの行を除いた1ファイルを書き出し、
+        新しいファイル一覧を返す（残る行がなければ空）。
+        """
+        lf = pl.concat([pl.scan_parquet(p) for p in files], how="diagonal_relaxed")
+        schema = lf.collect_schema()
+        keys = new_keys.cast({c: schema[c] for c in new_keys.columns}, strict=False)
+        remaining = lf.join(keys.lazy(), on=new_keys.columns, how="anti").collect()
+        if remaining.is_empty():
+            return []
+        path = partition_dir / new_part_name()
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        remaining.write_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        return [path]
+
+    def merge_single_file(self, processed_lf: pl.LazyFrame, output_path: Path):
+        """
+        既存の単一Parquetファイルに新しいデータをマージし、原子的に置き換える。
+        dedup_key が指定されている場合は重複排除する（同じキーは新しいデータを優先）。
+        """
+        merged_lf = pl.concat(
+            [pl.scan_parquet(output_path), processed_lf], how="diagonal_relaxed"
+        )
+        if self.dedup_key:
+            merged_lf = merged_lf.unique(
+                subset=self.dedup_key, keep="last", maintain_order=True
+            )
+        merged_lf = self.sort_by_time(merged_lf)
+        tmp_path = output_path.with_name(f"{output_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            merged_lf.sink_parquet(tmp_path)
+            os.replace(tmp_path, output_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def process_tar_gz(self, file_path: Path, output_dir: Path | None = None):
         """
         tar.gzファイルを展開し、内部のTSVファイルを一つにまとめてParquetとして保存する。
         パーティション分割が有効な場合は、サブディレクトリに分割して保存する。
         """
+        if output_dir is None:
+            output_dir = self.output_dir
         typer.echo(f"処理中（アーカイブ）: {file_path}")
 
         try:
@@ -185,39 +566,33 @@ class DataLoader:
                 processed_lf = self.preprocess(combined_lf)
 
                 # このメソッドはパーティション分割専用とする
-                output_partition_dir = (
-                    self.output_dir / f"{file_path.name.removesuffix('.tar.gz')}"
+                self.save_partitioned(
+                    processed_lf,
+                    output_dir / f"{file_path.name.removesuffix('.tar.gz')}",
                 )
-                if output_partition_dir.exists():
-                    typer.echo(f"スキップ: {output_partition_dir} は既に存在します。")
-                    return
-                typer.echo(f"パーティション分割して保存: {output_partition_dir}")
-                df = processed_lf.collect()
-                df.write_parquet(
-                    output_partition_dir,
-                    partition_by=["event_month", "score_level"],
-                    use_pyarrow=True,
-                )
-                typer.echo(f"保存完了: {output_partition_dir}")
 
         except Exception as e:
+            self.failed_files.append(file_path)
             typer.secho(
                 f"エラー: {file_path} の処理中にエラーが発生しました: {e}",
                 fg=typer.colors.RED,
             )
 
-    def process_tar_gz_in_chunks(self, file_path: Path):
+    def process_tar_gz_in_chunks(self, file_path: Path, output_dir: Path | None = None):
         """
         tar.gzファイルをチャンク処理し、内部のTSVファイルを単一のParquetに追記保存する。
         """
+        if output_dir is None:
+            output_dir = self.output_dir
+        output_dir.mkdir(exist_ok=True)
         typer.echo(f"処理中（チャンク処理）: {file_path}")
-        output_path = (
-            self.output_dir / f"{file_path.name.removesuffix('.tar.gz')}.parquet"
-        )
-        if output_path.exists():
+        output_path = output_dir / f"{file_path.name.removesuffix('.tar.gz')}.parquet"
+        if output_path.exists() and not self.merge:
             typer.echo(f"スキップ: {output_path} は既に存在します。")
             return
 
+        # チャンクは一時ファイルに書き出し、全て成功した場合のみ出力に反映する
+        chunk_path = output_path.with_name(f"{output_path.name}.{uuid.uuid4().hex}.tmp")
         writer = None
         try:
             with tarfile.open(file_path, "r:gz") as tar:
@@ -258,7 +633,15 @@ class DataLoader:
                                 break
                             batch = batches[0]
                             # polarsのDataFrameに変換し、前処理を適用
-                            processed_df = self.preprocess(batch.lazy()).collect()
+                            processed_lf = self.preprocess(batch.lazy())
+                            if self.compact_types:
+                                # バッチ間でスキーマを揃えるため、レジストリの型のみ使用
+                                processed_lf = self.compact_dtypes(
+                                    processed_lf, observe=False
+                                )
+                            # バッチ単位で時刻順に並べ、行グループの期間を狭くする
+                            processed_df = self.sort_by_time(processed_lf).collect()
+                            self.sample_rows(processed_df.lazy())
 
                             # Arrowテーブルに変換
                             arrow_table = processed_df.to_arrow()
@@ -266,7 +649,7 @@ class DataLoader:
                             if writer is None:
                                 # 最初のバッチでスキーマを決定し、Writerを初期化
                                 writer = pq.ParquetWriter(
-                                    output_path, arrow_table.schema
+                                    chunk_path, arrow_table.schema
                                 )
 
                             writer.write_table(arrow_table)
@@ -274,7 +657,22 @@ class DataLoader:
                         # 一時ファイルを削除
                         os.remove(temp_file_path)
 
+            if writer is None:
+                typer.echo(f"警告: {file_path} 内に有効なデータがありませんでした。")
+                return
+            writer.close()
+            writer = None
+
+            with self.output_lock(output_path):
+                if output_path.exists():
+                    typer.echo(f"既存ファイルにマージ: {output_path}")
+                    self.merge_single_file(pl.scan_parquet(chunk_path), output_path)
+                else:
+                    os.replace(chunk_path, output_path)
+            typer.echo(f"保存完了: {output_path}")
+
         except Exception as e:
+            self.failed_files.append(file_path)
             typer.secho(
                 f"エラー: {file_path} の処理中にエラーが発生しました: {e}",
                 fg=typer.colors.RED,
@@ -282,7 +680,19 @@ class DataLoader:
         finally:
             if writer:
                 writer.close()
-                typer.echo(f"保存完了: {output_path}")
+            chunk_path.unlink(missing_ok=True)
+
+    def preprocess_for_duckdb(self, lf: pl.LazyFrame) -> pl.DataFrame:
+        """
+        DuckDBへ挿入するデータに前処理を適用する。
+        テーブルはファイル単位で追記するため、型の縮小はレジストリの型のみとする。
+        """
+        processed_lf = self.preprocess(lf)
+        if self.compact_types:
+            processed_lf = self.compact_dtypes(processed_lf, observe=False)
+        processed_df = processed_lf.collect()
+        self.sample_rows(processed_df.lazy())
+        return processed_df
 
     def process_tar_gz_to_duckdb(self, file_path: Path):
         """
@@ -317,7 +727,7 @@ class DataLoader:
                                 quote_char=None,
                                 ignore_errors=True,
                             )
-                            processed_df = self.preprocess(lf).collect()
+                            processed_df = self.preprocess_for_duckdb(lf)
                             # テーブルが存在しない場合のみ作成
                             con.execute(
                                 f"CREATE TABLE IF NOT EXISTS {table_name} AS SELECT * FROM processed_df"
@@ -338,45 +748,251 @@ class DataLoader:
                                     quote_char=None,
                                     ignore_errors=True,
                                 )
-                                processed_df = self.preprocess(lf).collect()
+                                processed_df = self.preprocess_for_duckdb(lf)
                                 con.execute(
                                     f"INSERT INTO {table_name} SELECT * FROM processed_df"
                                 )
                 typer.echo(f"テーブル '{table_name}' へのデータ追加が完了しました。")
 
         except Exception as e:
+            self.failed_files.append(file_path)
             typer.secho(
                 f"エラー: {file_path} のDuckDBへの保存中にエラーが発生しました: {e}",
                 fg=typer.colors.RED,
             )
 
+    def new_reservoir(self) -> StratifiedReservoir | None:
+        if self.sample_size <= 0:
+            return None
+        return StratifiedReservoir(self.sample_size, dedup_key=self.dedup_key)
+
+    def sample_rows(self, lf: pl.LazyFrame):
+        """
+        取り込んだ行をプレビュー用サンプルの候補に加える。
+        候補は入力ファイルの処理が成功した時点で commit_sample により全体のサンプルに反映する。
+        """
+        if self.sample is None:
+            return
+        if self.file_sample is None:
+            self.file_sample = self.new_reservoir()
+        self.file_sample.add(lf)
+
+    def commit_sample(self, succeeded: bool):
+        """
+        処理中の入力ファイルのサンプル候補を、成功した場合のみ全体のサンプルに反映する。
+        """
+        if succeeded and self.file_sample is not None:
+            self.sample.merge(self.file_sample.sample)
+        self.file_sample = None
+
+    def write_sample(self):
+        """
+        取り込み中に集めた層別サンプルを出力ディレクトリの _sample.parquet に保存する。
+        既存のサンプルと結合して保存するため、追加の取り込みや他のワーカーの分もまとめられる。
+        """
+        if self.sample is None or self.sample.is_empty():
+            return
+        sample_path = self.output_dir / SAMPLE_NAME
+        lock = (
+            nullcontext()
+            if self.queue is None
+            else self.queue.hold(f"output:{SAMPLE_NAME}")
+        )
+        with lock:
+            combined = self.new_reservoir()
+            if sample_path.exists():
+                combined.merge(pl.read_parquet(sample_path))
+            combined.merge(self.sample.sample)
+            tmp_path = sample_path.with_name(f"{SAMPLE_NAME}.{uuid.uuid4().hex}.tmp")
+            try:
+                combined.sample.write_parquet(tmp_path)
+                os.replace(tmp_path, sample_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        typer.echo(f"層別サンプルを保存しました: {sample_path}")
+
+    def process_path(self, file_path: Path, output_dir: Path | None = None):
+        """
+        ファイル形式と設定に応じて、適切な処理メソッドへ振り分ける。
+        """
+        if self.to_duckdb:
+            if file_path.suffix == ".gz" and file_path.name.endswith(".tar.gz"):
+                self.process_tar_gz_to_duckdb(file_path)
+            else:
+                typer.echo(
+                    f"スキップ（DuckDBモード）: {file_path} は.tar.gz形式ではありません。"
+                )
+        elif file_path.suffix in [".tsv", ".txt"]:
+            self.process_file(file_path, output_dir)
+        elif file_path.suffix == ".gz" and file_path.name.endswith(".tar.gz"):
+            if self.partitioned:
+                self.process_tar_gz(file_path, output_dir)
+            else:
+                self.process_tar_gz_in_chunks(file_path, output_dir)
+
     def run(self):
         """
         データ処理パイプラインを実行する。
         """
         typer.echo("データ処理を開始します...")
         try:
-            for file_path in self.find_files():
-                if self.to_duckdb:
-                    if file_path.suffix == ".gz" and file_path.name.endswith(".tar.gz"):
-                        self.process_tar_gz_to_duckdb(file_path)
-                    else:
-                        typer.echo(
-                            f"スキップ（DuckDBモード）: {file_path} は.tar.gz形式ではありません。"
-                        )
-                elif file_path.suffix in [".tsv", ".txt"]:
-                    self.process_file(file_path)
-                elif file_path.suffix == ".gz" and file_path.name.endswith(".tar.gz"):
-                    if self.partitioned:
-                        self.process_tar_gz(file_path)
-                    else:
-                        self.process_tar_gz_in_chunks(file_path)
+            if self.queue_dir is not None:
+                self.run_queue_worker()
+            else:
+                for file_path in self.find_files():
+                    failed_before = len(self.failed_files)
+                    self.process_path(file_path)
+                    self.commit_sample(len(self.failed_files) == failed_before)
+            self.write_sample()
         finally:
             shutil.rmtree(self.temp_dir)
+            if self.queue_dir is not None:
+                # 最後のワーカーが共通の親ディレクトリも片付ける
+                try:
+                    os.rmdir(self.temp_dir.parent)
+                except OSError:
+                    pass
             typer.echo("一時ファイルをクリーンアップしました。")
 
         typer.secho("データ処理が完了しました。", fg=typer.colors.GREEN)
 
+    def queue_key(self, file_path: Path) -> str:
+        """
+        入力ファイルのワークキュー上のキーを返す。
+        サイズと更新時刻を含めるため、内容が差し替えられたファイルは別のアイテムとして再処理される。
+        """
+        stat = file_path.stat()
+        rel = file_path.relative_to(self.input_dir)
+        return f"{rel}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def run_queue_worker(self):
+        """
+        共有ディレクトリのワークキューから入力ファイルを取得しながら処理する。
+        他のワーカーが処理中のファイルはスキップし、放棄されたリースは回収して処理する。
+        全ての入力が処理済みになるまで繰り返す。
+        """
+        queue = LeaseQueue(self.queue_dir, self.worker_id, self.lease_ttl)
+        self.queue = queue
+        poll_interval = min(self.lease_ttl / 4, 5.0)
+        typer.echo(f"ワーカー {queue.worker_id} としてキューを処理します: {self.queue_dir}")
+        if self.retry_failed:
+            cleared = queue.clear_failed()
+            typer.echo(f"失敗した {cleared} 件の入力を再試行します。")
+
+        keys = {file_path: self.queue_key(file_path) for file_path in self.find_files()}
+        while True:
+            pending = [f for f, key in keys.items() if not queue.is_finished(key)]
+            if not pending:
+                break
+            claimed_any = False
+            for file_path in pending:
+                key = keys[file_path]
+                if not queue.try_claim(key):
+                    continue
+                claimed_any = True
+                self.process_claimed(queue, key, file_path)
+            if not claimed_any:
+                # 他のワーカーが処理中。リースの完了または期限切れを待つ
+                time.sleep(poll_interval)
+
+    def output_lock(self, output_path: Path):
+        """
+        マージ先の出力を他のワーカーと排他するロックを返す。
+        ワークキューでのマージ時のみ、出力先ごとのリースを取得する。
+        ロック取得後に入力のリースを失っていた場合は、書き込まずに中断する。
+        """
+        if self.queue is None or not self.merge:
+            return nullcontext()
+        return self._hold_output(output_path)
+
+    @contextmanager
+    def _hold_output(self, output_path: Path) -> Iterator[None]:
+        rel = output_path.relative_to(self.output_dir)
+        with self.queue.hold(f"output:{rel}"):
+            if self.current_key is not None and not self.queue.owns(self.current_key):
+                raise RuntimeError(
+                    "入力のリースを失ったため、出力への書き込みを中断しました。"
+                )
+            yield
+
+    def process_claimed(self, queue: LeaseQueue, key: str, file_path: Path):
+        """
+        リースを取得した入力ファイルを処理する。
+        出力はワーカー固有の作業用ディレクトリに書き出し、リースを保持したまま成功した場合のみ
+        出力ディレクトリへ移動する。途中で停止したワーカーやリースを失ったワーカーの出力は公開されない。
+        マージモードでは出力先ごとのリースで排他しながら直接マージする。
+        """
+        item = queue.item_name(key)
+        # 放棄されたリースを回収した場合に備え、以前のワーカーの作業用出力を削除する
+        for stale in self.output_dir.glob(f"_inprogress-*-{item}"):
+            shutil.rmtree(stale, ignore_errors=True)
+
+        staging_dir = self.output_dir / f"_inprogress-{queue.worker_id}-{item}"
+        failed_before = len(self.failed_files)
+        self.current_key = key
+        try:
+            with queue.heartbeat(key):
+                if self.merge:
+                    self.process_path(file_path)
+                else:
+                    self.process_path(file_path, staging_dir)
+                    if len(self.failed_files) == failed_before:
+                        if not queue.owns(key):
+                            raise RuntimeError(
+                                "リースを失ったため、出力を公開せずに破棄します。"
+                            )
+                        self.publish_outputs(staging_dir, item)
+        except Exception as e:
+            self.failed_files.append(file_path)
+            typer.secho(
+                f"エラー: {file_path} の処理中にエラーが発生しました: {e}",
+                fg=typer.colors.RED,
+            )
+        finally:
+            self.current_key = None
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        succeeded = len(self.failed_files) == failed_before
+        if succeeded:
+            recorded = queue.complete(key)
+        else:
+            recorded = queue.fail(key)
+        self.commit_sample(succeeded and recorded)
+        if not recorded:
+            typer.secho(
+                f"警告: {file_path} のリースを失ったため、結果を記録しませんでした。",
+                fg=typer.colors.YELLOW,
+            )
+
+    def publish_outputs(self, staging_dir: Path, item: str):
+        """
+        作業用ディレクトリの出力を出力ディレクトリへ移動する。
+        同名の出力が既に存在する場合は上書きせず、アイテム名を付けた別名で公開する。
+        """
+        if not staging_dir.exists():
+            return
+        for child in staging_dir.iterdir():
+            target = self.output_dir / child.name
+            if target.exists():
+                target = self.output_dir / f"{child.stem}-{item}{child.suffix}"
+                typer.echo(
+                    f"{self.output_dir / child.name} は既に存在するため、{target} として保存します。"
+                )
+            if child.is_dir():
+                # 空でない既存ディレクトリへの rename は失敗するため上書きされない
+                os.rename(child, target)
+            else:
+                # link は既存ファイルがあれば失敗するため上書きされない
+                os.link(child, target)
+                child.unlink()
+
+
+def run_local_worker(loader_kwargs: dict, worker_id: str):
+    """
+    ローカルのワーカープロセスとしてワークキューを処理する（multiprocessing用）。
+    """
+    DataLoader(**loader_kwargs, worker_id=worker_id).run()
+
 
 app = typer.Typer(help="データローダー・前処理パイプライン")
 
@@ -417,17 +1033,108 @@ def main(
         "--duckdb-path",
         help="DuckDBデータベースファイルのパス。",
     ),
+    compact_types: bool = typer.Option(
+        False,
+        "--compact-types",
+        help="値域に応じて数値列を最小の型に縮小し、日時列の精度を落として保存するかどうか。",
+    ),
+    time_precision: str = typer.Option(
+        "ms",
+        "--time-precision",
+        click_type=click.Choice(TIME_PRECISIONS),
+        help="--compact-types 時の日時列の精度（s または ms）。",
+    ),
+    merge: bool = typer.Option(
+        False,
+        "--merge",
+        help="出力先が既に存在する場合、スキップせずに該当パーティションへマージするかどうか。",
+    ),
+    dedup_key: List[str] = typer.Option(
+        None,
+        "--dedup-key",
+        help="マージ時に重複排除するキー列（複数指定可）。",
+    ),
+    queue_dir: Path = typer.Option(
+        None,
+        "--queue-dir",
+        help="共有ワークキューのディレクトリ。指定すると複数プロセス・ホストで入力を分担して処理する。",
+    ),
+    worker_id: str = typer.Option(
+        None,
+        "--worker-id",
+        help="ワーカーID。デフォルトは「ホスト名-プロセスID」。",
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        help="--queue-dir 使用時に起動するローカルワーカープロセス数。",
+    ),
+    lease_ttl: float = typer.Option(
+        300.0,
+        "--lease-ttl",
+        help="リースの有効期間（秒）。この時間ハートビートが途絶えたリースは回収される。",
+    ),
+    retry_failed: bool = typer.Option(
+        False,
+        "--retry-failed",
+        help="--queue-dir 使用時に、以前の実行で失敗した入力を再試行するかどうか。",
+    ),
+    sample_size: int = typer.Option(
+        1000,
+        "--sample-size",
+        min=0,
+        help="プレビュー用の層別サンプル（_sample.parquet）の is_fraud × event_month ごとの最大行数。0で作成しない。",
+    ),
 ):
     """
     データローダーを実行し、ファイルを前処理してParquetまたはDuckDB形式で保存します。
     """
-    loader = DataLoader(
+    if queue_dir is None and workers > 1:
+        raise typer.BadParameter("--workers は --queue-dir と併用してください。")
+    if queue_dir is not None and to_duckdb:
+        raise typer.BadParameter("--queue-dir は --to-duckdb と併用できません。")
+
+    loader_kwargs = dict(
         input_dir=input_dir,
         output_dir=output_dir,
         score_thresholds=[score_t1, score_t2],
         partitioned=partitioned,
         to_duckdb=to_duckdb,
         duckdb_path=duckdb_path,
+        compact_types=compact_types,
+        time_precision=time_precision,
+        merge=merge,
+        dedup_key=dedup_key,
+        queue_dir=queue_dir,
+        lease_ttl=lease_ttl,
+        sample_size=sample_size,
+    )
+    if queue_dir is not None and workers > 1:
+        if retry_failed:
+            # 各ワーカーが実行中の他のワーカーの失敗を消さないよう、起動前に1回だけ消す
+            LeaseQueue(queue_dir, lease_ttl=lease_ttl).clear_failed()
+        base_id = worker_id or default_worker_id()
+        processes = [
+            multiprocessing.get_context("spawn").Process(
+                target=run_local_worker, args=(loader_kwargs, f"{base_id}-{i}")
+            )
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [p.name for p in processes if p.exitcode != 0]
+        if failed:
+            typer.secho(
+                f"エラー: {len(failed)} 個のワーカープロセスが異常終了しました。",
+                fg=typer.colors.RED,
+            )
+            raise typer.Exit(1)
+        return
+
+    loader = DataLoader(
+        **loader_kwargs, worker_id=worker_id, retry_failed=retry_failed
     )
     loader.run()
 
@@ -0,0 +1,334 @@
+import json
+import os
+import uuid
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from urllib.parse import unquote
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from sampling import SAMPLE_KEY_COL
+
+# パーティションディレクトリ内の有効なファイル一覧
+MANIFEST_NAME = "_manifest.json"
+
+# 取り込み時に作成する層別サンプル（プレビュー用）
+SAMPLE_NAME = "_sample.parquet"
+
+# Hive形式で欠損値を表すパーティション値
+HIVE_NULL = "__HIVE_DEFAULT_PARTITION__"
+
+# 期間フィルタの対象となる日時列と、その月で分割したパーティション列
+TIME_COL = "EVENT_TIME"
+TIME_PARTITION_COL = "event_month"
+
+# パーティション列の型に対応するDuckDBの型
+DUCKDB_HIVE_TYPES = {pl.Datetime: "TIMESTAMP", pl.Int64: "BIGINT", pl.String: "VARCHAR"}
+
+
+def read_manifest(partition_dir: Path) -> list[str] | None:
+    """
+    パーティションのマニフェストを読み込み、有効なファイル名の一覧を返す。
+    マニフェストが存在しない場合はNoneを返す（ディレクトリ内の全ファイルが有効）。
+    """
+    manifest_path = partition_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)["files"]
+
+
+def write_manifest(partition_dir: Path, files: list[str]) -> None:
+    """
+    パーティションのマニフェストを原子的に書き換える。
+    一時ファイルに書き出した後に os.replace で置き換えるため、
+    読み手は常に更新前か更新後のどちらかのファイル一覧を参照する。
+    ファイル一覧は書き込み順のまま保存する。
+    """
+    manifest_path = partition_dir / MANIFEST_NAME
+    tmp_path = manifest_path.with_name(f"{MANIFEST_NAME}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+
+def list_partition_files(partition_dir: Path) -> list[Path]:
+    """
+    パーティションディレクトリ直下の有効なParquetファイルを返す。
+    """
+    listed = read_manifest(partition_dir)
+    if listed is not None:
+        return [partition_dir / name for name in listed]
+    return sorted(
+        p for p in partition_dir.glob("*.parquet") if not p.name.startswith(("_", "."))
+    )
+
+
+def list_data_files(data_dir: Path) -> list[Path]:
+    """
+    データディレクトリ配下の分析対象Parquetファイルを再帰的に列挙する。
+    "_" や "." で始まるファイル・ディレクトリ（作業用ディレクトリ等）は除外し、
+    マニフェストを持つパーティションではマニフェストに記載されたファイルのみを返す。
+    """
+    files = []
+    manifests: dict[Path, list[str] | None] = {}
+    for path in sorted(data_dir.glob("**/*.parquet")):
+        rel = path.relative_to(data_dir)
+        if any(part.startswith(("_", ".")) for part in rel.parts):
+            continue
+        if path.parent not in manifests:
+            manifests[path.parent] = read_manifest(path.parent)
+        listed = manifests[path.parent]
+        if listed is not None and path.name not in listed:
+            continue
+        files.append(path)
+    return files
+
+
+def load_sample(data_dir: Path) -> pl.DataFrame | None:
+    """
+    データディレクトリの層別サンプル（_sample.parquet）を読み込む。
+    サンプルが存在しない場合はNoneを返す。
+    """
+    sample_path = data_dir / SAMPLE_NAME
+    if not sample_path.exists():
+        return None
+    return pl.read_parquet(sample_path).drop(SAMPLE_KEY_COL, strict=False)
+
+
+def parse_hive_segments(rel_path: Path) -> dict[str, str | None]:
+    """
+    相対パスのディレクトリ部分から Hive 形式（列名=値）のパーティション値を取り出す。
+    """
+    values = {}
+    for part in rel_path.parent.parts:
+        if "=" not in part:
+            continue
+        key, value = part.split("=", 1)
+        values[key] = None if value == HIVE_NULL else unquote(value)
+    return values
+
+
+def infer_partition_dtype(values: pl.Series) -> pl.Series:
+    """
+    パーティション値（文字列）を、全ての値を解釈できる型（日時・整数・文字列）に変換する。
+    """
+    non_null = values.drop_nulls()
+    if non_null.is_empty():
+        return values
+    as_int = values.cast(pl.Int64, strict=False)
+    if as_int.null_count() == values.null_count():
+        return as_int
+    try:
+        as_datetime = values.str.to_datetime(strict=False)
+    except pl.exceptions.ComputeError:
+        # 日時の書式を推定できない（日時ではない）
+        return values
+    if as_datetime.null_count() == values.null_count():
+        return as_datetime
+    return values
+
+
+class HiveDataset:
+    """
+    Hive形式（event_month=.../score_level=...）でパーティション分割された可能性のある
+    Parquetファイル群。
+
+    ディレクトリ名からパーティション列を検出し、パーティション列に対する条件で
+    読み込むファイルを絞り込む（ディレクトリ単位のプルーニング）。
+    絞り込んだファイルは Polars（hive_partitioning）と DuckDB（hive_partitioning=1）の
+    どちらからでも読み込める。
+    """
+
+    def __init__(self, files: list[Path], root: Path):
+        self.files = list(files)
+        self.root = root
+        segments = [parse_hive_segments(f.relative_to(root)) for f in self.files]
+        self.partition_columns: list[str] = []
+        for values in segments:
+            for key in values:
+                if key not in self.partition_columns:
+                    self.partition_columns.append(key)
+        # 全てのファイルが同じパーティション列を持つ場合のみ、パスから列を読み込む
+        self.is_hive = bool(self.partition_columns) and all(
+            list(values) == self.partition_columns for values in segments
+        )
+        self.partitions = pl.DataFrame(
+            {
+                "path": [str(f) for f in self.files],
+                **{
+                    c: infer_partition_dtype(
+                        pl.Series(c, [v.get(c) for v in segments], dtype=pl.String)
+                    )
+                    for c in self.partition_columns
+                },
+            },
+            schema_overrides={"path": pl.String},
+        )
+
+    @classmethod
+    def from_dir(cls, data_dir: Path) -> "HiveDataset":
+        """
+        データディレクトリ配下の分析対象ファイルからデータセットを作る。
+        """
+        return cls(list_data_files(data_dir), data_dir)
+
+    def partition_values(self, column: str) -> list:
+        """
+        パーティション列の値の一覧を昇順で返す。
+        """
+        return self.partitions.get_column(column).unique().sort().to_list()
+
+    def prune(self, predicate: pl.Expr | None) -> "HiveDataset":
+        """
+        パーティション列に対する条件を満たすディレクトリのファイルだけを残したデータセットを返す。
+        パーティション値を持たないファイルは、条件を判定できないため残す。
+        """
+        if predicate is None or self.partitions.is_empty():
+            return self
+        kept = self.partitions.filter(predicate.fill_null(True)).get_column("path")
+        return HiveDataset([Path(p) for p in kept], self.root)
+
+    def column_stats(self, column: str) -> pl.DataFrame:
+        """
+        Parquetのフッター（行グループの統計情報）から、ファイルごとの列の最小値・最大値を返す。
+        データ本体は読み込まない。統計情報がないファイルの値はnullになる。
+        """
+        rows = []
+        for path in self.files:
+            metadata = pq.read_metadata(path)
+            lo = hi = None
+            if column in metadata.schema.names:
+                index = metadata.schema.names.index(column)
+                for i in range(metadata.num_row_groups):
+                    stats = metadata.row_group(i).column(index).statistics
+                    if stats is None or not stats.has_min_max:
+                        # 統計情報のない行グループがあると範囲を判定できない
+                        lo = hi = None
+                        break
+                    lo = stats.min if lo is None else min(lo, stats.min)
+                    hi = stats.max if hi is None else max(hi, stats.max)
+            rows.append({"path": str(path), "min": lo, "max": hi})
+        return pl.DataFrame(
+            rows, schema_overrides={"path": pl.String}, infer_schema_length=None
+        )
+
+    def time_bounds(self, column: str = TIME_COL) -> tuple[datetime, datetime] | None:
+        """
+        データセット全体の日時列の範囲をフッターの統計情報から返す。分からない場合はNone。
+        """
+        if not self.files:
+            return None
+        stats = self.column_stats(column)
+        if stats["min"].null_count() or stats["max"].null_count():
+            return None
+        return stats["min"].min(), stats["max"].max()
+
+    def prune_time_range(
+        self, start: datetime, end: datetime, column: str = TIME_COL
+    ) -> "HiveDataset":
+        """
+        [start, end) の期間と重ならないファイルを除いたデータセットを返す。
+        月パーティション（event_month）があればディレクトリ名で、
+        なければフッターの統計情報（ファイル内の最小値・最大値）で判定する。
+        """
+        dataset = self
+        dtype = self.partitions.schema.get(TIME_PARTITION_COL)
+        if dtype is not None and dtype.base_type() == pl.Datetime:
+            month_start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            dataset = dataset.prune(
+                (pl.col(TIME_PARTITION_COL) >= month_start)
+                & (pl.col(TIME_PARTITION_COL) < end)
+            )
+        if not dataset.files:
+            return dataset
+        stats = dataset.column_stats(column)
+        if stats.schema["min"].base_type() != pl.Datetime:
+            return dataset
+        overlapping = stats.filter(
+            ((pl.col("max") >= start) & (pl.col("min") < end)).fill_null(True)
+        )
+        kept = set(overlapping.get_column("path"))
+        return HiveDataset(
+            [f for f in dataset.files if str(f) in kept], dataset.root
+        )
+
+    def hive_schema(self) -> dict[str, pl.DataType]:
+        return {c: self.partitions.schema[c] for c in self.partition_columns}
+
+    def scan_polars(self) -> pl.LazyFrame:
+        """
+        ファイルを Polars で遅延読み込みする。
+        """
+        if not self.files:
+            return pl.LazyFrame()
+        if self.is_hive:
+            return pl.scan_parquet(
+                self.files, hive_partitioning=True, hive_schema=self.hive_schema()
+            )
+        return pl.concat([pl.scan_parquet(f) for f in self.files], how="diagonal_relaxed")
+
+    def duckdb_source(self, filename: bool = False) -> str:
+        """
+        ファイルを DuckDB で読み込む read_parquet(...) 式を返す。
+        filename=True の場合は、行の読み込み元のパスを filename 列として加える。
+        """
+        file_list = ", ".join(f"'{f}'" for f in self.files)
+        options = ", filename=true" if filename else ""
+        if not self.is_hive:
+            return f"read_parquet([{file_list}], union_by_name=true{options})"
+        hive_types = ", ".join(
+            f"'{c}': {DUCKDB_HIVE_TYPES.get(dtype.base_type(), 'VARCHAR')}"
+            for c, dtype in self.hive_schema().items()
+        )
+        return (
+            f"read_parquet([{file_list}], hive_partitioning=1, "
+            f"hive_types={{{hive_types}}}, union_by_name=true{options})"
+        )
+
+
+def partition_predicate(
+    dataset: HiveDataset, selections: dict[str, list]
+) -> pl.Expr | None:
+    """
+    パーティション列ごとに選択された値から、HiveDataset.prune に渡す条件を作る。
+    全ての値が選択されている列は条件に含めない。
+    """
+    predicates = [
+        pl.col(column).is_in(selected)
+        for column, selected in selections.items()
+        if set(selected) != set(dataset.partition_values(column))
+    ]
+    if not predicates:
+        return None
+    return pl.all_horizontal(predicates)
+
+
+def day_range(start: date, end: date) -> tuple[datetime, datetime]:
+    """
+    日付の範囲（両端を含む）を、日時の半開区間 [start, end) に変換する。
+    """
+    return datetime.combine(start, time()), datetime.combine(end, time()) + timedelta(
+        days=1
+    )
+
+
+def time_range_expr(start: datetime, end: datetime, column: str = TIME_COL) -> pl.Expr:
+    """
+    [start, end) の期間の行を残す Polars の条件。
+    スキャンに押し下げられ、範囲外の行グループは統計情報により読み飛ばされる。
+    """
+    return pl.col(column).is_between(start, end, closed="left")
+
+
+def time_range_sql(start: datetime, end: datetime, column: str = TIME_COL) -> str:
+    """
+    [start, end) の期間の行を残す SQL の条件（DuckDB用）。
+    """
+    return (
+        f"{column} >= TIMESTAMP '{start:%Y-%m-%d %H:%M:%S}' "
+        f"AND {column} < TIMESTAMP '{end:%Y-%m-%d %H:%M:%S}'"
+    )
@@ -0,0 +1,220 @@
+import os
+import threading
+from pathlib import Path
+
+from dataset import TIME_COL, HiveDataset
+
+# データディレクトリ内に作成する永続カタログのファイル名（"_" で始まるため分析対象から除外される）
+CATALOG_NAME = "_catalog.duckdb"
+
+# カタログのデータベースを ATTACH する別名と、そのテーブル
+CATALOG_ALIAS = "catalog"
+EVENTS_TABLE = "events"
+FILES_TABLE = "_catalog_files"
+
+# 各行の読み込み元のParquetファイル
+SOURCE_FILE_COL = "_source_file"
+
+# data_loader --to-duckdb で作成したデータベースを ATTACH する別名
+DATABASE_ALIAS = "loaded"
+
+# 同じカタログへの同期は1つずつ行う
+_sync_lock = threading.Lock()
+
+
+def attach(con, path: Path, alias: str, read_only: bool = False) -> None:
+    """
+    DuckDBのデータベースファイルを別名で ATTACH する。
+    同じファイルが ATTACH 済みなら何もせず、別のファイルが ATTACH されていれば付け替える。
+    """
+    attached = con.execute(
+        "SELECT path FROM duckdb_databases() WHERE database_name = ?", [alias]
+    ).fetchone()
+    if attached:
+        if Path(attached[0]).resolve() == path.resolve():
+            return
+        con.execute(f"DETACH {alias}")
+    mode = " (READ_ONLY)" if read_only else ""
+    con.execute(f"ATTACH '{path}' AS {alias}{mode}")
+
+
+def list_tables(con, alias: str) -> list[str]:
+    """
+    ATTACH したデータベースのテーブル名の一覧を返す。
+    """
+    rows = con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE database_name = ? ORDER BY 1",
+        [alias],
+    ).fetchall()
+    return [name for (name,) in rows if not name.startswith("_")]
+
+
+def tables_source(alias: str, tables: list[str]) -> str:
+    """
+    ATTACH したデータベースの複数のテーブルを、列名で揃えて縦に結合するクエリを返す。
+    """
+    return " UNION ALL BY NAME ".join(
+        f'SELECT * FROM {alias}."{table}"' for table in tables
+    )
+
+
+class ParquetCatalog:
+    """
+    Parquetファイルの内容を、永続化した DuckDB のネイティブテーブルとして保持するカタログ。
+
+    ファイルごとにパス・サイズ・更新時刻を記録し、sync で追加・更新されたファイルだけを
+    読み込み、削除・更新されたファイルの行を取り除く（増分更新）。
+    クエリはParquetのフッターやスキーマを読み直さずにテーブルをスキャンし、
+    行は EVENT_TIME 順に挿入するため、行グループごとの最小値・最大値（ゾーンマップ）で
+    期間外の行を読み飛ばせる。
+    """
+
+    def __init__(self, con, alias: str = CATALOG_ALIAS):
+        self.con = con
+        self.alias = alias
+        self.con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.alias}.{FILES_TABLE} (
+                path VARCHAR PRIMARY KEY, size BIGINT, mtime_ns BIGINT
+            )
+            """
+        )
+
+    def table_exists(self) -> bool:
+        return EVENTS_TABLE in list_tables(self.con, self.alias)
+
+    def files(self) -> dict[str, tuple[int, int]]:
+        """
+        カタログに読み込まれているファイルと、読み込んだ時点のサイズ・更新時刻を返す。
+        """
+        rows = self.con.execute(
+            f"SELECT path, size, mtime_ns FROM {self.alias}.{FILES_TABLE}"
+        ).fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def sync(self, dataset: HiveDataset) -> dict[str, int]:
+        """
+        データセットのファイルをカタログに反映し、追加・削除したファイル数を返す。
+        内容が変わったファイル（サイズか更新時刻が異なる）は読み込み直す。
+        ディスク上から消えたファイルの行は取り除くが、選択されていないだけのファイルは残す。
+        """
+        with _sync_lock:
+            known = self.files()
+            current = {}
+            for path in dataset.files:
+                stat = os.stat(path)
+                current[str(path)] = (stat.st_size, stat.st_mtime_ns)
+
+            stale = [
+                path
+                for path, stat in known.items()
+                if (path in current and current[path] != stat)
+                or (path not in current and not os.path.exists(path))
+            ]
+            added = [
+                path for path, stat in current.items() if known.get(path) != stat
+            ]
+            if not stale and not added:
+                return {"added": 0, "removed": 0}
+
+            source = None
+            if added:
+                source = self._source(
+                    HiveDataset([Path(p) for p in added], dataset.root)
+                )
+                # 列の追加は行の変更と同じトランザクションでは行えないため、先に行う
+                self._add_missing_columns(source)
+
+            self.con.execute("BEGIN TRANSACTION")
+            try:
+                if stale:
+                    self._delete_files(stale)
+                if added:
+                    self._insert(source)
+                    self.con.executemany(
+                        f"INSERT INTO {self.alias}.{FILES_TABLE} VALUES (?, ?, ?)",
+                        [[path, *current[path]] for path in added],
+                    )
+                self.con.execute("COMMIT")
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+            return {"added": len(added), "removed": len(stale)}
+
+    def _delete_files(self, paths: list[str]) -> None:
+        placeholders = ", ".join("?" for _ in paths)
+        if self.table_exists():
+            self.con.execute(
+                f"DELETE FROM {self.alias}.{EVENTS_TABLE} "
+                f"WHERE {SOURCE_FILE_COL} IN ({placeholders})",
+                paths,
+            )
+        self.con.execute(
+            f"DELETE FROM {self.alias}.{FILES_TABLE} WHERE path IN ({placeholders})",
+            paths,
+        )
+
+    def _source(self, dataset: HiveDataset) -> str:
+        """
+        ファイルの行を、読み込み元のパスの列を加えて EVENT_TIME 順に読むクエリ。
+        """
+        source = (
+            f"SELECT * EXCLUDE (filename), filename AS {SOURCE_FILE_COL} "
+            f"FROM {dataset.duckdb_source(filename=True)}"
+        )
+        columns = self.con.execute(
+            f"SELECT list(column_name) FROM (DESCRIBE {source})"
+        ).fetchone()[0]
+        if TIME_COL in columns:
+            source += f" ORDER BY {TIME_COL}"
+        return source
+
+    def _add_missing_columns(self, source: str) -> None:
+        """
+        新しいファイルにしかない列をテーブルに追加する（既存の行は NULL になる）。
+        """
+        if not self.table_exists():
+            return
+        table = f"{self.alias}.{EVENTS_TABLE}"
+        existing = self.con.execute(
+            f"SELECT list(column_name) FROM (DESCRIBE {table})"
+        ).fetchone()[0]
+        for name, column_type, *_ in self.con.execute(
+            f"DESCRIBE {source}"
+        ).fetchall():
+            if name not in existing:
+                self.con.execute(
+                    f'ALTER TABLE {table} ADD COLUMN "{name}" {column_type}'
+                )
+
+    def _insert(self, source: str) -> None:
+        table = f"{self.alias}.{EVENTS_TABLE}"
+        if self.table_exists():
+            self.con.execute(f"INSERT INTO {table} BY NAME {source}")
+        else:
+            self.con.execute(f"CREATE TABLE {table} AS {source}")
+
+    def source_query(self, files: list[Path]) -> str:
+        """
+        選択されたファイルの行をカタログのテーブルから読むクエリを返す。
+        カタログ内の全てのファイルが選択されている場合は絞り込まない。
+        """
+        table = f"{self.alias}.{EVENTS_TABLE}"
+        selected = [str(f) for f in files]
+        if set(selected) == set(self.files()):
+            return f"SELECT * EXCLUDE ({SOURCE_FILE_COL}) FROM {table}"
+        file_list = ", ".join(f"'{p}'" for p in selected)
+        return (
+            f"SELECT * EXCLUDE ({SOURCE_FILE_COL}) FROM {table} "
+            f"WHERE {SOURCE_FILE_COL} IN ({file_list})"
+        )
+
+
+def open_catalog(con, path: Path) -> ParquetCatalog:
+    """
+    永続カタログのデータベースを ATTACH してカタログを返す。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    attach(con, path, CATALOG_ALIAS)
+    return ParquetCatalog(con)
+
@@ -0,0 +1,164 @@
+import os
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Generic, Iterator, TypeVar
+
+import duckdb
+
+from query_budget import QueryTimeout, timeout_from_env, wait_until_done
+from query_builder import PreparedConnection
+
+T = TypeVar("T")
+
+
+def settings_from_env() -> dict:
+    """
+    環境変数からDuckDBの設定を読み込む。
+    DUCKDB_THREADS: クエリ1件あたりのスレッド数、DUCKDB_MEMORY_LIMIT: メモリの上限（例: "8GB"）、
+    DUCKDB_QUERY_WORKERS: 同時に実行するクエリの数、
+    QUERY_TIMEOUT: クエリ1件あたりの時間の予算（秒、0 で無制限）。
+    """
+    threads = os.environ.get("DUCKDB_THREADS")
+    workers = os.environ.get("DUCKDB_QUERY_WORKERS")
+    return {
+        "threads": int(threads) if threads else None,
+        "memory_limit": os.environ.get("DUCKDB_MEMORY_LIMIT") or None,
+        "max_workers": int(workers) if workers else 4,
+        "query_timeout": timeout_from_env(),
+    }
+
+
+@contextmanager
+def interrupt_after(con, timeout: float | None) -> Iterator[None]:
+    """
+    ブロック内で con（カーソル）が実行するクエリを、timeout 秒を超えたら中断して
+    QueryTimeout を送出する。セッションのビューを参照するなど、スレッドプールに渡せない
+    クエリの時間の予算に使う。
+    """
+    if timeout is None:
+        yield
+        return
+    timer = threading.Timer(timeout, con.interrupt)
+    timer.start()
+    try:
+        yield
+    except duckdb.InterruptException as e:
+        raise QueryTimeout(f"クエリが{timeout:g}秒以内に終わりませんでした") from e
+    finally:
+        timer.cancel()
+
+
+class QueryTask(Generic[T]):
+    """
+    submit でスレッドプールに渡したクエリ。
+
+    result で結果を待つ。時間の予算（timeout）を超えた場合や、待っている間に例外
+    （Streamlitの再実行による打ち切りを含む）が発生した場合は cancel する。
+    cancel は実行前のタスクを取り消し、実行中のタスクはカーソルのクエリを中断する。
+    """
+
+    def __init__(self, task: Callable[[PreparedConnection], T], timeout: float | None):
+        self.task = task
+        self.timeout = timeout
+        self.future: Future | None = None
+        self.lock = threading.Lock()
+        self.cursor: PreparedConnection | None = None
+        self.cancelled = False
+
+    def run(self, cursor: PreparedConnection) -> T:
+        with self.lock:
+            if self.cancelled:
+                raise CancelledError()
+            self.cursor = cursor
+        try:
+            return self.task(cursor)
+        finally:
+            with self.lock:
+                self.cursor = None
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.cursor is not None:
+                self.cursor.interrupt()
+        self.future.cancel()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, on_wait: Callable[[float], None] | None = None) -> T:
+        """
+        結果を待って返す。待っている間は on_wait に経過秒数を渡す（wait_until_done を参照）。
+        """
+        wait_until_done(self.future.done, self.cancel, self.timeout, on_wait)
+        return self.future.result()
+
+
+class ConnectionManager:
+    """
+    全セッションで共有するDuckDBのデータベースと、セッションごとのカーソルを管理する。
+
+    データベース（ATTACH したカタログや絞り込み結果のテーブル）は共有し、
+    セッションごとに session_cursor でカーソル（別のコネクション）を払い出す。
+    ビューは TEMP VIEW としてカーソルごとに作成するため、同じ名前でもセッション間で衝突しない。
+    1つのコネクションでは同時に1つのクエリしか実行できないため、ページ内の独立したクエリは
+    submit でスレッドプールに渡し、スレッドごとのカーソルで並列に実行する。
+    """
+
+    def __init__(
+        self,
+        database: str = ":memory:",
+        threads: int | None = None,
+        memory_limit: str | None = None,
+        max_workers: int = 4,
+        query_timeout: float | None = None,
+    ):
+        self.query_timeout = query_timeout
+        self.con = duckdb.connect(database=database, read_only=False)
+        if threads:
+            self.con.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = '{memory_limit}'")
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="duckdb-query"
+        )
+        self.local = threading.local()
+
+    def session_cursor(self) -> PreparedConnection:
+        """
+        セッション用のカーソルを作成する。呼び出し側がセッションごとに保持する。
+        パラメータ付きの問い合わせは、カーソルごとに PREPARE して再利用する。
+        """
+        return PreparedConnection(self.con.cursor())
+
+    def _worker_cursor(self) -> PreparedConnection:
+        cursor = getattr(self.local, "cursor", None)
+        if cursor is None:
+            cursor = self.local.cursor = PreparedConnection(self.con.cursor())
+        return cursor
+
+    def submit(
+        self,
+        task: Callable[[PreparedConnection], T],
+        timeout: float | None = None,
+    ) -> QueryTask[T]:
+        """
+        task をスレッドプールで実行する。task はスレッドのカーソルを受け取る。
+        カーソルからはセッションの TEMP VIEW は見えないため、共有のテーブルだけを参照すること。
+        timeout（省略時は query_timeout）秒を超えたタスクは、結果を待つ側で中断する。
+        """
+        query_task = QueryTask(task, timeout or self.query_timeout)
+        query_task.future = self.pool.submit(
+            lambda: query_task.run(self._worker_cursor())
+        )
+        return query_task
+
+    def run_parallel(
+        self, tasks: dict[str, Callable[[PreparedConnection], T]]
+    ) -> dict[str, T]:
+        """
+        複数の task を並列に実行し、名前から結果への辞書を返す。
+        """
+        futures = {name: self.submit(task) for name, task in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
@@ -1,36 +1,93 @@
+import os
+import tempfile
 from pathlib import Path
 
-import duckdb
-import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import polars as pl
 import streamlit as st
 
+from dataset import SAMPLE_NAME, HiveDataset, list_data_files, partition_predicate
+from duckdb_catalog import (
+    CATALOG_NAME,
+    DATABASE_ALIAS,
+    attach,
+    list_tables,
+    open_catalog,
+    tables_source,
+)
+from duckdb_session import (
+    ConnectionManager,
+    QueryTask,
+    interrupt_after,
+    settings_from_env,
+)
+from materialized import MaterializedTables
+from query_budget import QueryTimeout
+from query_builder import QueryBuilder
+from query_profiler import format_profile
+from query_timing import QueryTimings
+from result_cache import ResultCache, dataset_fingerprint, result_key
+from sampling import SAMPLE_KEY_COL
+from score_histogram import ScoreHistogram, score_counts_query
+from segment_metrics import segment_metrics, segment_score_counts_query
+from threshold_sweep import (
+    OBJECTIVE_COST,
+    OBJECTIVE_F1,
+    average_precision,
+    best_threshold,
+    roc_auc,
+    threshold_sweep,
+    with_metrics,
+)
+from value_index import ValueIndexes
+
+# --- データの読み込み方式 ---
+LOAD_PARQUET = "Parquetを直接読み込む"
+LOAD_CATALOG = "永続カタログ（DuckDBテーブル）"
+LOAD_DATABASE = "DuckDBデータベース（--to-duckdb）"
+
+# フィルタの値の選択肢の最大件数
+MAX_VALUE_OPTIONS = 100
+
 
 # --- DuckDBコネクションのセットアップ ---
 @st.cache_resource
+def get_connection_manager() -> ConnectionManager:
+    """
+    全セッションで共有するインメモリのDuckDBとクエリ用のスレッドプールを生成・キャッシュする。
+    スレッド数・メモリ上限・同時実行数・クエリの時間の予算は環境変数
+    DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, DUCKDB_QUERY_WORKERS, QUERY_TIMEOUT で設定する。
+    """
+    return ConnectionManager(**settings_from_env())
+
+
 def get_db_connection():
-    """インメモリのDuckDBコネクションを生成・キャッシュする。"""
-    return duckdb.connect(database=":memory:", read_only=False)
+    """
+    このセッションのDuckDBカーソルを返す。
+    ビューはカーソルごとの TEMP VIEW として作成し、他のセッションのビューと衝突しない。
+    """
+    if "duckdb_cursor" not in st.session_state:
+        st.session_state["duckdb_cursor"] = get_connection_manager().session_cursor()
+    return st.session_state["duckdb_cursor"]
 
 
-def load_data_into_duckdb(con, selected_files: list[Path]) -> bool:
+def load_data_into_duckdb(con, selected_files: list[Path], data_dir: Path) -> bool:
     """
     指定されたParquetファイルをDuckDBのビューとして読み込む。
+    Hive形式で分割されている場合は、パーティション列をディレクトリ名から読み込む。
     成功すればTrue、失敗すればFalseを返す。
     """
     if not selected_files:
         st.warning("データソースを1つ以上選択してください。")
         return False
 
-    # ファイルパスのリストをSQLで使える形式 (['path1', 'path2', ...]) に変換
-    file_list_str = ", ".join([f"'{str(p)}'" for p in selected_files])
+    dataset = HiveDataset(selected_files, data_dir)
 
     try:
         # Parquetファイルからビューを作成
         con.execute(
-            f"CREATE OR REPLACE VIEW source_data AS SELECT * FROM read_parquet([{file_list_str}])"
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM {dataset.duckdb_source()}"
         )
         return True
     except Exception as e:
@@ -38,9 +95,179 @@ def load_data_into_duckdb(con, selected_files: list[Path]) -> bool:
         return False
 
 
+def load_catalog_into_duckdb(
+    con, selected_files: list[Path], data_dir: Path
+) -> bool:
+    """
+    選択されたParquetファイルを永続カタログ（データディレクトリの _catalog.duckdb）の
+    テーブルに同期し、テーブルをDuckDBのビューとして読み込む。
+    追加・更新されたファイルだけを読み込むため、2回目以降はParquetを読み直さない。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    dataset = HiveDataset(selected_files, data_dir)
+    try:
+        catalog = open_catalog(con, data_dir / CATALOG_NAME)
+        changes = catalog.sync(dataset)
+        if changes["added"] or changes["removed"]:
+            st.sidebar.caption(
+                f"カタログを更新しました（追加 {changes['added']} / "
+                f"削除 {changes['removed']} ファイル）"
+            )
+        source = catalog.source_query(dataset.files)
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM ({source})"
+        )
+        return True
+    except Exception as e:
+        st.error(f"カタログの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+def load_database_into_duckdb(con, tables: list[str]) -> bool:
+    """
+    data_loader --to-duckdb で作成したデータベースのテーブルをDuckDBのビューとして読み込む。
+    複数のテーブルは列名で揃えて縦に結合する。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    try:
+        source = tables_source(DATABASE_ALIAS, tables)
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM ({source})"
+        )
+        return True
+    except Exception as e:
+        st.error(f"データベースの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+def load_sample_into_duckdb(con, sample_path: Path) -> bool:
+    """
+    取り込み時に作成した層別サンプルをDuckDBのビューとして読み込む。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    try:
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * EXCLUDE ({SAMPLE_KEY_COL}) FROM read_parquet('{sample_path}')"
+        )
+        return True
+    except Exception as e:
+        st.error(f"サンプルの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    """
+    全セッションで共有する集計結果のキャッシュを生成する。
+    環境変数 RESULT_CACHE_DIR を設定すると、結果をParquetとしてディスクにも保存する。
+    """
+    persist_dir = os.environ.get("RESULT_CACHE_DIR")
+    return ResultCache(persist_dir=Path(persist_dir) if persist_dir else None)
+
+
+@st.cache_resource
+def get_materialized_tables() -> MaterializedTables:
+    """
+    全セッションで共有する、フィルタ条件ごとの絞り込み結果のテーブルを管理する。
+    """
+    return MaterializedTables(get_connection_manager().con)
+
+
+@st.cache_resource
+def get_value_indexes() -> ValueIndexes:
+    """
+    全セッションで共有する、フィルタの値の検索に使う列ごとの値のインデックスを管理する。
+    インデックスは環境変数 VALUE_INDEX_DIR のディレクトリ（省略時は一時ディレクトリ）に置く。
+    """
+    index_dir = os.environ.get("VALUE_INDEX_DIR")
+    return ValueIndexes(
+        Path(index_dir) if index_dir else Path(tempfile.gettempdir()) / "value_index"
+    )
+
+
+def submit_cached(
+    query: str,
+    fingerprint: str,
+    *context: str,
+    label: str,
+    params: list | None = None,
+) -> QueryTask[pl.DataFrame]:
+    """
+    fetch_cached と同じキャッシュを使い、クエリをスレッドプールで並列に実行する。
+    スレッドのカーソルからはセッションの TEMP VIEW が見えないため、
+    クエリは絞り込み結果のテーブルなど、共有のテーブルだけを参照すること。
+    結果は wait_result で待つ。
+    """
+    key = result_key(fingerprint, *context, query, params)
+    cache = get_result_cache()
+    page_timings = timings
+    task = get_connection_manager().submit(
+        lambda cursor: page_timings.fetch_cached(
+            cache, key, cursor, query, label, params
+        )
+    )
+    page_tasks.append(task)
+    return task
+
+
+def fetch_cached(
+    con,
+    query: str,
+    fingerprint: str,
+    *context: str,
+    label: str,
+    params: list | None = None,
+) -> pl.DataFrame:
+    """
+    クエリの結果を、全セッションで共有するキャッシュ経由でPolarsのデータフレームとして取得する。
+    キーはデータセットの指紋・クエリ・パラメータと、クエリが参照するビューの定義（context）から作る。
+    時間の内訳は label の名前で timings に記録し、時間の予算を超えたクエリは中断する。
+    """
+    key = result_key(fingerprint, *context, query, params)
+    with interrupt_after(con, get_connection_manager().query_timeout):
+        return timings.fetch_cached(get_result_cache(), key, con, query, label, params)
+
+
+def wait_result(task: QueryTask[pl.DataFrame]) -> pl.DataFrame | None:
+    """
+    submit_cached で実行中のクエリの結果を待つ。待っている間は経過時間を表示する。
+    表示の更新で再実行の要求が確認されるため、新しい再実行に置き換えられた描画の
+    クエリはここで中断される。時間の予算を超えた場合は警告を表示して None を返し、
+    ページの他の集計は表示を続ける。
+    """
+    status = st.empty()
+    shown = [0]
+
+    def on_wait(elapsed: float) -> None:
+        # 表示は1秒ごとに更新する
+        if int(elapsed) > shown[0]:
+            shown[0] = int(elapsed)
+            status.caption(f"集計中…（{shown[0]}秒経過）")
+
+    try:
+        return task.result(on_wait)
+    except QueryTimeout as e:
+        st.warning(f"{e}。この集計の表示を省略します。")
+        return None
+    finally:
+        status.empty()
+
+
 # --- メインアプリケーション ---
 st.set_page_config(layout="wide")
 
+# この描画で発行したクエリの時間の内訳。プロファイルを記録するかのチェックボックスは
+# サイドバーの末尾に表示するため、値はセッション状態から読む
+timings = QueryTimings(profile=st.session_state.get("profile_queries", False))
+
+# 前回の描画で実行中のまま残ったクエリ（新しい再実行に置き換えられた描画のもの）を中断し、
+# 放棄された描画のクエリがCPUを使い続けないようにする
+for abandoned in st.session_state.get("page_tasks", []):
+    abandoned.cancel()
+# この描画で submit_cached したクエリ
+page_tasks: list[QueryTask] = []
+st.session_state["page_tasks"] = page_tasks
+
 # --- カスタムCSSでサイドバーの幅を調整 ---
 st.markdown(
     """
@@ -59,37 +286,103 @@ st.title("取引分析・可視化ダッシュボード")
 st.sidebar.header("分析設定")
 
 # 1. データソース選択
-input_dir = st.sidebar.text_input("データディレクトリ", "prepared_data")
-data_dir = Path(input_dir)
+load_mode = st.sidebar.radio(
+    "読み込み方式",
+    options=[LOAD_PARQUET, LOAD_CATALOG, LOAD_DATABASE],
+    help="永続カタログは選択したParquetをDuckDBのテーブルとして保存し、"
+    "変更されたファイルだけを読み込み直します。DuckDBデータベースは data_loader --to-duckdb の出力を直接開きます（開いている間は書き込めません）。",
+)
+
+db_tables = []
+if load_mode == LOAD_DATABASE:
+    db_path = Path(st.sidebar.text_input("DuckDBファイル", "output/data.duckdb"))
+    data_dir = db_path.parent
+    selected_files_paths = []
+    if db_path.is_file():
+        try:
+            attach(get_db_connection(), db_path, DATABASE_ALIAS, read_only=True)
+            table_options = list_tables(get_db_connection(), DATABASE_ALIAS)
+        except Exception as e:
+            st.sidebar.error(f"データベースを開けませんでした: {e}")
+            table_options = []
+        db_tables = st.sidebar.multiselect(
+            "テーブルを選択", options=table_options, default=table_options
+        )
+    else:
+        st.sidebar.warning(f"`{db_path}` が見つかりません。")
+else:
+    input_dir = st.sidebar.text_input("データディレクトリ", "prepared_data")
+    data_dir = Path(input_dir)
 
-if data_dir.exists() and data_dir.is_dir():
-    available_files = sorted(list(data_dir.glob("**/*.parquet")))
-    available_filenames = [str(f.relative_to(data_dir)) for f in available_files]
+    if data_dir.exists() and data_dir.is_dir():
+        available_files = list_data_files(data_dir)
+        available_filenames = [str(f.relative_to(data_dir)) for f in available_files]
 
-    selected_filenames = st.sidebar.multiselect(
-        "データソースを選択",
-        options=available_filenames,
-        default=available_filenames,
+        selected_filenames = st.sidebar.multiselect(
+            "データソースを選択",
+            options=available_filenames,
+            default=available_filenames,
+        )
+        selected_files_paths = [data_dir / name for name in selected_filenames]
+    else:
+        st.sidebar.warning(f"`{input_dir}` ディレクトリが見つかりません。")
+        selected_files_paths = []
+
+# パーティションフィルタ: Hive形式で分割されたデータは、ディレクトリ単位で読み込むファイルを絞り込む
+dataset = HiveDataset(selected_files_paths, data_dir)
+if dataset.partition_columns:
+    st.sidebar.subheader("パーティションフィルタ")
+    partition_selections = {}
+    for column in dataset.partition_columns:
+        values = dataset.partition_values(column)
+        partition_selections[column] = st.sidebar.multiselect(
+            f"{column}（パーティション）", options=values, default=values, format_func=str
+        )
+    dataset = dataset.prune(partition_predicate(dataset, partition_selections))
+    st.sidebar.caption(
+        f"読み込むファイル: {len(dataset.files)} / {len(selected_files_paths)}"
     )
-    selected_files_paths = [data_dir / name for name in selected_filenames]
-else:
-    st.sidebar.warning(f"`{input_dir}` ディレクトリが見つかりません。")
-    selected_files_paths = []
+    selected_files_paths = dataset.files
+
+# プレビューモード: 取り込み時に作成した層別サンプルのみを使い、即座に表示する
+preview_mode = (
+    load_mode != LOAD_DATABASE and (data_dir / SAMPLE_NAME).exists()
+) and st.sidebar.checkbox(
+    "プレビューモード（層別サンプルのみ使用）",
+    help="is_fraud × event_month ごとに抽出したサンプルで集計します。件数は全体の件数ではありません。",
+)
 
 # DuckDBコネクションを取得し、データを読み込む
 con = get_db_connection()
 data_loaded = False
-if selected_files_paths:
-    data_loaded = load_data_into_duckdb(con, selected_files_paths)
+if preview_mode:
+    data_loaded = load_sample_into_duckdb(con, data_dir / SAMPLE_NAME)
+elif load_mode == LOAD_DATABASE and db_tables:
+    data_loaded = load_database_into_duckdb(con, db_tables)
+elif load_mode != LOAD_DATABASE and selected_files_paths:
+    if load_mode == LOAD_CATALOG:
+        loader = load_catalog_into_duckdb
+    else:
+        loader = load_data_into_duckdb
+    data_loaded = loader(con, selected_files_paths, data_dir)
 else:
     # データが選択されていない場合はビューをクリア
     con.execute("DROP VIEW IF EXISTS source_data")
 
+# 集計結果のキャッシュのキーに使うデータセットの指紋
+if preview_mode:
+    source_files = [data_dir / SAMPLE_NAME]
+elif load_mode == LOAD_DATABASE:
+    source_files = [db_path, db_path.with_name(f"{db_path.name}.wal")]
+else:
+    source_files = selected_files_paths
+data_fingerprint = result_key(dataset_fingerprint(source_files), db_tables)
+
 
 if data_loaded:
     # 2. 分析軸となる列の選択
-    schema_df = con.execute("DESCRIBE source_data").fetchdf()
-    all_cols = schema_df["column_name"].tolist()
+    schema_df = con.execute("DESCRIBE source_data").pl()
+    all_cols = schema_df["column_name"].to_list()
 
     # 除外したい基本的な列
     cols_to_exclude = {"EVENT_TIME", "SCORE", "is_fraud", "is_correct_label"}
@@ -109,30 +402,43 @@ if data_loaded:
     # 3. 選択された分析軸の値でフィルタ
     st.sidebar.header("フィルタ設定")
 
-    # 各選択列のユニーク値を取得し、ユーザーに選択させる
+    # 各選択列の値を、値のインデックスから検索してユーザーに選択させる
     filters = {}
     for col in selected_dims:
         try:
-            # DuckDBは列名にスペースや特殊文字が含まれる場合に備えてダブルクォートで囲むのが安全
-            distinct_values_df = con.execute(
-                f'SELECT DISTINCT "{col}" FROM source_data ORDER BY 1'
-            ).fetchdf()
-            distinct_values = distinct_values_df[col].tolist()
+            # 値の一覧はPythonに取り込まず、初回の利用時に作成したインデックス（Parquet）から
+            # 前方一致で検索する。検索は値の種類数によらず短い時間で終わる
+            with interrupt_after(con, get_connection_manager().query_timeout):
+                index = get_value_indexes().get(
+                    con, "source_data", col, data_fingerprint
+                )
+            search_text = st.sidebar.text_input(
+                f"「{col}」の値を検索（前方一致）",
+                key=f"value_search_{col}",
+                help="未入力の場合は出現頻度の上位の値を表示します。",
+            )
+            if search_text:
+                matches = index.search(search_text, limit=MAX_VALUE_OPTIONS)
+                st.sidebar.caption(
+                    f"{index.size():,}種類の値のうち、前方一致した値（最大{MAX_VALUE_OPTIONS}件）"
+                )
+            else:
+                matches = index.top(MAX_VALUE_OPTIONS)
+                st.sidebar.caption(
+                    f"{index.size():,}種類の値のうち、出現頻度の上位{matches.height}件"
+                )
+            value_counts = dict(zip(matches["value"], matches["count"]))
 
             # 手入力用の選択肢
             MANUAL_INPUT_OPTION = "（値を直接入力する）"
-            options = [MANUAL_INPUT_OPTION] + distinct_values
-
-            # 値が多すぎる場合は警告
-            if len(distinct_values) > 500:
-                st.sidebar.warning(
-                    f"`{col}`のユニーク値が多すぎます(>500)。最初の500件のみ表示します。"
-                )
-                options = [MANUAL_INPUT_OPTION] + distinct_values[:500]
+            options = [MANUAL_INPUT_OPTION] + matches["value"].to_list()
 
             selected_value = st.sidebar.selectbox(
                 f"「{col}」の値を選択",
                 options=options,
+                format_func=lambda v: (
+                    f"{v}（{value_counts[v]:,}件）" if v in value_counts else str(v)
+                ),
             )
 
             # 手入力が選択された場合の処理
@@ -162,26 +468,50 @@ if data_loaded:
 
     # --- フィルタリング済みデータのビューを作成 ---
     where_clauses = []
+    # フィルタの値はSQLに埋め込まず、パラメータとして渡す
+    filter_query = QueryBuilder()
+    column_types = dict(zip(schema_df["column_name"], schema_df["column_type"]))
 
     # 1. 列の値に基づくフィルタ
     for col, values in filters.items():
         if values:  # 選択された値がある場合のみ
-            # 値をSQLクエリ用にフォーマット (SQLインジェクション対策でシングルクォートをエスケープ)
-            safe_values = [str(v).replace("'", "''") for v in values]
-            formatted_values = ", ".join([f"'{v}'" for v in safe_values])
-            where_clauses.append(f'"{col}" IN ({formatted_values})')
+            # 手入力された文字列も比較できるよう、値は列の型に変換して比較する
+            where_clauses.append(
+                filter_query.in_list(col, values, column_types[col])
+            )
 
     # WHERE句を組み立て
     # スコアでのフィルタリングはビュー作成時には行わず、後段の分析で利用する
     where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
 
+    # 分析に使う列だけを絞り込み、フィルタ条件ごとにテーブルとして保持する。
+    # filtered_data はそのテーブルを指すビューで、条件が変わるまで同じテーブルを再利用する
+    analysis_cols = ["SCORE", "is_fraud"]
+    if "is_correct_label" in all_cols:
+        analysis_cols.append("is_correct_label")
     filtered_view_query = f"""
-        CREATE OR REPLACE VIEW filtered_data AS
-        SELECT *
+        SELECT {", ".join(analysis_cols)}
         FROM source_data
         WHERE {where_sql}
     """
-    con.execute(filtered_view_query)
+    # 絞り込み条件の署名。絞り込み結果から求める集計のキャッシュのキーにも使う
+    filter_signature = result_key(
+        data_fingerprint, filtered_view_query, filter_query.params
+    )
+    try:
+        # セッションのビューを参照するため、セッションのカーソルで作成する
+        with interrupt_after(con, get_connection_manager().query_timeout):
+            filtered_table = get_materialized_tables().get(
+                filter_signature, filtered_view_query, con, filter_query.params
+            )
+    except QueryTimeout as e:
+        st.error(f"絞り込み結果の作成を中断しました: {e}。条件を絞り込んでください。")
+        st.stop()
+    con.execute(
+        f"CREATE OR REPLACE TEMP VIEW filtered_data AS SELECT * FROM {filtered_table}"
+    )
+
+    filtered_count = con.execute("SELECT COUNT(*) FROM filtered_data").fetchone()[0]
 
     # --- デバッグ情報 ---
     st.sidebar.subheader("Debug Info")
@@ -190,8 +520,8 @@ if data_loaded:
         st.sidebar.write(f"Source records: {source_count:,}")
 
         st.sidebar.code(filtered_view_query, language="sql")
+        st.sidebar.write(f"Parameters: {filter_query.params}")
 
-        filtered_count = con.execute("SELECT COUNT(*) FROM filtered_data").fetchone()[0]
         st.sidebar.write(f"Filtered records: {filtered_count:,}")
     except Exception as e:
         st.sidebar.error(f"Debug Error: {e}")
@@ -201,13 +531,12 @@ if data_loaded:
         st.header("分析結果")
 
         # フィルタされたデータがない場合の表示
-        filtered_count = con.execute("SELECT COUNT(*) FROM filtered_data").fetchone()[0]
         if filtered_count == 0:
             st.warning("選択された条件に一致するデータがありません。")
             st.stop()
 
-        # --- 1. 件数サマリー ---
-        st.subheader("件数サマリー")
+        # ページの集計は互いに独立しているため、スレッドプールで並列に実行する。
+        # スレッドのカーソルからはセッションのビューが見えないため、絞り込み結果のテーブルを参照する
 
         # is_correct_label列の存在をチェック
         has_correct_label_col = "is_correct_label" in all_cols
@@ -224,152 +553,323 @@ if data_loaded:
             COUNT(*) AS total_count,
             SUM(CASE WHEN is_fraud = TRUE THEN 1 ELSE 0 END) AS fraud_count
             {misclassified_query_part}
-        FROM filtered_data
+        FROM {filtered_table}
         """
-        summary_df = con.execute(summary_query).fetchdf()
-
-        total_count = summary_df["total_count"][0]
-        fraud_count = summary_df["fraud_count"][0]
-
-        # 表示する列を動的に決定
-        if has_correct_label_col:
-            misclassified_count = summary_df["misclassified_count"][0]
-            col1, col2, col3 = st.columns(3)
-            col1.metric("総件数", f"{total_count:,}")
-            col2.metric("不正検知件数", f"{fraud_count:,}")
-            col3.metric("誤検知件数", f"{misclassified_count:,}")
-        else:
-            col1, col2 = st.columns(2)
-            col1.metric("総件数", f"{total_count:,}")
-            col2.metric("不正検知件数", f"{fraud_count:,}")
+        summary_task = submit_cached(
+            summary_query,
+            data_fingerprint,
+            filter_signature,
+            label="件数サマリー",
+        )
 
-        # --- 2. 混合行列 ---
-        st.subheader("混合行列")
+        # 混合行列とスコアのヒストグラムは、スコアの値ごとの正例・負例の件数から求める。
+        # 件数はスコアの値の種類数（数千行程度）しかなく、閾値・調整値によらないため、
+        # スライダーを動かしても集計し直さずに、累積件数から即座に求まる
         # is_fraud: 実際のラベル
         # 予測ラベル: (SCORE + 調整値) が中リスク上限以上ならPositive(不正疑い)
         # TP: is_fraud=True, 予測=Positive
         # FP: is_fraud=False, 予測=Positive
         # TN: is_fraud=False, 予測=Negative
         # FN: is_fraud=True, 予測=Negative
-        confusion_matrix_query = f"""
-        WITH adjusted_score_data AS (
-            SELECT *, (SCORE + {score_adjustment}) AS adjusted_score FROM filtered_data
+        score_counts_task = submit_cached(
+            score_counts_query(filtered_table),
+            data_fingerprint,
+            filter_signature,
+            label="スコアごとの件数",
         )
-        SELECT
-            SUM(CASE WHEN is_fraud = TRUE AND adjusted_score >= {threshold_mid} THEN 1 ELSE 0 END) AS tp,
-            SUM(CASE WHEN is_fraud = FALSE AND adjusted_score >= {threshold_mid} THEN 1 ELSE 0 END) AS fp,
-            SUM(CASE WHEN is_fraud = FALSE AND adjusted_score < {threshold_mid} THEN 1 ELSE 0 END) AS tn,
-            SUM(CASE WHEN is_fraud = TRUE AND adjusted_score < {threshold_mid} THEN 1 ELSE 0 END) AS fn
-        FROM adjusted_score_data
-        """
-        cm_df = con.execute(confusion_matrix_query).fetchdf()
-        tp = cm_df["tp"][0] or 0
-        fp = cm_df["fp"][0] or 0
-        tn = cm_df["tn"][0] or 0
-        fn = cm_df["fn"][0] or 0
-
-        # 可視化 (Plotlyヒートマップ)
-        z = [[int(tp), int(fn)], [int(fp), int(tn)]]
-        x = ["Actual: Fraud", "Actual: Not Fraud"]
-        y = ["Predicted: Fraud", "Predicted: Not Fraud"]
-
-        # ラベル（テキスト）もzと同じ構造で作成
-        z_text = [[str(y) for y in x] for x in z]
-
-        fig_cm = px.imshow(
-            z,
-            labels=dict(x="Actual Condition", y="Predicted Condition", color="Count"),
-            x=x,
-            y=y,
-            text_auto=True,
-            color_continuous_scale="Blues",
+
+        # --- 1. 件数サマリー ---
+        st.subheader("件数サマリー")
+
+        summary_df = wait_result(summary_task)
+        if summary_df is not None:
+            total_count = summary_df["total_count"][0]
+            fraud_count = summary_df["fraud_count"][0]
+
+            # 表示する列を動的に決定
+            if has_correct_label_col:
+                misclassified_count = summary_df["misclassified_count"][0]
+                col1, col2, col3 = st.columns(3)
+                col1.metric("総件数", f"{total_count:,}")
+                col2.metric("不正検知件数", f"{fraud_count:,}")
+                col3.metric("誤検知件数", f"{misclassified_count:,}")
+            else:
+                col1, col2 = st.columns(2)
+                col1.metric("総件数", f"{total_count:,}")
+                col2.metric("不正検知件数", f"{fraud_count:,}")
+
+        # --- 2. 混合行列 ---
+        st.subheader("混合行列")
+        score_counts = wait_result(score_counts_task)
+        score_histogram = (
+            ScoreHistogram(score_counts) if score_counts is not None else None
         )
+        if score_histogram is not None:
+            confusion = score_histogram.confusion(threshold_mid, score_adjustment)
+            tp = confusion["tp"]
+            fp = confusion["fp"]
+            tn = confusion["tn"]
+            fn = confusion["fn"]
+
+            # 可視化 (Plotlyヒートマップ)
+            z = [[int(tp), int(fn)], [int(fp), int(tn)]]
+            x = ["Actual: Fraud", "Actual: Not Fraud"]
+            y = ["Predicted: Fraud", "Predicted: Not Fraud"]
+
+            # ラベル（テキスト）もzと同じ構造で作成
+            z_text = [[str(y) for y in x] for x in z]
+
+            fig_cm = px.imshow(
+                z,
+                labels=dict(
+                    x="Actual Condition", y="Predicted Condition", color="Count"
+                ),
+                x=x,
+                y=y,
+                text_auto=True,
+                color_continuous_scale="Blues",
+            )
 
-        fig_cm.update_layout(title_text="<i><b>Confusion Matrix</b></i>")
-        st.plotly_chart(fig_cm, use_container_width=False)
+            fig_cm.update_layout(title_text="<i><b>Confusion Matrix</b></i>")
+            st.plotly_chart(fig_cm, use_container_width=False)
 
-        # --- 2.1 評価指標の計算と表示 ---
-        # Recall = TP / (TP + FN)
-        recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-        # False Positive Rate = FP / (FP + TN)
-        fpr = fp / (fp + tn) if (fp + tn) > 0 else 0
+            # --- 2.1 評価指標の計算と表示 ---
+            # Recall = TP / (TP + FN)
+            recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+            # False Positive Rate = FP / (FP + TN)
+            fpr = fp / (fp + tn) if (fp + tn) > 0 else 0
 
-        col1, col2 = st.columns(2)
-        col1.metric("リコール (再現率)", f"{recall:.2%}")
-        col2.metric("偽陽性率 (FPR)", f"{fpr:.2%}")
+            col1, col2 = st.columns(2)
+            col1.metric("リコール (再現率)", f"{recall:.2%}")
+            col2.metric("偽陽性率 (FPR)", f"{fpr:.2%}")
 
         # --- 3. スコアのヒストグラム（第二軸対応） ---
         st.subheader("調整後スコアの分布")
-        hist_df = con.execute(
-            f"SELECT (SCORE + {score_adjustment}) AS adjusted_score, is_fraud FROM filtered_data"
-        ).fetchdf()
-
-        # データを不正と正常に分離
-        fraud_scores = hist_df[hist_df["is_fraud"] == True]["adjusted_score"]
-        normal_scores = hist_df[hist_df["is_fraud"] == False]["adjusted_score"]
-
-        # 全体のスコア範囲に基づいてビニングを決定
-        min_score, max_score = (
-            hist_df["adjusted_score"].min(),
-            hist_df["adjusted_score"].max(),
-        )
-        bins = np.linspace(min_score, max_score, 101)  # 100個のビン
-
-        # 各データセットのヒストグラムを計算
-        normal_counts, bin_edges = np.histogram(normal_scores, bins=bins)
-        fraud_counts, _ = np.histogram(fraud_scores, bins=bins)
+        if score_histogram is not None:
+            # 調整後スコアのビンは、元のスコアのビンを調整値だけずらしたものになる
+            hist_df = score_histogram.binned().with_columns(
+                (
+                    (pl.col("bin_start") + pl.col("bin_end")) / 2 + score_adjustment
+                ).alias("bin_center")
+            )
+            normal_bins = hist_df.filter(~pl.col("is_fraud"))
+            fraud_bins = hist_df.filter(pl.col("is_fraud"))
+
+            # グラフを作成
+            fig_hist = go.Figure()
+
+            # 正常データのバーを追加 (プライマリY軸)
+            fig_hist.add_trace(
+                go.Bar(
+                    x=normal_bins["bin_center"].to_numpy(),
+                    y=normal_bins["count"].to_numpy(),
+                    name="Normal",
+                    marker_color="blue",
+                    opacity=0.6,
+                )
+            )
 
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+            # 不正データのバーを追加 (セカンダリY軸)
+            fig_hist.add_trace(
+                go.Bar(
+                    x=fraud_bins["bin_center"].to_numpy(),
+                    y=fraud_bins["count"].to_numpy(),
+                    name="Fraud",
+                    marker_color="red",
+                    opacity=0.6,
+                    yaxis="y2",
+                )
+            )
 
-        # グラフを作成
-        fig_hist = go.Figure()
+            # レイアウトを更新
+            fig_hist.update_layout(
+                title_text="調整後スコアのヒストグラム（不正フラグ別）",
+                xaxis_title="調整後スコア",
+                yaxis_title="正常(Normal)件数",
+                yaxis2=dict(title="不正(Fraud)件数", overlaying="y", side="right"),
+                barmode="overlay",
+                legend=dict(x=0, y=1.0),
+            )
 
-        # 正常データのバーを追加 (プライマリY軸)
-        fig_hist.add_trace(
-            go.Bar(
-                x=bin_centers,
-                y=normal_counts,
-                name="Normal",
-                marker_color="blue",
-                opacity=0.6,
+            # 判定閾値の垂直線を追加
+            fig_hist.add_vline(
+                x=threshold_mid,
+                line_width=2,
+                line_dash="dash",
+                line_color="black",
+                annotation_text="不正判定閾値",
+                annotation_position="top right",
             )
+
+            st.plotly_chart(fig_hist, use_container_width=True)
+
+        # --- 4. 閾値ごとの評価（ROC曲線・PR曲線） ---
+        st.subheader("閾値ごとの評価（ROC曲線・PR曲線）")
+        col1, col2, col3 = st.columns(3)
+        objective = col1.selectbox(
+            "最適な閾値の基準", options=[OBJECTIVE_F1, OBJECTIVE_COST]
         )
+        fp_cost = col2.number_input(
+            "誤検出1件あたりのコスト", min_value=0.0, value=1.0, step=1.0
+        )
+        fn_cost = col3.number_input(
+            "見逃し1件あたりのコスト", min_value=0.0, value=10.0, step=1.0
+        )
+        if score_histogram is not None:
+            # 全ての閾値の評価指標を、スコアごとの累積件数から一度に求める（クエリは実行しない）
+            sweep = threshold_sweep(score_histogram, score_adjustment, fp_cost, fn_cost)
+            best = best_threshold(sweep, objective)
+            current = with_metrics(
+                pl.DataFrame([score_histogram.confusion(threshold_mid, score_adjustment)]),
+                fp_cost,
+                fn_cost,
+            ).row(0, named=True)
+
+            auc = roc_auc(sweep)
+            ap = average_precision(sweep)
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("ROC AUC", f"{auc:.3f}" if auc is not None else "-")
+            col2.metric("平均適合率 (AP)", f"{ap:.3f}" if ap is not None else "-")
+            if best is not None:
+                col3.metric(
+                    f"推奨閾値（{objective}）",
+                    f"{best['threshold']:g}",
+                    help="調整後スコアがこの値以上を不正と判定します。inf は全件を正常と判定する場合です。",
+                )
+                col4.metric(
+                    "推奨閾値でのF1 / コスト",
+                    f"{best['f1'] or 0:.3f} / {best['cost']:,.0f}",
+                    delta=f"現在: {current['f1'] or 0:.3f} / {current['cost']:,.0f}",
+                    delta_color="off",
+                )
 
-        # 不正データのバーを追加 (セカンダリY軸)
-        fig_hist.add_trace(
-            go.Bar(
-                x=bin_centers,
-                y=fraud_counts,
-                name="Fraud",
-                marker_color="red",
-                opacity=0.6,
-                yaxis="y2",
+            curve = sweep.filter(pl.col("threshold").is_finite())
+            col1, col2 = st.columns(2)
+            fig_roc = px.line(
+                curve,
+                x="fpr",
+                y="recall",
+                hover_data=["threshold", "precision", "f1", "cost"],
+                title="ROC曲線",
+                labels={"fpr": "偽陽性率 (FPR)", "recall": "リコール (再現率)"},
             )
-        )
+            fig_pr = px.line(
+                curve,
+                x="recall",
+                y="precision",
+                hover_data=["threshold", "fpr", "f1", "cost"],
+                title="PR曲線",
+                labels={"recall": "リコール (再現率)", "precision": "適合率 (Precision)"},
+            )
+            for fig, x, y in [(fig_roc, "fpr", "recall"), (fig_pr, "recall", "precision")]:
+                fig.add_trace(
+                    go.Scatter(
+                        x=[current[x]],
+                        y=[current[y]],
+                        mode="markers",
+                        marker=dict(color="black", size=10),
+                        name="現在の閾値",
+                    )
+                )
+                if best is not None:
+                    fig.add_trace(
+                        go.Scatter(
+                            x=[best[x]],
+                            y=[best[y]],
+                            mode="markers",
+                            marker=dict(color="red", size=12, symbol="star"),
+                            name="推奨閾値",
+                        )
+                    )
+            col1.plotly_chart(fig_roc, use_container_width=True)
+            col2.plotly_chart(fig_pr, use_container_width=True)
+
+            # 閾値に対する指標の推移
+            fig_sweep = px.line(
+                curve.unpivot(
+                    index="threshold",
+                    on=["precision", "recall", "f1"],
+                    variable_name="metric",
+                ),
+                x="threshold",
+                y="value",
+                color="metric",
+                title="閾値ごとの適合率・再現率・F1スコア",
+                labels={"threshold": "閾値（調整後スコア）", "value": "値"},
+            )
+            fig_sweep.add_vline(
+                x=threshold_mid, line_width=2, line_dash="dash", line_color="black"
+            )
+            st.plotly_chart(fig_sweep, use_container_width=True)
 
-        # レイアウトを更新
-        fig_hist.update_layout(
-            title_text="調整後スコアのヒストグラム（不正フラグ別）",
-            xaxis_title="調整後スコア",
-            yaxis_title="正常(Normal)件数",
-            yaxis2=dict(title="不正(Fraud)件数", overlaying="y", side="right"),
-            barmode="overlay",
-            legend=dict(x=0, y=1.0),
-        )
+            with st.expander("閾値ごとの評価指標"):
+                st.dataframe(sweep, use_container_width=True)
 
-        # 判定閾値の垂直線を追加
-        fig_hist.add_vline(
-            x=threshold_mid,
-            line_width=2,
-            line_dash="dash",
-            line_color="black",
-            annotation_text="不正判定閾値",
-            annotation_position="top right",
+        # --- 5. セグメント別の評価指標 ---
+        st.subheader("セグメント別の評価指標")
+        st.caption(
+            "分析軸の全ての値とその組み合わせについて、現在の閾値・調整値での評価指標を表示します"
+            "（サイドバーのフィルタは適用しません）。列名をクリックすると並べ替えられます。"
         )
-
-        st.plotly_chart(fig_hist, use_container_width=True)
+        try:
+            # セグメント × スコアの値ごとの件数を1回の集計で求める。閾値・調整値・コストを
+            # 変えても集計し直さず、この件数から全セグメントの指標を求める
+            segment_counts = fetch_cached(
+                con,
+                segment_score_counts_query("source_data", selected_dims),
+                data_fingerprint,
+                label="セグメント×スコアごとの件数",
+            )
+        except QueryTimeout as e:
+            st.warning(f"{e}。セグメント別の評価指標の表示を省略します。")
+            segment_counts = None
+        if segment_counts is not None:
+            min_count = st.number_input(
+                "表示するセグメントの最小件数", min_value=1, value=1, step=1
+            )
+            segments = segment_metrics(
+                segment_counts,
+                selected_dims,
+                threshold_mid,
+                score_adjustment,
+                fp_cost,
+                fn_cost,
+            ).filter(pl.col("count") >= min_count)
+            st.dataframe(
+                segments,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    c: st.column_config.NumberColumn(format="percent")
+                    for c in ["fraud_rate", "precision", "recall", "fpr"]
+                },
+            )
 
     else:
         st.info("サイドバーで分析軸となる列を1つ以上選択してください。")
 else:
     st.info("サイドバーで表示するデータソースを選択してください。")
+
+# --- クエリ時間の内訳・プロファイル ---
+st.sidebar.checkbox(
+    "クエリのプロファイルを記録",
+    key="profile_queries",
+    help="実行したクエリのスキャン行数・バイト数と実行計画（EXPLAIN ANALYZE）を記録します。"
+    "キャッシュから返したクエリは実行しないため記録されません。",
+)
+if timings.records:
+    with st.sidebar.expander("クエリ時間の内訳（ms）"):
+        # 時間のかかった順に並べる。再実行するとキャッシュから返すためプロファイルは
+        # 記録されなくなるので、実行計画は選択させずに全て表示する
+        ranking = timings.ranking()
+        st.dataframe(ranking, use_container_width=True)
+        for label in ranking["label"]:
+            if label in timings.profiles:
+                st.caption(label)
+                st.code(format_profile(timings.profiles[label]))
+        st.download_button(
+            "トレースをダウンロード（JSON）",
+            data=timings.trace(),
+            file_name="query_trace.json",
+            mime="application/json",
+        )
@@ -0,0 +1,77 @@
+def histogram_query(
+    source: str,
+    value: str,
+    group: str | None = None,
+    bins: int = 100,
+    tail: float = 0.0,
+) -> str:
+    """
+    value（列名またはSQL式）を bins 個の等幅のビンに分け、ビンごとの件数を求めるクエリ。
+    結果の列は [group,] bin, bin_start, bin_end, count（件数0のビンは含まない）。
+
+    ビンの範囲は全体（グループ共通）の最小値・最大値から決める。
+    tail > 0 の場合は近似分位点 tail・1-tail を範囲とし、範囲外の値は両端のビンに含める
+    （裾の長い分布で、少数の外れ値のためにビンが粗くなるのを防ぐ）。
+    """
+    if tail > 0:
+        bounds = (
+            f"approx_quantile({value}, {tail}) AS lo, "
+            f"approx_quantile({value}, {1 - tail}) AS hi"
+        )
+    else:
+        bounds = f"MIN({value}) AS lo, MAX({value}) AS hi"
+    group_part = f"{group}, " if group else ""
+    return f"""
+        WITH bounds AS (
+            SELECT
+                CAST(lo AS DOUBLE) AS lo,
+                CASE WHEN hi > lo THEN (CAST(hi AS DOUBLE) - lo) / {bins} ELSE 1 END
+                    AS width
+            FROM (SELECT {bounds} FROM {source})
+        ),
+        binned AS (
+            SELECT
+                {group_part}
+                LEAST(GREATEST(FLOOR(({value} - lo) / width), 0), {bins - 1}) AS bin
+            FROM {source}, bounds
+            WHERE {value} IS NOT NULL
+        )
+        SELECT
+            {group_part}
+            CAST(bin AS INTEGER) AS bin,
+            lo + bin * width AS bin_start,
+            lo + (bin + 1) * width AS bin_end,
+            COUNT(*) AS count
+        FROM binned, bounds
+        GROUP BY ALL
+        ORDER BY ALL
+    """
+
+
+def box_stats_query(source: str, value: str, group: str | None = None) -> str:
+    """
+    箱ひげ図の要約統計量（件数・最小値・四分位数・最大値・平均）を求めるクエリ。
+    四分位数は近似分位点（t-digest）で、全行を並べ替えずに求める。
+    ひげの端（lower_fence, upper_fence）は四分位範囲の1.5倍と最小値・最大値の内側とする。
+    """
+    group_part = f"{group}, " if group else ""
+    return f"""
+        SELECT
+            *,
+            GREATEST(min, q1 - 1.5 * (q3 - q1)) AS lower_fence,
+            LEAST(max, q3 + 1.5 * (q3 - q1)) AS upper_fence
+        FROM (
+            SELECT
+                {group_part}
+                COUNT({value}) AS count,
+                MIN({value}) AS min,
+                approx_quantile({value}, 0.25) AS q1,
+                approx_quantile({value}, 0.5) AS median,
+                approx_quantile({value}, 0.75) AS q3,
+                MAX({value}) AS max,
+                AVG({value}) AS mean
+            FROM {source}
+            {"GROUP BY ALL" if group else ""}
+        )
+        {"ORDER BY ALL" if group else ""}
+    """
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+# 絞り込み結果のテーブルを置くインメモリデータベースの別名
+SCRATCH_ALIAS = "scratch"
+
+
+def in_memory_table_bytes(con) -> int:
+    """
+    DuckDBのインメモリテーブルが使用しているメモリの合計（バイト）を返す。
+    """
+    return con.execute(
+        "SELECT COALESCE(SUM(memory_usage_bytes), 0) FROM duckdb_memory() "
+        "WHERE tag = 'IN_MEMORY_TABLE'"
+    ).fetchone()[0]
+
+
+class MaterializedTables:
+    """
+    フィルタ条件ごとの絞り込み結果を、インメモリのテーブルとして保持する。
+
+    ビューは参照されるたびにフィルタやCASE式を評価し直すが、テーブルにしておけば
+    同じ条件の集計は、必要な列だけを持つ絞り込み済みの行をスキャンするだけで済む。
+    テーブルは条件の署名（key）ごとに作り、インメモリテーブルの使用メモリが max_bytes を
+    超えた場合は、最も長く参照されていない条件のテーブルから削除する。
+    テーブルは全セッションで共有し、別の条件のテーブルの作成は並行して行える。
+    """
+
+    def __init__(self, con, max_bytes: int = 512 * 1024**2, alias: str = SCRATCH_ALIAS):
+        self.con = con
+        self.max_bytes = max_bytes
+        self.alias = alias
+        self.tables: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+        # 作成中の条件ごとのロック（同じ条件のテーブルを重複して作らない）
+        self.creating: dict[str, threading.Lock] = {}
+        attached = con.execute(
+            "SELECT 1 FROM duckdb_databases() WHERE database_name = ?", [alias]
+        ).fetchone()
+        if not attached:
+            con.execute(f"ATTACH ':memory:' AS {alias}")
+
+    def get(self, key: str, query: str, con=None, params: list | None = None) -> str:
+        """
+        key の条件の絞り込み結果（query の結果）を保持するテーブル名を返す。
+        テーブルがなければ、con（省略時は作成時のコネクション）で query を
+        パラメータ params で実行して作成する。key にはパラメータも含めること。
+        query がセッションの TEMP VIEW を参照する場合は、そのセッションのカーソルを渡す。
+        """
+        con = con or self.con
+        with self.lock:
+            if key in self.tables:
+                self.tables.move_to_end(key)
+                return self.tables[key]
+            key_lock = self.creating.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.tables:
+                    self.tables.move_to_end(key)
+                    return self.tables[key]
+            table = f"{self.alias}.filtered_{key[:16]}"
+            con.execute(f"CREATE OR REPLACE TABLE {table} AS {query}", params)
+            with self.lock:
+                self.tables[key] = table
+                self.creating.pop(key, None)
+                self._evict(con)
+            return table
+
+    def _evict(self, con) -> None:
+        # 作成したばかりのテーブルは、上限を超えていても削除しない
+        while in_memory_table_bytes(con) > self.max_bytes and len(self.tables) > 1:
+            _, evicted = self.tables.popitem(last=False)
+            con.execute(f"DROP TABLE IF EXISTS {evicted}")
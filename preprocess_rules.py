@@ -0,0 +1,355 @@
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import typer
+
+# 真とみなす文字列（小文字で比較する）
+TRUE_STRINGS = ["true", "1"]
+
+# 日時として解釈できる文字列（ISO 8601 形式）
+ISO_DATETIME_PATTERN = r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$"
+DATETIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]
+
+
+class Rule:
+    """
+    前処理ルールの基底クラス。
+    各ルールは Polars の式（polars）と Arrow の計算（arrow）の両方に変換できる。
+
+    polars は列名から「その列の最終的な値を表す式」への辞書 cols を更新する。
+    後続のルールは cols の式を参照するため、全ルールが1つの with_columns に融合される。
+    """
+
+    def polars(self, cols: dict[str, pl.Expr], dtypes: dict[str, pl.DataType]):
+        raise NotImplementedError
+
+    def arrow(self, table: pa.Table) -> pa.Table:
+        raise NotImplementedError
+
+
+def col_expr(cols: dict[str, pl.Expr], name: str) -> pl.Expr:
+    return cols.get(name, pl.col(name))
+
+
+def set_arrow_column(table: pa.Table, name: str, array) -> pa.Table:
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, array)
+    return table.append_column(name, array)
+
+
+def is_arrow_string(dtype: pa.DataType) -> bool:
+    return pa.types.is_string(dtype) or pa.types.is_large_string(dtype)
+
+
+@dataclass(frozen=True)
+class DropEmptyRows(Rule):
+    """全列が欠損値の行を削除する（行のフィルタ）。"""
+
+    def polars_predicate(self) -> pl.Expr:
+        return ~pl.all_horizontal(pl.all().is_null())
+
+    def arrow(self, table: pa.Table) -> pa.Table:
+        if table.num_columns == 0:
+            return table
+        all_null = pc.is_null(table.column(0))
+        for column in table.columns[1:]:
+            all_null = pc.and_(all_null, pc.is_null(column))
+        return table.filter(pc.invert(all_null))
+
+
+@dataclass(frozen=True)
+class FillNull(Rule):
+    """列の欠損値を定数で補完する。"""
+
+    column: str
+    value: object
+
+    def polars(self, cols, dtypes):
+        if self.column in dtypes:
+            cols[self.column] = col_expr(cols, self.column).fill_null(self.value)
+
+    def arrow(self, table):
+        if self.column not in table.column_names:
+            return table
+        array = table.column(self.column)
+        return set_arrow_column(
+            table, self.column, pc.fill_null(array, pa.scalar(self.value, array.type))
+        )
+
+
+@dataclass(frozen=True)
+class FillStrings(Rule):
+    """文字列型の全ての列の欠損値を定数で補完する。"""
+
+    value: str
+
+    def polars(self, cols, dtypes):
+        for name, dtype in dtypes.items():
+            if dtype == pl.Utf8:
+                cols[name] = col_expr(cols, name).fill_null(self.value)
+
+    def arrow(self, table):
+        for name in table.column_names:
+            array = table.column(name)
+            if is_arrow_string(array.type):
+                table = set_arrow_column(table, name, pc.fill_null(array, self.value))
+        return table
+
+
+@dataclass(frozen=True)
+class ToBool(Rule):
+    """
+    列を真偽値に変換し、欠損値を偽で補完する。
+    文字列は "true" / "1"（大文字小文字を区別しない）を真、数値は0以外を真とする。
+    """
+
+    column: str
+
+    def polars(self, cols, dtypes):
+        if self.column not in dtypes:
+            return
+        expr = col_expr(cols, self.column)
+        dtype = dtypes[self.column]
+        if dtype == pl.Utf8:
+            expr = expr.str.to_lowercase().is_in(TRUE_STRINGS)
+        elif dtype.is_numeric():
+            expr = expr != 0
+        cols[self.column] = expr.fill_null(False)
+        dtypes[self.column] = pl.Boolean
+
+    def arrow(self, table):
+        if self.column not in table.column_names:
+            return table
+        array = table.column(self.column)
+        if is_arrow_string(array.type):
+            array = pc.is_in(pc.utf8_lower(array), pa.array(TRUE_STRINGS))
+        elif pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+            array = pc.not_equal(array, 0)
+        return set_arrow_column(table, self.column, pc.fill_null(array, False))
+
+
+@dataclass(frozen=True)
+class ParseDatetime(Rule):
+    """文字列の列を日時型に変換する。解釈できない値は欠損値とする。"""
+
+    column: str
+
+    def polars(self, cols, dtypes):
+        if dtypes.get(self.column) == pl.Utf8:
+            cols[self.column] = col_expr(cols, self.column).str.to_datetime(
+                strict=False
+            )
+            dtypes[self.column] = pl.Datetime
+
+    def arrow(self, table):
+        if self.column not in table.column_names:
+            return table
+        array = table.column(self.column)
+        if not is_arrow_string(array.type):
+            return table
+        valid = pc.match_substring_regex(array, ISO_DATETIME_PATTERN)
+        masked = pc.if_else(valid, array, pa.scalar(None, array.type))
+        try:
+            parsed = pc.cast(masked, pa.timestamp("ns"))
+        except pa.ArrowInvalid:
+            # 形式は正しいが存在しない日付などがある場合は、書式ごとに解釈する
+            parsed = pc.coalesce(
+                *[
+                    pc.strptime(array, format=fmt, unit="ns", error_is_null=True)
+                    for fmt in DATETIME_FORMATS
+                ]
+            )
+        return set_arrow_column(table, self.column, parsed)
+
+
+@dataclass(frozen=True)
+class FillGaps(Rule):
+    """列の欠損値を直前の値で補完し、先頭の欠損値は直後の値で補完する。"""
+
+    column: str
+
+    def polars(self, cols, dtypes):
+        if self.column in dtypes:
+            cols[self.column] = (
+                col_expr(cols, self.column).forward_fill().backward_fill()
+            )
+
+    def arrow(self, table):
+        if self.column not in table.column_names:
+            return table
+        array = pc.fill_null_backward(pc.fill_null_forward(table.column(self.column)))
+        return set_arrow_column(table, self.column, array)
+
+
+@dataclass(frozen=True)
+class Bucket(Rule):
+    """
+    数値列を閾値で区分し、ラベルの列を追加する。
+    labels は thresholds より1つ多く、値 < thresholds[i] となる最初の区分のラベルを付ける。
+    """
+
+    source: str
+    target: str
+    thresholds: tuple
+    labels: tuple
+
+    def polars(self, cols, dtypes):
+        if self.source not in dtypes:
+            return
+        source = col_expr(cols, self.source)
+        (first_threshold, *thresholds) = self.thresholds
+        expr = pl.when(source < first_threshold).then(pl.lit(self.labels[0]))
+        for threshold, label in zip(thresholds, self.labels[1:]):
+            expr = expr.when(source < threshold).then(pl.lit(label))
+        cols[self.target] = expr.otherwise(pl.lit(self.labels[-1]))
+        dtypes[self.target] = pl.Utf8
+
+    def arrow(self, table):
+        if self.source not in table.column_names:
+            return table
+        source = table.column(self.source)
+        result = pa.scalar(self.labels[-1])
+        for threshold, label in reversed(list(zip(self.thresholds, self.labels))):
+            condition = pc.fill_null(pc.less(source, threshold), False)
+            result = pc.if_else(condition, label, result)
+        return set_arrow_column(table, self.target, result)
+
+
+@dataclass(frozen=True)
+class MonthStart(Rule):
+    """日時列を月初に切り捨てた列を追加する。"""
+
+    source: str
+    target: str
+
+    def polars(self, cols, dtypes):
+        if self.source not in dtypes:
+            return
+        cols[self.target] = col_expr(cols, self.source).dt.truncate("1mo")
+        dtypes[self.target] = dtypes[self.source]
+
+    def arrow(self, table):
+        if self.source not in table.column_names:
+            return table
+        array = pc.floor_temporal(table.column(self.source), unit="month")
+        return set_arrow_column(table, self.target, array)
+
+
+def default_rules(score_thresholds: List[int]) -> list[Rule]:
+    """
+    データローダーとHDF5変換で共通の前処理ルールを返す。
+    """
+    t1, t2 = sorted(score_thresholds)
+    return [
+        # 1. 全列が欠損値の行を削除
+        DropEmptyRows(),
+        # 2. 欠損値処理（numeric_col_* は null のまま）
+        FillNull("SCORE", 0),
+        FillNull("EVENT_VALUE", 0),
+        ToBool("is_fraud"),
+        ParseDatetime("EVENT_TIME"),
+        FillStrings("unknown"),
+        FillGaps("EVENT_TIME"),
+        # 3. 特徴量生成
+        Bucket("SCORE", "score_level", (t1, t2), ("low", "mid", "high")),
+        MonthStart("EVENT_TIME", "event_month"),
+    ]
+
+
+def apply_polars(rules: list[Rule], lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    ルールを1つの filter と1つの with_columns に融合した Polars の実行計画に変換する。
+    """
+    dtypes = dict(lf.collect_schema())
+    cols: dict[str, pl.Expr] = {}
+    for rule in rules:
+        if isinstance(rule, DropEmptyRows):
+            lf = lf.filter(rule.polars_predicate())
+        else:
+            rule.polars(cols, dtypes)
+    if not cols:
+        return lf
+    return lf.with_columns(**cols)
+
+
+def apply_arrow(rules: list[Rule], table: pa.Table) -> pa.Table:
+    """
+    ルールを Arrow の計算カーネルで順に適用する。
+    """
+    for rule in rules:
+        table = rule.arrow(table)
+    return table
+
+
+def profile_rules(rules: list[Rule], df: pl.DataFrame) -> pl.DataFrame:
+    """
+    ルールごとの処理時間を Polars と Arrow の両方で計測する。
+    各ルールは直前のルールまで適用済みのデータに対して単独で実行し、
+    最後の行に全ルールを融合した Polars の計画の処理時間を示す。
+    """
+    rows = []
+    current_df = df
+    current_table = df.to_arrow()
+    for rule in rules:
+        start = time.perf_counter()
+        current_df = apply_polars([rule], current_df.lazy()).collect()
+        polars_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        current_table = apply_arrow([rule], current_table)
+        arrow_ms = (time.perf_counter() - start) * 1000
+
+        rows.append(
+            {
+                "step": repr(rule),
+                "rows": current_df.height,
+                "polars_ms": polars_ms,
+                "arrow_ms": arrow_ms,
+            }
+        )
+
+    start = time.perf_counter()
+    fused = apply_polars(rules, df.lazy()).collect()
+    rows.append(
+        {
+            "step": "全ルール（融合）",
+            "rows": fused.height,
+            "polars_ms": (time.perf_counter() - start) * 1000,
+            "arrow_ms": sum(row["arrow_ms"] for row in rows),
+        }
+    )
+    return pl.DataFrame(rows)
+
+
+app = typer.Typer(help="前処理ルールのプロファイリング")
+
+
+@app.command()
+def main(
+    input_file: Path = typer.Argument(
+        ..., help="計測に使用するTSVファイル", exists=True, dir_okay=False
+    ),
+    score_t1: int = typer.Option(500, help="SCOREの閾値1（low <-> mid）"),
+    score_t2: int = typer.Option(1500, help="SCOREの閾値2（mid <-> high）"),
+):
+    """
+    TSVファイルに前処理ルールを適用し、ルールごとの処理時間を表示します。
+    """
+    df = pl.read_csv(
+        input_file,
+        separator="\t",
+        try_parse_dates=True,
+        quote_char=None,
+        ignore_errors=True,
+    )
+    with pl.Config(fmt_str_lengths=80, tbl_rows=-1):
+        typer.echo(profile_rules(default_rules([score_t1, score_t2]), df))
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,50 @@
+import os
+from time import perf_counter, sleep
+from typing import Callable
+
+
+class QueryTimeout(Exception):
+    """
+    クエリが時間の予算内に終わらず、中断された。
+    """
+
+
+def timeout_from_env(default: float | None = 60.0) -> float | None:
+    """
+    環境変数 QUERY_TIMEOUT（秒）からクエリ1件あたりの時間の予算を読み込む。
+    0 の場合は予算を設けない。
+    """
+    value = os.environ.get("QUERY_TIMEOUT")
+    if value is None:
+        return default
+    return float(value) or None
+
+
+def wait_until_done(
+    done: Callable[[], bool],
+    cancel: Callable[[], None],
+    timeout: float | None,
+    on_wait: Callable[[float], None] | None = None,
+    interval: float = 0.1,
+) -> None:
+    """
+    done() が真になるまで interval 秒ごとに確認して待つ。
+
+    timeout 秒を超えた場合は cancel() を呼んで QueryTimeout を送出する。
+    待っている間は on_wait（経過秒数を受け取る）を呼ぶ。Streamlitでは画面の更新が
+    再実行の要求を確認する箇所になるため、on_wait で表示を更新すると、新しい再実行に
+    置き換えられた描画はここで打ち切られる。その場合を含め、待っている間に例外が
+    発生した場合も cancel() を呼び、放棄された描画のクエリがCPUを使い続けないようにする。
+    """
+    start = perf_counter()
+    try:
+        while not done():
+            elapsed = perf_counter() - start
+            if timeout is not None and elapsed >= timeout:
+                raise QueryTimeout(f"クエリが{timeout:g}秒以内に終わりませんでした")
+            if on_wait is not None:
+                on_wait(elapsed)
+            sleep(interval)
+    except BaseException:
+        cancel()
+        raise
@@ -0,0 +1,147 @@
+import hashlib
+import math
+import re
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+# PREPARE できる問い合わせ（SELECT 文）
+_QUERY_PATTERN = re.compile(r"\s*(SELECT|WITH|FROM)\b", re.IGNORECASE)
+
+# ビューを作成・削除する文（ビューの名前を取り出す）
+_VIEW_DDL_PATTERN = re.compile(
+    r"\s*(?:CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP\s+|TEMPORARY\s+)?VIEW|DROP\s+VIEW)"
+    r"\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\S+)",
+    re.IGNORECASE,
+)
+
+
+def quote_ident(name: str) -> str:
+    """
+    列名などの識別子をダブルクォートで囲む。
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_literal(value) -> str:
+    """
+    Pythonの値をDuckDBのリテラルに変換する（EXECUTE の引数に使う）。
+    """
+    if hasattr(value, "item"):
+        # numpy のスカラー
+        value = value.item()
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isfinite(value):
+            return repr(value)
+        return f"'{value}'::DOUBLE"
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(sql_literal(v) for v in value) + "]"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class QueryBuilder:
+    """
+    プレースホルダ（$1, $2, ...）とパラメータの組を組み立てる。
+
+    値をSQLの文字列に埋め込まずにパラメータとして渡すため、値が変わってもSQLの文字列
+    （テンプレート）は変わらず、引用符を含む値でも構文が壊れない。
+    """
+
+    def __init__(self):
+        self.params: list = []
+
+    def param(self, value) -> str:
+        """
+        値をパラメータに加え、そのプレースホルダを返す。
+        """
+        self.params.append(value)
+        return f"${len(self.params)}"
+
+    def in_list(self, column: str, values: list, column_type: str | None = None) -> str:
+        """
+        列の値が values のいずれかである条件。values が空の場合は絞り込まない。
+        column_type を指定すると、値のリストをその型に変換してから比較する
+        （入力された文字列を数値の列と比較する場合など）。
+        """
+        if not values:
+            return "TRUE"
+        placeholder = self.param(list(values))
+        if column_type:
+            placeholder = f"CAST({placeholder} AS {column_type}[])"
+        return f"{quote_ident(column)} IN {placeholder}"
+
+
+class PreparedConnection:
+    """
+    パラメータ付きの問い合わせを PREPARE し、テンプレートごとに再利用するコネクション。
+
+    execute にパラメータを渡した SELECT 文は、初回に PREPARE してから EXECUTE し、
+    2回目以降はパースと実行計画の作成を省略する。DuckDBのPython APIからは
+    EXECUTE にパラメータをバインドできないため、値は sql_literal で引数のリテラルにする。
+    PREPARE した文は参照するビューの定義を取り込むため、このコネクションで作成した
+    ビューの定義が変わった場合は別の文として PREPARE し直す。
+    その他の属性・メソッドは元のコネクションにそのまま委譲する。
+    """
+
+    def __init__(self, con, max_statements: int = 64):
+        self.con = con
+        self.max_statements = max_statements
+        self.statements: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self.views: dict[str, str] = {}
+        self.views_signature = ""
+        self.prepared = 0
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+    def execute(self, sql: str, params: list | None = None):
+        if not params or not _QUERY_PATTERN.match(sql):
+            result = self.con.execute(sql, params)
+            self._track_views(sql)
+            return result
+        name = self._prepare(sql)
+        args = ", ".join(sql_literal(p) for p in params)
+        return self.con.execute(f"EXECUTE {name}({args})")
+
+    def _prepare(self, sql: str) -> str:
+        key = (self.views_signature, sql)
+        name = self.statements.get(key)
+        if name is not None:
+            self.statements.move_to_end(key)
+            return name
+        self.prepared += 1
+        name = f"prepared_{self.prepared}"
+        self.con.execute(f"PREPARE {name} AS {sql}")
+        self.statements[key] = name
+        if len(self.statements) > self.max_statements:
+            _, evicted = self.statements.popitem(last=False)
+            self.con.execute(f"DEALLOCATE {evicted}")
+        return name
+
+    def _track_views(self, sql: str) -> None:
+        match = _VIEW_DDL_PATTERN.match(sql)
+        if not match:
+            return
+        name = match.group(1).lower()
+        definition = " ".join(sql.split()) if sql.lstrip()[:4].upper() != "DROP" else None
+        if self.views.get(name) == definition:
+            return
+        if definition is None:
+            self.views.pop(name, None)
+        else:
+            self.views[name] = definition
+        self.views_signature = hashlib.sha1(
+            repr(sorted(self.views.items())).encode("utf-8")
+        ).hexdigest()
@@ -0,0 +1,190 @@
+import re
+import threading
+from typing import Callable
+
+import polars as pl
+
+from query_budget import wait_until_done
+from query_profiler import polars_profile
+from result_cache import ResultCache, result_key
+
+
+def plan_signature(lf: pl.LazyFrame) -> str:
+    """
+    LazyFrame の実行計画を、キャッシュのキーに使える文字列にする。
+    スキャンごとに振られるIDは実行ごとに変わるため取り除く。
+    """
+    return re.sub(r"\s*\[id: \d+\]", "", lf.explain(optimized=False))
+
+
+# 取り消したバックグラウンドの collect。Polarsの取り消しは演算子の区切りでしか効かず、
+# 実行中に結果の受け取り口を破棄するとプロセスが異常終了するため、終了するまで保持する
+_abandoned: list = []
+_abandoned_lock = threading.Lock()
+
+
+def _abandon(queries: list) -> None:
+    with _abandoned_lock:
+        for query in queries:
+            query.cancel()
+        _abandoned.extend(queries)
+        _abandoned[:] = [query for query in _abandoned if not _finished(query)]
+
+
+def _finished(query) -> bool:
+    try:
+        return query.fetch() is not None
+    except Exception:
+        # 取り消されて中断した
+        return True
+
+
+def collect_cancellable(
+    lfs: list[pl.LazyFrame],
+    timeout: float | None,
+    on_wait: Callable[[float], None] | None = None,
+) -> list[pl.DataFrame]:
+    """
+    LazyFrame をバックグラウンドで collect し、全ての結果を返す。
+    timeout 秒を超えた場合は全ての collect を取り消して QueryTimeout を送出する。
+    """
+    queries = [lf.collect(background=True) for lf in lfs]
+    frames: list[pl.DataFrame | None] = [None] * len(queries)
+
+    def done() -> bool:
+        for i, query in enumerate(queries):
+            if frames[i] is None:
+                frames[i] = query.fetch()
+        return all(frame is not None for frame in frames)
+
+    wait_until_done(
+        done,
+        lambda: _abandon(
+            [query for query, frame in zip(queries, frames) if frame is None]
+        ),
+        timeout,
+        on_wait,
+    )
+    return frames
+
+
+class QueryPlanner:
+    """
+    ダッシュボードの1ページに必要な集計をまとめて実行するクエリプランナー。
+
+    - add: データをスキャンする集計（LazyFrame）を登録する。
+      登録された集計は execute で pl.collect_all により同時に実行され、
+      共通の部分計画（スキャンや前処理）は1回だけ評価される。
+    - derive: 実行済みの集計結果から計算する集計を登録する。
+      データを再スキャンせず、メモリ上の小さな集計結果から計算する。
+
+    ページ内の集計を細かい粒度の1つの集計（add）と、そこから導出する集計（derive）に
+    分けることで、データのスキャンを1回にまとめられる。
+
+    cache を指定した場合、add した集計の結果はデータセットの指紋（fingerprint）と
+    実行計画をキーにキャッシュされ、同じ集計はスキャンせずに再利用される。
+
+    profile=True の場合は、add した集計を1つずつ .profile() で実行し、集計ごとの
+    プロファイルを profiles に記録する（共通の部分計画はまとめて評価されなくなる）。
+    """
+
+    def __init__(
+        self,
+        cache: ResultCache | None = None,
+        fingerprint: str = "",
+        profile: bool = False,
+    ):
+        self.queries: dict[str, pl.LazyFrame] = {}
+        self.derivations: dict[str, Callable[[dict[str, pl.DataFrame]], pl.DataFrame]] = {}
+        self.results: dict[str, pl.DataFrame] = {}
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.scans = 0
+        self.cache_hits = 0
+        self.profile = profile
+        self.profiles: dict[str, dict] = {}
+
+    def add(self, name: str, lf: pl.LazyFrame) -> None:
+        """
+        データをスキャンする集計を登録する。
+        """
+        self.queries[name] = lf
+
+    def derive(
+        self, name: str, func: Callable[[dict[str, pl.DataFrame]], pl.DataFrame]
+    ) -> None:
+        """
+        実行済み（または同時に実行される）集計の結果から計算する集計を登録する。
+        func は集計名から結果への辞書を受け取る。
+        """
+        self.derivations[name] = func
+
+    def execute(
+        self,
+        timeout: float | None = None,
+        on_wait: Callable[[float], None] | None = None,
+    ) -> dict[str, pl.DataFrame]:
+        """
+        未実行の集計を実行し、全ての結果を返す。何度呼び出してもよい。
+        timeout・on_wait を指定した場合は、集計をバックグラウンドで実行して完了を待ち、
+        timeout 秒を超えるか待っている間に例外が発生したら集計を取り消す
+        （wait_until_done を参照）。この場合、集計ごとに別々に実行する。
+        """
+        pending = {
+            name: lf for name, lf in self.queries.items() if name not in self.results
+        }
+        keys = {}
+        if self.cache is not None:
+            for name, lf in list(pending.items()):
+                keys[name] = result_key(self.fingerprint, plan_signature(lf))
+                cached = self.cache.get(keys[name])
+                if cached is not None:
+                    self.results[name] = cached
+                    self.cache_hits += 1
+                    del pending[name]
+        if pending:
+            if self.profile:
+                frames = []
+                for name, lf in pending.items():
+                    frame, self.profiles[name] = polars_profile(lf)
+                    frames.append(frame)
+            elif timeout is not None or on_wait is not None:
+                frames = collect_cancellable(list(pending.values()), timeout, on_wait)
+            else:
+                frames = pl.collect_all(list(pending.values()))
+            self.results.update(zip(pending, frames))
+            self.scans += len(pending)
+            if self.cache is not None:
+                for name, frame in zip(pending, frames):
+                    self.cache.put(keys[name], frame)
+        for name, func in self.derivations.items():
+            if name not in self.results:
+                self.results[name] = func(self.results)
+        return self.results
+
+    def is_cached(self) -> bool:
+        """
+        登録された全ての集計（add）の結果がキャッシュ済みで、データをスキャンせずに
+        execute できるかを返す。
+        """
+        if self.cache is None:
+            return False
+        return all(
+            name in self.results
+            or self.cache.contains(result_key(self.fingerprint, plan_signature(lf)))
+            for name, lf in self.queries.items()
+        )
+
+    @property
+    def query_count(self) -> int:
+        """
+        登録された集計の数（集計ごとに collect した場合のスキャン回数）。
+        """
+        return len(self.queries) + len(self.derivations)
+
+    @property
+    def scans_saved(self) -> int:
+        """
+        集計ごとに collect した場合と比べて削減できたスキャン回数。
+        """
+        return self.query_count - self.scans
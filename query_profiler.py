@@ -0,0 +1,145 @@
+import json
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+import polars as pl
+
+
+@contextmanager
+def duckdb_profile(con) -> Iterator[dict]:
+    """
+    ブロック内で con（カーソル）が最後に実行したクエリのプロファイルを、
+    DuckDBのJSONプロファイル（EXPLAIN ANALYZE と同じ実行計画と演算子ごとの計測値）として取得する。
+    プロファイルの設定はコネクションごとのため、同時に実行中の他のカーソルには影響しない。
+    """
+    profile: dict = {}
+    path = os.path.join(tempfile.gettempdir(), f"duckdb_profile_{uuid.uuid4().hex}.json")
+    con.execute(f"SET profiling_output = '{path}'")
+    con.execute("PRAGMA enable_profiling = 'json'")
+    try:
+        yield profile
+    finally:
+        con.execute("PRAGMA disable_profiling")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                profile.update(json.load(f))
+            os.remove(path)
+
+
+def _operators(node: dict) -> Iterator[dict]:
+    for child in node.get("children", []):
+        yield child
+        yield from _operators(child)
+
+
+def profile_metrics(profile: dict) -> dict:
+    """
+    DuckDBのプロファイルから、スキャンした行数・バイト数、CPU時間を取り出す。
+    スキャンのバイト数は、テーブルスキャンの演算子が出力した列データの大きさ
+    （DuckDB 1.3 のプロファイルにはファイルから読んだバイト数の項目がないため）。
+    """
+    if not profile:
+        return {}
+    return {
+        "rows_scanned": profile.get("cumulative_rows_scanned"),
+        "scan_bytes": sum(
+            op.get("result_set_size", 0)
+            for op in _operators(profile)
+            if op.get("operator_type") == "TABLE_SCAN"
+        ),
+        "cpu_ms": profile.get("cpu_time", 0.0) * 1000,
+    }
+
+
+def format_profile(profile: dict) -> str:
+    """
+    DuckDBのプロファイルを、演算子ごとの時間・行数を付けた実行計画の木として文字列にする。
+    """
+    lines = [f"latency: {profile.get('latency', 0.0) * 1000:.1f} ms"]
+
+    def walk(node: dict, depth: int) -> None:
+        for child in node.get("children", []):
+            lines.append(
+                f"{'  ' * depth}{child.get('operator_name', '').strip()}"
+                f"  time={child.get('operator_timing', 0.0) * 1000:.1f}ms"
+                f"  rows={child.get('operator_cardinality', 0):,}"
+                f"  scanned={child.get('operator_rows_scanned', 0):,}"
+            )
+            walk(child, depth + 1)
+
+    walk(profile, 0)
+    return "\n".join(lines)
+
+
+def polars_profile(lf: pl.LazyFrame) -> tuple[pl.DataFrame, dict]:
+    """
+    LazyFrame を .profile() で実行し、結果とプロファイル（実行計画と計画のノードごとの時間）を返す。
+    """
+    frame, nodes = lf.profile()
+    profile = {
+        "rows": frame.height,
+        "result_bytes": frame.estimated_size(),
+        "total_ms": nodes["end"].max() / 1000 if nodes.height else 0.0,
+        "plan": lf.explain(),
+        "nodes": [
+            {
+                "node": node["node"],
+                "start_us": node["start"],
+                "end_us": node["end"],
+            }
+            for node in nodes.iter_rows(named=True)
+        ],
+    }
+    return frame, profile
+
+
+def format_polars_profile(profile: dict) -> str:
+    """
+    Polarsのプロファイルを、計画のノードごとの時間の一覧と実行計画として文字列にする。
+    """
+    lines = [
+        f"{node['node']}  time={(node['end_us'] - node['start_us']) / 1000:.1f}ms"
+        for node in profile["nodes"]
+    ]
+    return "\n".join(lines + ["", profile["plan"]])
+
+
+def polars_profile_ranking(profiles: dict[str, dict]) -> pl.DataFrame:
+    """
+    集計ごとのPolarsのプロファイルを、実行時間のかかった順の表にする。
+    """
+    return pl.DataFrame(
+        [
+            {
+                "label": label,
+                "rows": profile["rows"],
+                "result_bytes": profile["result_bytes"],
+                "total_ms": profile["total_ms"],
+            }
+            for label, profile in profiles.items()
+        ],
+        schema={
+            "label": pl.String,
+            "rows": pl.Int64,
+            "result_bytes": pl.Int64,
+            "total_ms": pl.Float64,
+        },
+    ).sort("total_ms", descending=True)
+
+
+def trace_json(records: dict[str, dict], profiles: dict[str, dict]) -> str:
+    """
+    クエリごとの計測値とプロファイルを、ダウンロード用のJSON（トレース）にする。
+    """
+    return json.dumps(
+        [
+            {"label": label, **record, "profile": profiles.get(label)}
+            for label, record in records.items()
+        ],
+        ensure_ascii=False,
+        indent=2,
+        default=str,
+    )
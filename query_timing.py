@@ -0,0 +1,141 @@
+from time import perf_counter
+
+import pandas as pd
+import polars as pl
+
+from query_profiler import duckdb_profile, profile_metrics, trace_json
+from result_cache import ResultCache
+
+
+class QueryTimings:
+    """
+    1回の描画で発行したクエリごとに、時間の内訳を記録する。
+
+    - query_ms: DuckDBでのクエリの実行と、結果をArrow形式で受け取るまでの時間
+    - convert_ms: ArrowからPolarsへの変換時間（多くの型はバッファをコピーしない）
+    - pandas_ms: グラフ・表に渡すため、必要な列だけをpandasに変換した時間
+
+    profile=True の場合は、実行したクエリのDuckDBのプロファイルも記録し、
+    スキャンした行数（rows_scanned）・バイト数（scan_bytes）とCPU時間（cpu_ms）を内訳に加える。
+    """
+
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.records: dict[str, dict] = {}
+        self.profiles: dict[str, dict] = {}
+
+    def _record(self, label: str, **values) -> None:
+        record = self.records.setdefault(
+            label,
+            {
+                "rows": None,
+                "cached": False,
+                "query_ms": None,
+                "convert_ms": None,
+                "pandas_ms": None,
+                "rows_scanned": None,
+                "scan_bytes": None,
+                "cpu_ms": None,
+            },
+        )
+        record.update(values)
+
+    def fetch(
+        self, con, query: str, label: str, params: list | None = None
+    ) -> pl.DataFrame:
+        """
+        クエリの結果をArrow形式で受け取り、Polarsのデータフレームとして返す。
+        """
+        profile: dict = {}
+        start = perf_counter()
+        if self.profile:
+            with duckdb_profile(con) as profile:
+                table = con.execute(query, params).arrow()
+        else:
+            table = con.execute(query, params).arrow()
+        fetched = perf_counter()
+        frame = pl.from_arrow(table)
+        converted = perf_counter()
+        self._record(
+            label,
+            rows=frame.height,
+            query_ms=(fetched - start) * 1000,
+            convert_ms=(converted - fetched) * 1000,
+            **profile_metrics(profile),
+        )
+        if profile:
+            self.profiles[label] = profile
+        return frame
+
+    def fetch_cached(
+        self,
+        cache: ResultCache,
+        key: str,
+        con,
+        query: str,
+        label: str,
+        params: list | None = None,
+    ) -> pl.DataFrame:
+        """
+        キャッシュされた結果を返し、なければクエリを実行して保存する。
+        """
+        frame = cache.get(key)
+        if isinstance(frame, pd.DataFrame):
+            # 以前のバージョンがpandasで永続化した結果
+            frame = pl.from_pandas(frame)
+        if frame is not None:
+            self._record(label, rows=frame.height, cached=True)
+            return frame
+        frame = self.fetch(con, query, label, params)
+        cache.put(key, frame)
+        return frame
+
+    def to_pandas(
+        self, frame: pl.DataFrame, label: str, columns: list[str] | None = None
+    ) -> pd.DataFrame:
+        """
+        Polarsのデータフレームの columns の列だけをpandasに変換する。
+        """
+        start = perf_counter()
+        converted = (frame.select(columns) if columns else frame).to_pandas()
+        self._record(label, pandas_ms=(perf_counter() - start) * 1000)
+        return converted
+
+    def summary(self) -> pl.DataFrame:
+        """
+        記録した内訳を1クエリ1行の表にする。
+        """
+        return pl.DataFrame(
+            [{"label": label, **record} for label, record in self.records.items()],
+            schema={
+                "label": pl.String,
+                "rows": pl.Int64,
+                "cached": pl.Boolean,
+                "query_ms": pl.Float64,
+                "convert_ms": pl.Float64,
+                "pandas_ms": pl.Float64,
+                "rows_scanned": pl.Int64,
+                "scan_bytes": pl.Int64,
+                "cpu_ms": pl.Float64,
+            },
+        )
+
+    def ranking(self) -> pl.DataFrame:
+        """
+        内訳の表に合計時間（total_ms）の列を加え、時間のかかった順に並べる。
+        """
+        return (
+            self.summary()
+            .with_columns(
+                pl.sum_horizontal("query_ms", "convert_ms", "pandas_ms").alias(
+                    "total_ms"
+                )
+            )
+            .sort("total_ms", descending=True)
+        )
+
+    def trace(self) -> str:
+        """
+        内訳とプロファイルをダウンロード用のJSONにする。
+        """
+        return trace_json(self.records, self.profiles)
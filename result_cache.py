@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Union
+
+import pandas as pd
+import polars as pl
+
+# キャッシュできる集計結果の型
+Frame = Union[pl.DataFrame, pd.DataFrame]
+
+# 永続化ファイルの拡張子（読み込み時に元の型へ戻すため、型ごとに分ける）
+FRAME_SUFFIXES = {pl.DataFrame: ".pl.parquet", pd.DataFrame: ".pd.parquet"}
+
+
+def dataset_fingerprint(files: list[Path]) -> str:
+    """
+    ファイル群のパス・サイズ・更新時刻からデータセットの指紋を作る。
+    ファイルが追加・更新・削除されると指紋が変わり、古いキャッシュは参照されなくなる。
+    """
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def normalize_part(part) -> str:
+    """
+    キーの要素を正規化する。文字列（SQLなど）は空白の違いを無視する。
+    """
+    if isinstance(part, str):
+        return " ".join(part.split())
+    return json.dumps(part, sort_keys=True, default=str, ensure_ascii=False)
+
+
+def result_key(fingerprint: str, *parts) -> str:
+    """
+    データセットの指紋と、クエリ・フィルタ条件からキャッシュのキーを作る。
+    """
+    digest = hashlib.sha1(fingerprint.encode("utf-8"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(normalize_part(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def frame_nbytes(frame: Frame) -> int:
+    if isinstance(frame, pl.DataFrame):
+        return int(frame.estimated_size())
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+class ResultCache:
+    """
+    集計結果をセッション間で共有するLRUキャッシュ。
+
+    メモリ上では max_bytes を上限に、最も長く参照されていない結果から破棄する。
+    persist_dir を指定した場合は結果をParquetとしても保存し、メモリから破棄された結果や
+    アプリの再起動後も再利用する（ディスク上も max_disk_bytes を上限に古いものから削除する）。
+    キーにはデータセットの指紋を含めるため、データが変わると自動的に無効になる。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 256 * 1024**2,
+        persist_dir: Path | None = None,
+        max_disk_bytes: int = 1024**3,
+    ):
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries: OrderedDict[str, tuple[Frame, int]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.persist_dir is not None:
+            self.persist_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Frame | None:
+        """
+        キャッシュされた結果を返す。存在しない場合はNoneを返す。
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self._copy(entry[0])
+        frame = self._read_persisted(key)
+        with self.lock:
+            if frame is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(key, frame)
+        return self._copy(frame)
+
+    def contains(self, key: str) -> bool:
+        """
+        結果がキャッシュされているかを返す（参照回数や破棄の順序には影響しない）。
+        """
+        with self.lock:
+            if key in self.entries:
+                return True
+        if self.persist_dir is None:
+            return False
+        return any(
+            (self.persist_dir / f"{key}{suffix}").exists()
+            for suffix in FRAME_SUFFIXES.values()
+        )
+
+    def put(self, key: str, frame: Frame) -> None:
+        """
+        結果をキャッシュに保存する。
+        """
+        with self.lock:
+            self._insert(key, frame)
+        if self.persist_dir is not None:
+            self._persist(key, frame)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Frame]) -> Frame:
+        """
+        キャッシュされた結果を返し、なければ compute で計算して保存する。
+        """
+        frame = self.get(key)
+        if frame is None:
+            frame = compute()
+            self.put(key, frame)
+            frame = self._copy(frame)
+        return frame
+
+    @staticmethod
+    def _copy(frame: Frame) -> Frame:
+        # pandasのDataFrameは呼び出し側で変更されうるため、コピーを返す
+        if isinstance(frame, pd.DataFrame):
+            return frame.copy()
+        return frame
+
+    def _insert(self, key: str, frame: Frame) -> None:
+        nbytes = frame_nbytes(frame)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (frame, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def _read_persisted(self, key: str) -> Frame | None:
+        if self.persist_dir is None:
+            return None
+        for frame_type, suffix in FRAME_SUFFIXES.items():
+            path = self.persist_dir / f"{key}{suffix}"
+            try:
+                if frame_type is pl.DataFrame:
+                    frame = pl.read_parquet(path)
+                else:
+                    frame = pd.read_parquet(path)
+            except (FileNotFoundError, OSError):
+                continue
+            # 参照されたファイルは削除の対象から遠ざける
+            os.utime(path)
+            return frame
+        return None
+
+    def _persist(self, key: str, frame: Frame) -> None:
+        path = self.persist_dir / f"{key}{FRAME_SUFFIXES[type(frame)]}"
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            if isinstance(frame, pl.DataFrame):
+                frame.write_parquet(tmp_path)
+            else:
+                frame.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        self._evict_persisted()
+
+    def _evict_persisted(self) -> None:
+        files = []
+        for path in self.persist_dir.glob("*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
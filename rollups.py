@@ -0,0 +1,139 @@
+import polars as pl
+
+from approximate import ci_expr
+
+# ロールアップの最小の時間粒度
+BASE_GRAIN = "1h"
+
+# 粒度ごとに、どの粒度のロールアップから導出するか
+# 週・月は日次から導出する（週の開始は月曜日で、日の境界と揃っている）
+PYRAMID = {"1d": BASE_GRAIN, "1w": "1d", "1mo": "1d"}
+
+# 上位カテゴリ以外をまとめるグループ名
+OTHER_LABEL = "Other"
+
+
+def hourly_rollup(
+    lf: pl.LazyFrame, keys: list[str], aggs: list[pl.Expr], time_col: str = "EVENT_TIME"
+) -> pl.LazyFrame:
+    """
+    1時間単位 × keys ごとの集計（ロールアップの最下層）を求める。
+    aggs には件数・合計など、グループについて加法的な集計だけを指定する。
+    """
+    return (
+        lf.with_columns(pl.col(time_col).dt.truncate(BASE_GRAIN).alias("time_agg"))
+        .group_by(["time_agg", *keys])
+        .agg(aggs)
+    )
+
+
+def roll_up(rollup: pl.DataFrame, every: str, keys: list[str]) -> pl.DataFrame:
+    """
+    ロールアップの時間粒度を every に粗くする。keys 以外の列は合計する。
+    """
+    measures = [c for c in rollup.columns if c not in ["time_agg", *keys]]
+    return (
+        rollup.with_columns(pl.col("time_agg").dt.truncate(every))
+        .group_by(["time_agg", *keys])
+        .agg(pl.sum(c) for c in measures)
+    )
+
+
+class RollupPyramid:
+    """
+    1時間単位のロールアップから、日・週・月単位のロールアップを導出する。
+
+    生データを集計し直さず、細かい粒度のロールアップ（行数は時間 × キーの組み合わせ数）から
+    粗い粒度を求める。導出した粒度は保持し、同じ粒度は再計算しない。
+    """
+
+    def __init__(self, hourly: pl.DataFrame, keys: list[str]):
+        self.keys = keys
+        self.levels: dict[str, pl.DataFrame] = {BASE_GRAIN: hourly}
+
+    def level(self, every: str) -> pl.DataFrame:
+        """
+        every（"1h", "1d", "1w", "1mo"）単位のロールアップを返す。
+        """
+        if every not in self.levels:
+            source = self.level(PYRAMID.get(every, BASE_GRAIN))
+            self.levels[every] = roll_up(source, every, self.keys)
+        return self.levels[every]
+
+
+def rank_categories(
+    rollup: pl.DataFrame, category: str, value_col: str, label: str, limit: int = 100
+) -> pl.DataFrame:
+    """
+    ロールアップを期間全体で合計し、value_col の大きい順にカテゴリの上位 limit 件を返す。
+    value_col の分散の列（value_col_var）があれば、95%信頼区間の列「label (±95%)」を加える。
+    """
+    var_col = f"{value_col}_var"
+    aggs = [pl.sum(value_col).alias(label)]
+    if var_col in rollup.columns:
+        aggs.append(pl.sum(var_col))
+    ranked = rollup.group_by(category).agg(aggs)
+    if var_col in rollup.columns:
+        ranked = ranked.with_columns(ci_expr(var_col).alias(f"{label} (±95%)")).drop(
+            var_col
+        )
+    return ranked.sort(label, descending=True).head(limit)
+
+
+def top_n_other(
+    rollup: pl.DataFrame, category: str, top_cats: list, value_col: str
+) -> pl.DataFrame:
+    """
+    上位カテゴリ（top_cats）以外を "Other" にまとめ、時間 × カテゴリグループごとに合計する。
+    value_col の分散の列があれば、95%信頼区間の半幅を「value_col_ci」列として加える。
+    """
+    var_col = f"{value_col}_var"
+    measures = [value_col] + ([var_col] if var_col in rollup.columns else [])
+    regrouped = (
+        rollup.with_columns(
+            pl.when(pl.col(category).is_in(top_cats))
+            .then(pl.col(category))
+            .otherwise(pl.lit(OTHER_LABEL))
+            .alias("category_group")
+        )
+        .group_by(["time_agg", "category_group"])
+        .agg(pl.sum(c) for c in measures)
+    )
+    if var_col in rollup.columns:
+        regrouped = regrouped.with_columns(ci_expr(var_col).alias(f"{value_col}_ci"))
+    return regrouped.sort("time_agg", "category_group")
+
+
+def weekday_hour(rollup: pl.DataFrame, value_col: str) -> pl.DataFrame:
+    """
+    1時間単位のロールアップを、曜日（day_of_week、月曜:1〜日曜:7）× 時間帯（hour_of_day）
+    ごとに合計する。曜日と時間帯は1時間単位の時刻から決まるため、生データを集計し直さずに求まる。
+    """
+    return (
+        rollup.group_by(
+            pl.col("time_agg").dt.weekday().alias("day_of_week"),
+            pl.col("time_agg").dt.hour().alias("hour_of_day"),
+        )
+        .agg(pl.sum(value_col))
+        .sort("day_of_week", "hour_of_day")
+    )
+
+
+def category_ratio(
+    rollup: pl.DataFrame,
+    category: str,
+    cats: list,
+    part_col: str,
+    total_col: str,
+    ratio_col: str,
+) -> pl.DataFrame:
+    """
+    ロールアップを期間全体で合計し、カテゴリ（cats に含まれるもの）ごとの
+    part_col / total_col の比率を ratio_col 列として返す。
+    """
+    return (
+        rollup.filter(pl.col(category).is_in(cats))
+        .group_by(category)
+        .agg(pl.sum(total_col), pl.sum(part_col))
+        .with_columns((pl.col(part_col) / pl.col(total_col)).alias(ratio_col))
+    )
@@ -0,0 +1,69 @@
+import random
+
+import polars as pl
+
+# サンプルの層（この列の値の組み合わせごとに行数を揃える）
+SAMPLE_STRATA = ["is_fraud", "event_month"]
+
+# 各行に付与する乱数キーの列名（サンプルを後から結合するために保存する）
+SAMPLE_KEY_COL = "_sample_key"
+
+
+class StratifiedReservoir:
+    """
+    層ごとに最大 size 行を一様に無作為抽出して保持するリザーバサンプル。
+
+    各行に64ビットの乱数キーを付け、層ごとにキーの小さい size 行だけを残す（bottom-k）。
+    キーの小さい順に残すという規則は結合しても変わらないため、ファイル・バッチ・
+    ワーカーごとのサンプルを後から merge しても、全体から抽出したサンプルと同じ分布になる。
+    """
+
+    def __init__(
+        self,
+        size: int,
+        strata: list[str] | None = None,
+        dedup_key: list[str] | None = None,
+        seed: int | None = None,
+    ):
+        self.size = size
+        self.strata = strata or SAMPLE_STRATA
+        self.dedup_key = dedup_key or []
+        self.rng = random.Random(seed)
+        self.sample: pl.DataFrame | None = None
+
+    def add(self, lf: pl.LazyFrame) -> None:
+        """
+        新しい行をサンプルの候補に加える。入力は1回だけスキャンされ、
+        層ごとに上位 size 行だけが集計結果として返るため、メモリはサンプルの大きさで済む。
+        """
+        keyed = lf.with_columns(
+            pl.int_range(pl.len(), dtype=pl.UInt64)
+            .hash(self.rng.getrandbits(32))
+            .alias(SAMPLE_KEY_COL)
+        )
+        self.merge(self._bottom_k(keyed).collect())
+
+    def merge(self, other: pl.DataFrame | None) -> None:
+        """
+        乱数キー付きの別のサンプル（保存済みのサンプルなど）を結合する。
+        """
+        if other is None or other.is_empty():
+            return
+        if self.sample is None:
+            self.sample = other
+            return
+        combined = pl.concat([self.sample, other], how="diagonal_relaxed")
+        if self.dedup_key:
+            # 同じキーの行は新しい方を残す
+            combined = combined.unique(
+                subset=self.dedup_key, keep="last", maintain_order=True
+            )
+        self.sample = self._bottom_k(combined.lazy()).collect()
+
+    def _bottom_k(self, lf: pl.LazyFrame) -> pl.LazyFrame:
+        return lf.filter(
+            pl.col(SAMPLE_KEY_COL).rank("ordinal").over(self.strata) <= self.size
+        )
+
+    def is_empty(self) -> bool:
+        return self.sample is None or self.sample.is_empty()
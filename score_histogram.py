@@ -0,0 +1,131 @@
+import polars as pl
+
+
+def score_counts_query(source: str, score: str = "SCORE", label: str = "is_fraud") -> str:
+    """
+    スコアの値ごとに、正例（label が真）と負例（label が偽）の件数を求めるクエリ。
+    結果の列は score, positives, negatives（スコアの昇順）。
+    整数のスコアであれば、行数によらず結果はスコアの値の種類数（数千行程度）になる。
+    """
+    return f"""
+        SELECT
+            {score} AS score,
+            COUNT(*) FILTER (WHERE {label}) AS positives,
+            COUNT(*) FILTER (WHERE NOT {label}) AS negatives
+        FROM {source}
+        WHERE {score} IS NOT NULL
+        GROUP BY ALL
+        ORDER BY ALL
+    """
+
+
+def score_counts(
+    frame: pl.DataFrame | pl.LazyFrame,
+    score: str = "SCORE",
+    label: str = "is_fraud",
+    weight: str | None = None,
+) -> pl.DataFrame:
+    """
+    score_counts_query と同じ集計をPolarsの DataFrame / LazyFrame に対して行う。
+    weight を指定した場合は、行数の代わりにその列（集計済みの件数など）を合計する。
+    """
+    if weight is None:
+        positives = pl.col(label).sum()
+        negatives = (~pl.col(label)).sum()
+    else:
+        positives = pl.col(weight).filter(pl.col(label)).sum()
+        negatives = pl.col(weight).filter(~pl.col(label)).sum()
+    return (
+        frame.lazy()
+        .filter(pl.col(score).is_not_null())
+        .group_by(pl.col(score).alias("score"))
+        .agg(
+            positives.cast(pl.Int64).alias("positives"),
+            negatives.cast(pl.Int64).alias("negatives"),
+        )
+        .sort("score")
+        .collect()
+    )
+
+
+class ScoreHistogram:
+    """
+    スコアの値ごとの正例・負例の件数（score_counts_query の結果）から、
+    任意の閾値・スコア調整値の混合行列とヒストグラムを求める。
+
+    「調整後スコア（score + adjustment）が閾値以上なら陽性」は
+    「score が threshold - adjustment 以上なら陽性」と同じため、スコアの累積件数を
+    二分探索するだけで求まり、データを集計し直す必要がない。
+    """
+
+    def __init__(self, counts: pl.DataFrame):
+        self.counts = counts.sort("score")
+        self.scores = self.counts["score"]
+        # 各スコア未満の累積件数（先頭に0を置く）
+        self.positives_below = pl.concat(
+            [pl.Series([0]), self.counts["positives"].cum_sum()]
+        )
+        self.negatives_below = pl.concat(
+            [pl.Series([0]), self.counts["negatives"].cum_sum()]
+        )
+        self.total_positives = int(self.positives_below[-1])
+        self.total_negatives = int(self.negatives_below[-1])
+
+    def confusion(self, threshold: float, adjustment: float = 0) -> dict[str, int]:
+        """
+        調整後スコアが threshold 以上を陽性と予測した場合の tp, fp, tn, fn を返す。
+        """
+        index = int(self.scores.search_sorted(threshold - adjustment, side="left"))
+        fn = int(self.positives_below[index])
+        tn = int(self.negatives_below[index])
+        return {
+            "tp": self.total_positives - fn,
+            "fp": self.total_negatives - tn,
+            "tn": tn,
+            "fn": fn,
+        }
+
+    def binned(self, bins: int = 100, label: str = "is_fraud") -> pl.DataFrame:
+        """
+        スコアを bins 個の等幅のビンに分けた件数を、histogram_query と同じ列
+        （label, bin, bin_start, bin_end, count。件数0のビンは含まない）で返す。
+        調整後スコアのビンは、ビンの位置を調整値だけずらせばよい。
+        """
+        if self.counts.is_empty():
+            return pl.DataFrame(
+                schema={
+                    label: pl.Boolean,
+                    "bin": pl.Int32,
+                    "bin_start": pl.Float64,
+                    "bin_end": pl.Float64,
+                    "count": pl.Int64,
+                }
+            )
+        lo = float(self.scores.min())
+        hi = float(self.scores.max())
+        width = (hi - lo) / bins if hi > lo else 1.0
+        return (
+            self.counts.with_columns(
+                ((pl.col("score") - lo) / width)
+                .floor()
+                .clip(0, bins - 1)
+                .cast(pl.Int32)
+                .alias("bin")
+            )
+            .unpivot(
+                index="bin",
+                on=["positives", "negatives"],
+                variable_name=label,
+                value_name="count",
+            )
+            .with_columns(pl.col(label) == "positives")
+            .group_by(label, "bin")
+            .agg(pl.sum("count").cast(pl.Int64))
+            .filter(pl.col("count") > 0)
+            .with_columns(
+                (lo + pl.col("bin") * width).alias("bin_start"),
+                (lo + (pl.col("bin") + 1) * width).alias("bin_end"),
+            )
+            .select(label, "bin", "bin_start", "bin_end", "count")
+            .sort(label, "bin")
+        )
@@ -0,0 +1,94 @@
+import polars as pl
+
+from query_builder import quote_ident
+from threshold_sweep import with_metrics
+
+# 全ての分析軸をまとめたセグメント（全体）の名前
+ALL_SEGMENTS = "（全体）"
+
+
+def segment_score_counts_query(
+    source: str, dims: list[str], score: str = "SCORE", label: str = "is_fraud"
+) -> str:
+    """
+    分析軸 dims の値の全ての組み合わせ（CUBE。一部の軸だけの組み合わせと全体を含む）について、
+    スコアの値ごとの正例・負例の件数を1回の集計で求めるクエリ。
+    結果の列は grouping_id, dims..., score, positives, negatives。
+    grouping_id は GROUPING(dims...) の値で、まとめた（値を区別しない）軸のビットが立つ
+    （先頭の軸が最上位のビット）。まとめた軸の値は NULL になる。
+    """
+    columns = ", ".join(quote_ident(d) for d in dims)
+    return f"""
+        SELECT
+            GROUPING({columns}) AS grouping_id,
+            {columns},
+            {score} AS score,
+            COUNT(*) FILTER (WHERE {label}) AS positives,
+            COUNT(*) FILTER (WHERE NOT {label}) AS negatives
+        FROM {source}
+        WHERE {score} IS NOT NULL
+        GROUP BY CUBE({columns}), {score}
+    """
+
+
+def segment_name(grouping_id: int, dims: list[str]) -> str:
+    """
+    grouping_id から、セグメントを区別している軸の名前（「a × b」など）を返す。
+    """
+    grouped = [
+        dim
+        for i, dim in enumerate(dims)
+        if not grouping_id & (1 << (len(dims) - 1 - i))
+    ]
+    return " × ".join(grouped) or ALL_SEGMENTS
+
+
+def segment_metrics(
+    counts: pl.DataFrame,
+    dims: list[str],
+    threshold: float,
+    adjustment: float = 0,
+    fp_cost: float = 1.0,
+    fn_cost: float = 1.0,
+) -> pl.DataFrame:
+    """
+    segment_score_counts_query の結果から、調整後スコアが threshold 以上を陽性と
+    予測した場合のセグメントごとの混合行列と評価指標を求める。
+    件数はスコアの値ごとに集計済みのため、閾値・調整値を変えてもデータを集計し直さない。
+    """
+    predicted = pl.col("score") >= threshold - adjustment
+    keys = ["grouping_id", *dims]
+    confusion = counts.group_by(keys).agg(
+        pl.col("positives").filter(predicted).sum().alias("tp"),
+        pl.col("negatives").filter(predicted).sum().alias("fp"),
+        pl.col("negatives").filter(~predicted).sum().alias("tn"),
+        pl.col("positives").filter(~predicted).sum().alias("fn"),
+    )
+    total = pl.col("tp") + pl.col("fp") + pl.col("tn") + pl.col("fn")
+    return (
+        with_metrics(confusion, fp_cost, fn_cost)
+        .with_columns(
+            pl.col("grouping_id")
+            .map_elements(lambda g: segment_name(g, dims), return_dtype=pl.String)
+            .alias("segment"),
+            total.alias("count"),
+            ((pl.col("tp") + pl.col("fn")) / total).alias("fraud_rate"),
+        )
+        # 全体、軸の少ない組み合わせの順に、件数の多いセグメントから並べる
+        .sort(["grouping_id", "count"], descending=True)
+        .select(
+            "segment",
+            *dims,
+            "count",
+            "fraud_rate",
+            "tp",
+            "fp",
+            "tn",
+            "fn",
+            "precision",
+            "recall",
+            "fpr",
+            "f1",
+            "cost",
+        )
+    )
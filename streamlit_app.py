@@ -1,35 +1,96 @@
+import json
+import os
 from pathlib import Path
 
 import plotly.express as px
 import polars as pl
 import streamlit as st
 
+from approximate import (
+    SAMPLE_FRACTIONS,
+    estimate_aggs,
+    fraction_label,
+    sample_lazy,
+)
+from dataset import (
+    SAMPLE_NAME,
+    HiveDataset,
+    day_range,
+    list_data_files,
+    load_sample,
+    partition_predicate,
+    time_range_expr,
+)
+from query_budget import QueryTimeout, timeout_from_env
+from query_planner import QueryPlanner
+from query_profiler import format_polars_profile, polars_profile_ranking
+from result_cache import ResultCache, dataset_fingerprint
+from rollups import RollupPyramid, hourly_rollup, rank_categories, top_n_other
+
 # --- 時間集計単位の定数 ---
 TIME_AGG_OPTIONS = {"月次": "1mo", "週次": "1w", "日次": "1d"}
 
 
 # --- データ読み込みとキャッシュ ---
 @st.cache_data
-def load_lazy_data(selected_files: list[Path]) -> pl.LazyFrame:
+def load_lazy_data(selected_files: list[Path], data_dir: Path) -> pl.LazyFrame:
     """
     指定されたParquetファイルを遅延読み込みし、結合する。
+    Hive形式で分割されている場合は、パーティション列をディレクトリ名から読み込む。
     """
     if not selected_files:
         st.warning("データソースを1つ以上選択してください。")
         return pl.LazyFrame()
 
     try:
-        lf_list = [pl.scan_parquet(file) for file in selected_files]
-        full_lf = pl.concat(lf_list)
-        return full_lf
+        return HiveDataset(selected_files, data_dir).scan_polars()
     except Exception as e:
         st.error(f"データの読み込み中にエラーが発生しました: {e}")
         return pl.LazyFrame()
 
 
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    """
+    全セッションで共有する集計結果のキャッシュを生成する。
+    環境変数 RESULT_CACHE_DIR を設定すると、結果をParquetとしてディスクにも保存する。
+    """
+    persist_dir = os.environ.get("RESULT_CACHE_DIR")
+    return ResultCache(persist_dir=Path(persist_dir) if persist_dir else None)
+
+
 # --- メインアプリケーション ---
 st.set_page_config(layout="wide")
 
+# この描画で実行した集計のプロファイル。記録するかのチェックボックスは
+# サイドバーの末尾に表示するため、値はセッション状態から読む
+profile_queries = st.session_state.get("profile_queries", False)
+profiles: dict[str, dict] = {}
+
+# 集計1回あたりの時間の予算（秒）
+query_timeout = timeout_from_env()
+
+
+def execute_planner(planner: QueryPlanner) -> dict[str, pl.DataFrame]:
+    """
+    プランナーの集計を実行する。待っている間は経過時間を表示する。
+    表示の更新で再実行の要求が確認されるため、新しい再実行に置き換えられた描画の
+    集計はここで取り消される。時間の予算を超えた場合は QueryTimeout を送出する。
+    """
+    status = st.empty()
+    shown = [0]
+
+    def on_wait(elapsed: float) -> None:
+        # 表示は1秒ごとに更新する
+        if int(elapsed) > shown[0]:
+            shown[0] = int(elapsed)
+            status.caption(f"集計中…（{shown[0]}秒経過）")
+
+    try:
+        return planner.execute(query_timeout, on_wait)
+    finally:
+        status.empty()
+
 # --- カスタムCSSでサイドバーの幅を調整 ---
 st.markdown(
     """
@@ -53,7 +114,7 @@ data_dir = Path(input_dir)
 
 if data_dir.exists() and data_dir.is_dir():
     # .parquetファイルを再帰的に検索
-    available_files = sorted(list(data_dir.glob("**/*.parquet")))
+    available_files = list_data_files(data_dir)
     # data_dirからの相対パスを生成
     available_filenames = [str(f.relative_to(data_dir)) for f in available_files]
 
@@ -68,12 +129,59 @@ else:
     st.sidebar.warning(f"`{input_dir}` ディレクトリが見つかりません。")
     selected_files_paths = []
 
+# パーティションフィルタ: Hive形式で分割されたデータは、ディレクトリ単位で読み込むファイルを絞り込む
+dataset = HiveDataset(selected_files_paths, data_dir)
+if dataset.partition_columns:
+    st.sidebar.subheader("パーティションフィルタ")
+    partition_selections = {}
+    for column in dataset.partition_columns:
+        values = dataset.partition_values(column)
+        partition_selections[column] = st.sidebar.multiselect(
+            f"{column}（パーティション）", options=values, default=values, format_func=str
+        )
+    dataset = dataset.prune(partition_predicate(dataset, partition_selections))
+    st.sidebar.caption(
+        f"読み込むファイル: {len(dataset.files)} / {len(selected_files_paths)}"
+    )
+    selected_files_paths = dataset.files
+
+# 期間フィルタ: 範囲外の月パーティション・ファイルは読み込まず、
+# 残りのファイルでも EVENT_TIME の条件をスキャンに押し下げて範囲外の行グループを読み飛ばす
+time_range = None
+time_bounds = dataset.time_bounds()
+if time_bounds:
+    min_date, max_date = time_bounds[0].date(), time_bounds[1].date()
+    selected_dates = st.sidebar.date_input(
+        "期間 (EVENT_TIME)",
+        value=(min_date, max_date),
+        min_value=min_date,
+        max_value=max_date,
+    )
+    if len(selected_dates) == 2 and tuple(selected_dates) != (min_date, max_date):
+        time_range = day_range(*selected_dates)
+        dataset = dataset.prune_time_range(*time_range)
+        st.sidebar.caption(
+            f"期間内のファイル: {len(dataset.files)} / {len(selected_files_paths)}"
+        )
+        selected_files_paths = dataset.files
+
+# プレビューモード: 取り込み時に作成した層別サンプルのみを使い、即座に表示する
+preview_mode = (data_dir / SAMPLE_NAME).exists() and st.sidebar.checkbox(
+    "プレビューモード（層別サンプルのみ使用）",
+    help="is_fraud × event_month ごとに抽出したサンプルで集計します。件数は全体の件数ではありません。",
+)
+
 # データの読み込み
-if selected_files_paths:
-    lf = load_lazy_data(selected_files_paths)
+if preview_mode:
+    lf = load_sample(data_dir).lazy()
+elif selected_files_paths:
+    lf = load_lazy_data(selected_files_paths, data_dir)
 else:
     lf = pl.LazyFrame()
 
+if time_range and len(lf.columns) > 0:
+    lf = lf.filter(time_range_expr(*time_range))
+
 
 if len(lf.columns) > 0:
     # 2. 集計カテゴリ列の選択
@@ -104,18 +212,7 @@ if len(lf.columns) > 0:
     )
     time_agg_unit = TIME_AGG_OPTIONS[time_agg_label]
 
-    # --- フィルタ設定 ---
-    st.sidebar.header("フィルタ設定")
-
-    # is_fraud フラグのフィルタ
-    fraud_options = (
-        lf.select("is_fraud").unique().collect().get_column("is_fraud").sort().to_list()
-    )
-    selected_fraud = st.sidebar.multiselect(
-        "不正フラグ (is_fraud)", options=fraud_options, default=fraud_options
-    )
-
-    # スコア閾値の入力
+    # スコア閾値の入力（ページの集計の粒度に含めるため、フィルタより先に決める）
     st.sidebar.subheader("スコアレベル設定")
     threshold_low = st.sidebar.number_input("低リスクの上限スコア", value=1000, step=1)
     threshold_mid = st.sidebar.number_input("中リスクの上限スコア", value=1500, step=1)
@@ -134,41 +231,166 @@ if len(lf.columns) > 0:
         .alias("score_level")
     )
 
+    # 近似モード: サンプルから推定した結果を先に表示し、全データの確定値で置き換える
+    approx_label = st.sidebar.selectbox(
+        "近似モード（サンプルで先に表示）",
+        options=["オフ", *SAMPLE_FRACTIONS],
+        help="固定シードのサンプルから推定した集計を先に表示し、全データの集計が終わり次第置き換えます。",
+    )
+    approx_fraction = SAMPLE_FRACTIONS.get(approx_label)
+
+    # --- ページの集計 ---
+    # カテゴリ × 1時間 × フィルタ列の粒度で1回だけスキャンしてロールアップを作り、
+    # 選択された時間集計単位の集計・フィルタの選択肢・サマリー表・グラフはそこから導出する。
+    # ロールアップは時間集計単位によらないため、単位を切り替えてもデータを再スキャンしない
+    group_keys = ([agg_col] if agg_col else []) + ["is_fraud", "score_level"]
+
+    def build_planner(fraction: float) -> QueryPlanner:
+        """
+        ページの集計を登録したプランナーを作る。
+        fraction < 1 の場合は、その率のサンプルから件数・合計とその分散を推定する。
+        """
+        planner = QueryPlanner(
+            cache=get_result_cache(),
+            fingerprint=dataset_fingerprint(
+                [data_dir / SAMPLE_NAME] if preview_mode else selected_files_paths
+            ),
+            profile=profile_queries,
+        )
+        planner.add(
+            "rollup",
+            hourly_rollup(
+                sample_lazy(lf_with_score_level, fraction),
+                group_keys,
+                estimate_aggs(
+                    fraction, "record_count", {"event_value_sum": "EVENT_VALUE"}
+                ),
+            ),
+        )
+        planner.derive(
+            "base",
+            lambda r: RollupPyramid(r["rollup"], group_keys).level(time_agg_unit),
+        )
+        planner.derive(
+            "fraud_options",
+            lambda r: r["base"].select(pl.col("is_fraud").unique().sort()),
+        )
+        return planner
+
+    passes = [(1.0, build_planner(1.0))]
+    if approx_fraction and not passes[0][1].is_cached():
+        # 確定値がキャッシュされていなければ、先にサンプルで集計する
+        passes.insert(0, (approx_fraction, build_planner(approx_fraction)))
+    try:
+        results = execute_planner(passes[0][1])
+    except QueryTimeout as e:
+        # 時間の予算内に終わらなければ、最小のサンプル率の近似値で代替する
+        fallback_fraction = min(SAMPLE_FRACTIONS.values())
+        if passes[0][0] <= fallback_fraction:
+            st.error(f"{e}。条件を絞り込んでください。")
+            st.stop()
+        st.warning(
+            f"{e}。代わりに{fraction_label(fallback_fraction)}を表示します。"
+        )
+        passes = [(fallback_fraction, build_planner(fallback_fraction))]
+        try:
+            results = execute_planner(passes[0][1])
+        except QueryTimeout as e:
+            st.error(f"近似値の{e}。条件を絞り込んでください。")
+            st.stop()
+
+    # --- フィルタ設定 ---
+    st.sidebar.header("フィルタ設定")
+
+    # is_fraud フラグのフィルタ
+    fraud_options = results["fraud_options"].get_column("is_fraud").to_list()
+    selected_fraud = st.sidebar.multiselect(
+        "不正フラグ (is_fraud)", options=fraud_options, default=fraud_options
+    )
+
     # score_levelのフィルタ
     level_options = ["Low", "Mid", "High"]
     selected_levels = st.sidebar.multiselect(
         "スコアレベル (動的)", options=level_options, default=level_options
     )
 
-    # --- データのフィルタリング ---
-    filtered_lf = lf_with_score_level.filter(
-        (pl.col("is_fraud").is_in(selected_fraud))
-        & (pl.col("score_level").is_in(selected_levels))
-    )
-
     # --- メインコンテンツ ---
     if agg_col:
         st.header(f"`{agg_col}`別 サマリー")
 
-        # ここで計算を実行
-        top_by_count = (
-            filtered_lf.group_by(agg_col)
-            .agg(pl.len().alias("レコード数"))
-            .sort("レコード数", descending=True)
-            .head(100)
-            .collect()
-        )
-        top_by_value = (
-            filtered_lf.group_by(agg_col)
-            .agg(pl.sum("EVENT_VALUE").alias("EVENT_VALUE合計"))
-            .sort("EVENT_VALUE合計", descending=True)
-            .head(100)
-            .collect()
-        )
+        # --- 集計用ヘルパー関数 ---
+        def top_categories(top_df: pl.DataFrame) -> list:
+            return top_df.head(top_n)[agg_col].to_list()
+
+        def add_page_aggregates(planner: QueryPlanner) -> None:
+            """
+            サマリー表とグラフの集計を、ページの集計（base）からの導出として登録する。
+            """
+            # データのフィルタリング（集計結果に対して行う）
+            planner.derive(
+                "filtered",
+                lambda r: r["base"].filter(
+                    (pl.col("is_fraud").is_in(selected_fraud))
+                    & (pl.col("score_level").is_in(selected_levels))
+                ),
+            )
+            planner.derive(
+                "top_by_count",
+                lambda r: rank_categories(
+                    r["filtered"], agg_col, "record_count", "レコード数"
+                ),
+            )
+            planner.derive(
+                "top_by_value",
+                lambda r: rank_categories(
+                    r["filtered"], agg_col, "event_value_sum", "EVENT_VALUE合計"
+                ),
+            )
+            planner.derive(
+                "summary_by_count",
+                lambda r: top_n_other(
+                    r["filtered"],
+                    agg_col,
+                    top_categories(r["top_by_count"]),
+                    "record_count",
+                ),
+            )
+            planner.derive(
+                "summary_by_value",
+                lambda r: top_n_other(
+                    r["filtered"],
+                    agg_col,
+                    top_categories(r["top_by_value"]),
+                    "event_value_sum",
+                ),
+            )
+
+        def render_results(
+            results: dict[str, pl.DataFrame], planner: QueryPlanner, fraction: float
+        ) -> None:
+            """
+            サマリー表とトレンドグラフを表示する。
+            近似値（fraction < 1）の場合は、表に信頼区間の列を、グラフに誤差棒を付ける。
+            """
+            approximate = fraction < 1
+            if approximate:
+                st.warning(f"{fraction_label(fraction)}。確定値を集計中です…")
+            elif approx_fraction:
+                st.caption(fraction_label(fraction))
+            st.caption(
+                f"{planner.query_count}件の集計を{planner.scans}回のデータスキャンで実行しました"
+                f"（{planner.scans_saved}回のスキャンを削減、キャッシュヒット{planner.cache_hits}件）。"
+            )
+
+            top_by_count = results["top_by_count"]
+            top_by_value = results["top_by_value"]
+            if not approximate:
+                top_by_count = top_by_count.drop("レコード数 (±95%)")
+                top_by_value = top_by_value.drop("EVENT_VALUE合計 (±95%)")
+            if top_by_count.is_empty():
+                st.warning("選択された条件に一致するデータがありません。")
+                return
 
-        if top_by_count.is_empty():
-            st.warning("選択された条件に一致するデータがありません。")
-        else:
             col1, col2 = st.columns(2)
             with col1:
                 st.subheader("レコード数 トップ100")
@@ -178,6 +400,7 @@ if len(lf.columns) > 0:
                         "レコード数": st.column_config.NumberColumn(format="localized")
                     },
                     use_container_width=True,
+                    key=f"top_by_count_{fraction}",
                 )
             with col2:
                 st.subheader("EVENT_VALUE合計 トップ100")
@@ -187,49 +410,18 @@ if len(lf.columns) > 0:
                         "EVENT_VALUE合計": st.column_config.NumberColumn(format="yen")
                     },
                     use_container_width=True,
+                    key=f"top_by_value_{fraction}",
                 )
 
             st.header(f"{time_agg_label}トレンド分析")
 
-            # --- 集計用ヘルパー関数 ---
-            def aggregate_for_chart(
-                lf: pl.LazyFrame,
-                agg_col: str,
-                top_cats: list,
-                time_agg_unit: str,
-                value_col: str = None,
-                value_alias: str = None,
-            ) -> pl.DataFrame:
-                df = lf.with_columns(
-                    pl.when(pl.col(agg_col).is_in(top_cats))
-                    .then(pl.col(agg_col))
-                    .otherwise(pl.lit("Other"))
-                    .alias("category_group"),
-                    pl.col("EVENT_TIME").dt.truncate(time_agg_unit).alias("time_agg"),
-                )
-                if value_col and value_alias:
-                    agg_expr = pl.sum(value_col).alias(value_alias)
-                else:
-                    agg_expr = pl.len().alias("record_count")
-                return (
-                    df.group_by(["time_agg", "category_group"])
-                    .agg(agg_expr)
-                    .sort("time_agg")
-                    .collect()
-                )
-
             # --- グラフ1: レコード数 ---
-            top_n_by_count_cats = top_by_count.head(top_n)[agg_col].to_list()
-            summary_by_count = aggregate_for_chart(
-                filtered_lf,
-                agg_col,
-                top_n_by_count_cats,
-                time_agg_unit,
-            )
+            top_n_by_count_cats = top_categories(top_by_count)
             fig1 = px.bar(
-                summary_by_count,
+                results["summary_by_count"],
                 x="time_agg",
                 y="record_count",
+                error_y="record_count_ci" if approximate else None,
                 color="category_group",
                 title=f"{time_agg_label}レコード数（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
@@ -242,22 +434,17 @@ if len(lf.columns) > 0:
             fig1.update_traces(
                 hovertemplate="<b>%{x}</b><br>カテゴリ: %{fullData.name}<br>レコード数: %{y}<extra></extra>"
             )
-            st.plotly_chart(fig1, use_container_width=True)
+            st.plotly_chart(
+                fig1, use_container_width=True, key=f"summary_by_count_{fraction}"
+            )
 
             # --- グラフ2: イベント価値合計 ---
-            top_n_by_value_cats = top_by_value.head(top_n)[agg_col].to_list()
-            summary_by_value = aggregate_for_chart(
-                filtered_lf,
-                agg_col,
-                top_n_by_value_cats,
-                time_agg_unit,
-                value_col="EVENT_VALUE",
-                value_alias="event_value_sum",
-            )
+            top_n_by_value_cats = top_categories(top_by_value)
             fig2 = px.bar(
-                summary_by_value,
+                results["summary_by_value"],
                 x="time_agg",
                 y="event_value_sum",
+                error_y="event_value_sum_ci" if approximate else None,
                 color="category_group",
                 title=f"{time_agg_label}イベント価値合計（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
@@ -270,9 +457,52 @@ if len(lf.columns) > 0:
             fig2.update_traces(
                 hovertemplate="<b>%{x}</b><br>カテゴリ: %{fullData.name}<br>価値合計: ¥%{y:,.0f}<extra></extra>"
             )
-            st.plotly_chart(fig2, use_container_width=True)
+            st.plotly_chart(
+                fig2, use_container_width=True, key=f"summary_by_value_{fraction}"
+            )
+
+        # 近似値を先に表示し、確定値の集計が終わったら同じ場所を置き換える。
+        # 集計中にウィジェットを操作すると再実行されるため、古い条件の集計は打ち切られる
+        result_area = st.empty()
+        for fraction, planner in passes:
+            add_page_aggregates(planner)
+            try:
+                results = execute_planner(planner)
+            except QueryTimeout as e:
+                # 確定値が時間の予算内に終わらなければ、表示済みの近似値を残す
+                st.warning(f"{e}。近似値の表示を続けます。")
+                break
+            with result_area.container():
+                render_results(results, planner, fraction)
+            profiles.update(
+                (f"{name}（{fraction:g}）", profile)
+                for name, profile in planner.profiles.items()
+            )
 
     else:
         st.info("サイドバーで集計する列を選択してください。")
 else:
     st.info("サイドバーで表示するデータソースを選択してください。")
+
+# --- 集計のプロファイル ---
+st.sidebar.checkbox(
+    "集計のプロファイルを記録",
+    key="profile_queries",
+    help="データをスキャンする集計を1つずつ .profile() で実行し、計画のノードごとの時間を記録します。"
+    "キャッシュから返した集計は実行しないため記録されません。",
+)
+if profiles:
+    with st.sidebar.expander("集計のプロファイル（ms）"):
+        # 時間のかかった順に並べる。再実行するとキャッシュから返すためプロファイルは
+        # 記録されなくなるので、実行計画は選択させずに全て表示する
+        ranking = polars_profile_ranking(profiles)
+        st.dataframe(ranking, use_container_width=True)
+        for label in ranking["label"]:
+            st.caption(label)
+            st.code(format_polars_profile(profiles[label]))
+        st.download_button(
+            "トレースをダウンロード（JSON）",
+            data=json.dumps(profiles, ensure_ascii=False, indent=2),
+            file_name="query_trace.json",
+            mime="application/json",
+        )
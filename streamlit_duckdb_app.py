@@ -1,37 +1,106 @@
+import os
 from pathlib import Path
 
-import duckdb
-import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import polars as pl
 import streamlit as st
+from plotly.subplots import make_subplots
+
+from approximate import (
+    SAMPLE_FRACTIONS,
+    count_estimate_sql,
+    fraction_label,
+    sample_clause_sql,
+    sum_estimate_sql,
+)
+from dataset import (
+    SAMPLE_NAME,
+    HiveDataset,
+    day_range,
+    list_data_files,
+    partition_predicate,
+    time_range_sql,
+)
+from duckdb_catalog import (
+    CATALOG_NAME,
+    DATABASE_ALIAS,
+    attach,
+    list_tables,
+    open_catalog,
+    tables_source,
+)
+from duckdb_session import (
+    ConnectionManager,
+    QueryTask,
+    interrupt_after,
+    settings_from_env,
+)
+from histograms import box_stats_query, histogram_query
+from materialized import MaterializedTables
+from query_budget import QueryTimeout
+from query_builder import QueryBuilder, quote_ident
+from query_profiler import format_profile
+from query_timing import QueryTimings
+from result_cache import ResultCache, dataset_fingerprint, result_key
+from rollups import (
+    RollupPyramid,
+    category_ratio,
+    rank_categories,
+    top_n_other,
+    weekday_hour,
+)
+from sampling import SAMPLE_KEY_COL
 
-# --- 時間集計単位の定数 (DuckDB形式) ---
-TIME_AGG_OPTIONS = {"月次": "month", "週次": "week", "日次": "day"}
+# --- 時間集計単位の定数（ロールアップの粒度） ---
+TIME_AGG_OPTIONS = {"月次": "1mo", "週次": "1w", "日次": "1d"}
+
+# --- データの読み込み方式 ---
+LOAD_PARQUET = "Parquetを直接読み込む"
+LOAD_CATALOG = "永続カタログ（DuckDBテーブル）"
+LOAD_DATABASE = "DuckDBデータベース（--to-duckdb）"
 
 
 # --- DuckDBコネクションのセットアップ ---
 @st.cache_resource
+def get_connection_manager() -> ConnectionManager:
+    """
+    全セッションで共有するインメモリのDuckDBとクエリ用のスレッドプールを生成・キャッシュする。
+    スレッド数・メモリ上限・同時実行数・クエリの時間の予算は環境変数
+    DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, DUCKDB_QUERY_WORKERS, QUERY_TIMEOUT で設定する。
+    """
+    return ConnectionManager(**settings_from_env())
+
+
 def get_db_connection():
-    """インメモリのDuckDBコネクションを生成・キャッシュする。"""
-    return duckdb.connect(database=":memory:", read_only=False)
+    """
+    このセッションのDuckDBカーソルを返す。
+    ビューはカーソルごとの TEMP VIEW として作成し、他のセッションのビューと衝突しない。
+    """
+    if "duckdb_cursor" not in st.session_state:
+        st.session_state["duckdb_cursor"] = get_connection_manager().session_cursor()
+    return st.session_state["duckdb_cursor"]
 
 
-def load_data_into_duckdb(con, selected_files: list[Path]) -> bool:
+def load_data_into_duckdb(
+    con, selected_files: list[Path], data_dir: Path, where: str = "1=1"
+) -> bool:
     """
     指定されたParquetファイルをDuckDBのビューとして読み込む。
+    Hive形式で分割されている場合は、パーティション列をディレクトリ名から読み込む。
+    where はビューに含める条件で、Parquetのスキャンに押し下げられる。
     成功すればTrue、失敗すればFalseを返す。
     """
     if not selected_files:
         st.warning("データソースを1つ以上選択してください。")
         return False
 
-    # ファイルパスのリストをSQLで使える形式 (['path1', 'path2', ...]) に変換
-    file_list_str = ", ".join([f"'{str(p)}'" for p in selected_files])
+    dataset = HiveDataset(selected_files, data_dir)
 
     try:
         # Parquetファイルからビューを作成
         con.execute(
-            f"CREATE OR REPLACE VIEW source_data AS SELECT * FROM read_parquet([{file_list_str}])"
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM {dataset.duckdb_source()} WHERE {where}"
         )
         return True
     except Exception as e:
@@ -39,9 +108,175 @@ def load_data_into_duckdb(con, selected_files: list[Path]) -> bool:
         return False
 
 
+def load_catalog_into_duckdb(
+    con, selected_files: list[Path], data_dir: Path, where: str = "1=1"
+) -> bool:
+    """
+    選択されたParquetファイルを永続カタログ（データディレクトリの _catalog.duckdb）の
+    テーブルに同期し、テーブルをDuckDBのビューとして読み込む。
+    追加・更新されたファイルだけを読み込むため、2回目以降はParquetを読み直さない。
+    where はビューに含める条件で、テーブルのスキャンに押し下げられる。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    dataset = HiveDataset(selected_files, data_dir)
+    try:
+        catalog = open_catalog(con, data_dir / CATALOG_NAME)
+        changes = catalog.sync(dataset)
+        if changes["added"] or changes["removed"]:
+            st.sidebar.caption(
+                f"カタログを更新しました（追加 {changes['added']} / "
+                f"削除 {changes['removed']} ファイル）"
+            )
+        source = catalog.source_query(dataset.files)
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM ({source}) WHERE {where}"
+        )
+        return True
+    except Exception as e:
+        st.error(f"カタログの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+def load_database_into_duckdb(con, tables: list[str], where: str = "1=1") -> bool:
+    """
+    data_loader --to-duckdb で作成したデータベースのテーブルをDuckDBのビューとして読み込む。
+    複数のテーブルは列名で揃えて縦に結合する。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    try:
+        source = tables_source(DATABASE_ALIAS, tables)
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * FROM ({source}) WHERE {where}"
+        )
+        return True
+    except Exception as e:
+        st.error(f"データベースの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+def load_sample_into_duckdb(con, sample_path: Path, where: str = "1=1") -> bool:
+    """
+    取り込み時に作成した層別サンプルをDuckDBのビューとして読み込む。
+    成功すればTrue、失敗すればFalseを返す。
+    """
+    try:
+        con.execute(
+            f"CREATE OR REPLACE TEMP VIEW source_data AS SELECT * EXCLUDE ({SAMPLE_KEY_COL}) FROM read_parquet('{sample_path}') WHERE {where}"
+        )
+        return True
+    except Exception as e:
+        st.error(f"サンプルの読み込み中にエラーが発生しました: {e}")
+        return False
+
+
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    """
+    全セッションで共有する集計結果のキャッシュを生成する。
+    環境変数 RESULT_CACHE_DIR を設定すると、結果をParquetとしてディスクにも保存する。
+    """
+    persist_dir = os.environ.get("RESULT_CACHE_DIR")
+    return ResultCache(persist_dir=Path(persist_dir) if persist_dir else None)
+
+
+@st.cache_resource
+def get_materialized_tables() -> MaterializedTables:
+    """
+    全セッションで共有する、フィルタ条件ごとの絞り込み結果のテーブルを管理する。
+    """
+    return MaterializedTables(get_connection_manager().con)
+
+
+def submit_cached(
+    query: str,
+    fingerprint: str,
+    *context: str,
+    label: str,
+    params: list | None = None,
+) -> QueryTask[pl.DataFrame]:
+    """
+    fetch_cached と同じキャッシュを使い、クエリをスレッドプールで並列に実行する。
+    スレッドのカーソルからはセッションの TEMP VIEW が見えないため、
+    クエリは絞り込み結果のテーブルなど、共有のテーブルだけを参照すること。
+    結果は wait_result で待つ。
+    """
+    key = result_key(fingerprint, *context, query, params)
+    cache = get_result_cache()
+    page_timings = timings
+    task = get_connection_manager().submit(
+        lambda cursor: page_timings.fetch_cached(
+            cache, key, cursor, query, label, params
+        )
+    )
+    page_tasks.append(task)
+    return task
+
+
+def fetch_cached(
+    con,
+    query: str,
+    fingerprint: str,
+    *context: str,
+    label: str,
+    params: list | None = None,
+) -> pl.DataFrame:
+    """
+    クエリの結果を、全セッションで共有するキャッシュ経由でPolarsのデータフレームとして取得する。
+    キーはデータセットの指紋・クエリ・パラメータと、クエリが参照するビューの定義（context）から作る。
+    時間の内訳は label の名前で timings に記録し、時間の予算を超えたクエリは中断する。
+    """
+    key = result_key(fingerprint, *context, query, params)
+    with interrupt_after(con, get_connection_manager().query_timeout):
+        return timings.fetch_cached(get_result_cache(), key, con, query, label, params)
+
+
+def is_cached(
+    query: str, fingerprint: str, *context: str, params: list | None = None
+) -> bool:
+    """
+    fetch_cached で取得するクエリの結果がキャッシュ済みかを返す。
+    """
+    return get_result_cache().contains(
+        result_key(fingerprint, *context, query, params)
+    )
+
+
+def wait_result(task: QueryTask[pl.DataFrame]) -> pl.DataFrame:
+    """
+    submit_cached で実行中のクエリの結果を待つ。待っている間は経過時間を表示する。
+    表示の更新で再実行の要求が確認されるため、新しい再実行に置き換えられた描画の
+    クエリはここで中断される。時間の予算を超えた場合は QueryTimeout を送出する。
+    """
+    status = st.empty()
+    shown = [0]
+
+    def on_wait(elapsed: float) -> None:
+        # 表示は1秒ごとに更新する
+        if int(elapsed) > shown[0]:
+            shown[0] = int(elapsed)
+            status.caption(f"集計中…（{shown[0]}秒経過）")
+
+    try:
+        return task.result(on_wait)
+    finally:
+        status.empty()
+
+
 # --- メインアプリケーション ---
 st.set_page_config(layout="wide")
 
+# この描画で発行したクエリの時間の内訳。プロファイルを記録するかのチェックボックスは
+# サイドバーの末尾に表示するため、値はセッション状態から読む
+timings = QueryTimings(profile=st.session_state.get("profile_queries", False))
+
+# 前回の描画で実行中のまま残ったクエリ（新しい再実行に置き換えられた描画のもの）を中断し、
+# 放棄された描画のクエリがCPUを使い続けないようにする
+for abandoned in st.session_state.get("page_tasks", []):
+    abandoned.cancel()
+# この描画で submit_cached したクエリ
+page_tasks: list[QueryTask] = []
+st.session_state["page_tasks"] = page_tasks
+
 # --- カスタムCSSでサイドバーの幅を調整 ---
 st.markdown(
     """
@@ -60,40 +295,130 @@ st.title("インタラクティブ・データ分析ダッシュボード (DuckD
 st.sidebar.header("表示設定")
 
 # 1. データソース選択
-input_dir = st.sidebar.text_input("データディレクトリ", "prepared_data")
-data_dir = Path(input_dir)
+load_mode = st.sidebar.radio(
+    "読み込み方式",
+    options=[LOAD_PARQUET, LOAD_CATALOG, LOAD_DATABASE],
+    help="永続カタログは選択したParquetをDuckDBのテーブルとして保存し、"
+    "変更されたファイルだけを読み込み直します。DuckDBデータベースは data_loader --to-duckdb の出力を直接開きます（開いている間は書き込めません）。",
+)
 
-if data_dir.exists() and data_dir.is_dir():
-    available_files = sorted(list(data_dir.glob("**/*.parquet")))
-    available_filenames = [str(f.relative_to(data_dir)) for f in available_files]
+db_tables = []
+if load_mode == LOAD_DATABASE:
+    db_path = Path(st.sidebar.text_input("DuckDBファイル", "output/data.duckdb"))
+    data_dir = db_path.parent
+    selected_files_paths = []
+    if db_path.is_file():
+        try:
+            attach(get_db_connection(), db_path, DATABASE_ALIAS, read_only=True)
+            table_options = list_tables(get_db_connection(), DATABASE_ALIAS)
+        except Exception as e:
+            st.sidebar.error(f"データベースを開けませんでした: {e}")
+            table_options = []
+        db_tables = st.sidebar.multiselect(
+            "テーブルを選択", options=table_options, default=table_options
+        )
+    else:
+        st.sidebar.warning(f"`{db_path}` が見つかりません。")
+else:
+    input_dir = st.sidebar.text_input("データディレクトリ", "prepared_data")
+    data_dir = Path(input_dir)
 
-    selected_filenames = st.sidebar.multiselect(
-        "データソースを選択",
-        options=available_filenames,
-        default=available_filenames,
+    if data_dir.exists() and data_dir.is_dir():
+        available_files = list_data_files(data_dir)
+        available_filenames = [str(f.relative_to(data_dir)) for f in available_files]
+
+        selected_filenames = st.sidebar.multiselect(
+            "データソースを選択",
+            options=available_filenames,
+            default=available_filenames,
+        )
+        selected_files_paths = [data_dir / name for name in selected_filenames]
+    else:
+        st.sidebar.warning(f"`{input_dir}` ディレクトリが見つかりません。")
+        selected_files_paths = []
+
+# パーティションフィルタ: Hive形式で分割されたデータは、ディレクトリ単位で読み込むファイルを絞り込む
+dataset = HiveDataset(selected_files_paths, data_dir)
+if dataset.partition_columns:
+    st.sidebar.subheader("パーティションフィルタ")
+    partition_selections = {}
+    for column in dataset.partition_columns:
+        values = dataset.partition_values(column)
+        partition_selections[column] = st.sidebar.multiselect(
+            f"{column}（パーティション）", options=values, default=values, format_func=str
+        )
+    dataset = dataset.prune(partition_predicate(dataset, partition_selections))
+    st.sidebar.caption(
+        f"読み込むファイル: {len(dataset.files)} / {len(selected_files_paths)}"
     )
-    selected_files_paths = [data_dir / name for name in selected_filenames]
-else:
-    st.sidebar.warning(f"`{input_dir}` ディレクトリが見つかりません。")
-    selected_files_paths = []
+    selected_files_paths = dataset.files
+
+# 期間フィルタ: 範囲外の月パーティション・ファイルは読み込まず、
+# 残りのファイルでも EVENT_TIME の条件をスキャンに押し下げて範囲外の行グループを読み飛ばす
+time_filter = "1=1"
+time_bounds = dataset.time_bounds()
+if time_bounds:
+    min_date, max_date = time_bounds[0].date(), time_bounds[1].date()
+    selected_dates = st.sidebar.date_input(
+        "期間 (EVENT_TIME)",
+        value=(min_date, max_date),
+        min_value=min_date,
+        max_value=max_date,
+    )
+    if len(selected_dates) == 2 and tuple(selected_dates) != (min_date, max_date):
+        time_range = day_range(*selected_dates)
+        time_filter = time_range_sql(*time_range)
+        dataset = dataset.prune_time_range(*time_range)
+        st.sidebar.caption(
+            f"期間内のファイル: {len(dataset.files)} / {len(selected_files_paths)}"
+        )
+        selected_files_paths = dataset.files
+
+# プレビューモード: 取り込み時に作成した層別サンプルのみを使い、即座に表示する
+preview_mode = (
+    load_mode != LOAD_DATABASE and (data_dir / SAMPLE_NAME).exists()
+) and st.sidebar.checkbox(
+    "プレビューモード（層別サンプルのみ使用）",
+    help="is_fraud × event_month ごとに抽出したサンプルで集計します。件数は全体の件数ではありません。",
+)
 
 # DuckDBコネクションを取得し、データを読み込む
 con = get_db_connection()
 data_loaded = False
-if selected_files_paths:
-    data_loaded = load_data_into_duckdb(con, selected_files_paths)
+if preview_mode:
+    data_loaded = load_sample_into_duckdb(con, data_dir / SAMPLE_NAME, time_filter)
+elif load_mode == LOAD_DATABASE and db_tables:
+    data_loaded = load_database_into_duckdb(con, db_tables, time_filter)
+elif load_mode != LOAD_DATABASE and selected_files_paths:
+    if load_mode == LOAD_CATALOG:
+        loader = load_catalog_into_duckdb
+    else:
+        loader = load_data_into_duckdb
+    data_loaded = loader(con, selected_files_paths, data_dir, time_filter)
 else:
     # データが選択されていない場合はビューをクリア
     con.execute("DROP VIEW IF EXISTS source_data")
 
+# 集計結果のキャッシュのキーに使うデータセットの指紋
+# 期間フィルタは source_data ビューに含まれるため、指紋にも含める
+if preview_mode:
+    source_files = [data_dir / SAMPLE_NAME]
+elif load_mode == LOAD_DATABASE:
+    source_files = [db_path, db_path.with_name(f"{db_path.name}.wal")]
+else:
+    source_files = selected_files_paths
+data_fingerprint = result_key(
+    dataset_fingerprint(source_files), time_filter, db_tables
+)
+
 
 if data_loaded:
     # 2. 集計カテゴリ列の選択
-    schema_df = con.execute("DESCRIBE source_data").fetchdf()
+    schema_df = con.execute("DESCRIBE source_data").pl()
     # 文字列型の列を抽出
-    categorical_cols = schema_df[schema_df["column_type"] == "VARCHAR"][
+    categorical_cols = schema_df.filter(pl.col("column_type") == "VARCHAR")[
         "column_name"
-    ].tolist()
+    ].to_list()
 
     if "score_level" in categorical_cols:
         categorical_cols.remove("score_level")
@@ -125,9 +450,12 @@ if data_loaded:
     st.sidebar.header("フィルタ設定")
 
     # is_fraud フラグのフィルタ
-    fraud_options_df = con.execute(
-        "SELECT DISTINCT is_fraud FROM source_data ORDER BY 1"
-    ).fetchdf()
+    fraud_options_df = fetch_cached(
+        con,
+        "SELECT DISTINCT is_fraud FROM source_data ORDER BY 1",
+        data_fingerprint,
+        label="is_fraud の値",
+    )
     fraud_options = fraud_options_df["is_fraud"].to_list()
     selected_fraud = st.sidebar.multiselect(
         "不正フラグ (is_fraud)", options=fraud_options, default=fraud_options
@@ -142,11 +470,14 @@ if data_loaded:
         st.sidebar.error("低リスクの閾値は中リスクの閾値より小さくしてください。")
         st.stop()
 
+    # フィルタの値はSQLに埋め込まず、パラメータとして渡す
+    filter_query = QueryBuilder()
+
     # score_levelを動的に生成するSQLのCASE文
     score_level_case_stmt = f"""
         CASE
-            WHEN SCORE <= {threshold_low} THEN 'Low'
-            WHEN SCORE <= {threshold_mid} THEN 'Mid'
+            WHEN SCORE <= {filter_query.param(threshold_low)} THEN 'Low'
+            WHEN SCORE <= {filter_query.param(threshold_mid)} THEN 'Mid'
             ELSE 'High'
         END AS score_level
     """
@@ -158,33 +489,44 @@ if data_loaded:
     )
 
     # --- フィルタリング済みデータのビューを作成 ---
-    # フィルタ条件をSQLのWHERE句に変換
-    def build_in_clause(values: list) -> str:
-        """SQLのIN句の文字列を安全に構築する。"""
-        if not values:
-            return "1=1"  # 常にTrue
-
-        def format_value(v):
-            if isinstance(v, str):
-                return f"'{v}'"
-            return str(v)  # booleanや数値はそのまま文字列化
-
-        items = ", ".join([format_value(v) for v in values])
-        return f"IN ({items})"
-
-    fraud_filter = f"is_fraud {build_in_clause(selected_fraud)}"
-    level_filter = f"score_level {build_in_clause(selected_levels)}"
+    fraud_filter = filter_query.in_list("is_fraud", selected_fraud)
+    level_filter = filter_query.in_list("score_level", selected_levels)
 
+    # 集計に使う列だけを絞り込み、フィルタ条件ごとにテーブルとして保持する。
+    # filtered_data はそのテーブルを指すビューで、条件が変わるまで同じテーブルを再利用する
+    agg_col_part = f"{quote_ident(agg_col)}, " if agg_col else ""
     filtered_view_query = f"""
-        CREATE OR REPLACE VIEW filtered_data AS
         SELECT *
         FROM (
-            SELECT * EXCLUDE (score_level), {score_level_case_stmt}
+            SELECT {agg_col_part}EVENT_TIME, EVENT_VALUE, is_fraud, {score_level_case_stmt}
             FROM source_data
         )
         WHERE {fraud_filter} AND {level_filter}
     """
-    con.execute(filtered_view_query)
+    # 絞り込み条件の署名。絞り込み結果から求める集計のキャッシュのキーにも使う
+    filter_signature = result_key(
+        data_fingerprint, filtered_view_query, filter_query.params
+    )
+    try:
+        # セッションのビューを参照するため、セッションのカーソルで作成する
+        with interrupt_after(con, get_connection_manager().query_timeout):
+            filtered_table = get_materialized_tables().get(
+                filter_signature, filtered_view_query, con, filter_query.params
+            )
+    except QueryTimeout as e:
+        st.error(f"絞り込み結果の作成を中断しました: {e}。条件を絞り込んでください。")
+        st.stop()
+    con.execute(
+        f"CREATE OR REPLACE TEMP VIEW filtered_data AS SELECT * FROM {filtered_table}"
+    )
+
+    # 近似モード: サンプルから推定した結果を先に表示し、全データの確定値で置き換える
+    approx_label = st.sidebar.selectbox(
+        "近似モード（サンプルで先に表示）",
+        options=["オフ", *SAMPLE_FRACTIONS],
+        help="固定シードのサンプルから推定した集計を先に表示し、全データの集計が終わり次第置き換えます。",
+    )
+    approx_fraction = SAMPLE_FRACTIONS.get(approx_label)
 
     # --- デバッグ情報 ---
     st.sidebar.subheader("Debug Info")
@@ -193,6 +535,7 @@ if data_loaded:
         st.sidebar.write(f"Source records: {source_count:,}")
 
         st.sidebar.code(filtered_view_query, language="sql")
+        st.sidebar.write(f"Parameters: {filter_query.params}")
 
         filtered_count = con.execute("SELECT COUNT(*) FROM filtered_data").fetchone()[0]
         st.sidebar.write(f"Filtered records: {filtered_count:,}")
@@ -203,107 +546,117 @@ if data_loaded:
     if agg_col:
         st.header(f"`{agg_col}`別 サマリー")
 
-        # --- ここで計算を実行 ---
-        top_by_count_query = f"""
-            SELECT {agg_col}, COUNT(*) AS "レコード数"
-            FROM filtered_data
-            GROUP BY {agg_col}
-            ORDER BY "レコード数" DESC
-            LIMIT 100
-        """
-        top_by_value_query = f"""
-            SELECT {agg_col}, SUM(EVENT_VALUE) AS "EVENT_VALUE合計"
-            FROM filtered_data
-            GROUP BY {agg_col}
-            ORDER BY "EVENT_VALUE合計" DESC
-            LIMIT 100
-        """
-        top_by_count = con.execute(top_by_count_query).fetchdf()
-        top_by_value = con.execute(top_by_value_query).fetchdf()
-
-        if top_by_count.empty:
-            st.warning("選択された条件に一致するデータがありません。")
-        else:
+        # --- 集計用ヘルパー関数 ---
+        def rollup_query(fraction: float) -> str:
+            """
+            カテゴリ × 1時間ごとの件数・EVENT_VALUE合計・不正件数（ロールアップ）を求めるクエリ。
+            fraction < 1 の場合はサンプルから推定し、分散の列（*_var）を加える。
+            時間集計単位によらないため、単位を切り替えてもキャッシュから再利用される。
+            上位カテゴリ表・トレンド・ヒートマップ・不正利用率は全てこの結果から導出するため、
+            絞り込み結果のスキャンは1回で済む。
+            """
+            count, count_var = count_estimate_sql(fraction)
+            value_sum, value_sum_var = sum_estimate_sql("EVENT_VALUE", fraction)
+            fraud_count, fraud_count_var = sum_estimate_sql(
+                "CAST(is_fraud AS INTEGER)", fraction
+            )
+            return f"""
+                SELECT
+                    date_trunc('hour', EVENT_TIME) AS time_agg,
+                    {quote_ident(agg_col)},
+                    {count} AS record_count,
+                    {count_var} AS record_count_var,
+                    {value_sum} AS event_value_sum,
+                    {value_sum_var} AS event_value_sum_var,
+                    {fraud_count} AS fraud_count,
+                    {fraud_count_var} AS fraud_count_var
+                FROM {filtered_table} {sample_clause_sql(fraction)}
+                GROUP BY ALL
+            """
+
+        def render_summary(
+            fraction: float, final: bool = False
+        ) -> tuple[pl.DataFrame, pl.DataFrame]:
+            """
+            サマリー表とトレンドグラフを表示し、ロールアップと件数の上位カテゴリ表を返す。
+            近似値（fraction < 1）の場合は、表に信頼区間の列を、グラフに誤差棒を付ける。
+            final は確定値の代わりに表示する近似値（後から置き換えない）であることを表す。
+            """
+            approximate = fraction < 1
+            if approximate and not final:
+                st.warning(f"{fraction_label(fraction)}。確定値を集計中です…")
+            elif approx_fraction or final:
+                st.caption(fraction_label(fraction))
+
+            # サマリー表・グラフは全て1時間単位のロールアップから導出する
+            rollup = wait_result(
+                submit_cached(
+                    rollup_query(fraction),
+                    data_fingerprint,
+                    filter_signature,
+                    label=f"ロールアップ（{fraction:g}）",
+                )
+            )
+            if not approximate:
+                rollup = rollup.drop(
+                    "record_count_var", "event_value_sum_var", "fraud_count_var"
+                )
+            pyramid = RollupPyramid(rollup, [agg_col])
+            top_by_count = rank_categories(
+                rollup, agg_col, "record_count", "レコード数"
+            )
+            top_by_value = rank_categories(
+                rollup, agg_col, "event_value_sum", "EVENT_VALUE合計"
+            )
+
+            if top_by_count.is_empty():
+                st.warning("選択された条件に一致するデータがありません。")
+                return rollup, top_by_count
+
             col1, col2 = st.columns(2)
             with col1:
                 st.subheader("レコード数 トップ100")
                 st.data_editor(
-                    top_by_count,
+                    timings.to_pandas(top_by_count, "レコード数 トップ100"),
                     column_config={
                         "レコード数": st.column_config.NumberColumn(format="localized")
                     },
                     use_container_width=True,
+                    key=f"top_by_count_{fraction}",
                 )
             with col2:
                 st.subheader("EVENT_VALUE合計 トップ100")
                 st.data_editor(
-                    top_by_value,
+                    timings.to_pandas(top_by_value, "EVENT_VALUE合計 トップ100"),
                     column_config={
                         "EVENT_VALUE合計": st.column_config.NumberColumn(
                             format="¥{value:,.0f}"
                         )
                     },
                     use_container_width=True,
+                    key=f"top_by_value_{fraction}",
                 )
 
             st.header(f"{time_agg_label}トレンド分析")
 
-            # --- 集計用ヘルパー関数 ---
-            def aggregate_for_chart(
-                agg_col: str,
-                top_cats: list,
-                time_agg_unit: str,
-                value_col: str = None,
-            ) -> pd.DataFrame:
-                def build_in_clause_for_agg(values: list) -> str:
-                    """集計用のIN句ビルダー"""
-                    if not values:
-                        return "IN ('')"  # 空のIN句
-                    # カテゴリ列は常に文字列と想定
-                    items = ", ".join([f"'{v}'" for v in values])
-                    return f"IN ({items})"
-
-                category_group_case = f"""
-                    CASE
-                        WHEN {agg_col} {build_in_clause_for_agg(top_cats)} THEN {agg_col}
-                        ELSE 'Other'
-                    END AS category_group
-                """
-
-                time_agg_expr = f"date_trunc('{time_agg_unit}', EVENT_TIME) AS time_agg"
-
-                if value_col:
-                    agg_expr = f"SUM({value_col}) AS value_agg"
-                    group_by_cols = "time_agg, category_group"
-                else:
-                    agg_expr = "COUNT(*) AS value_agg"
-                    group_by_cols = "time_agg, category_group"
-
-                query = f"""
-                    SELECT
-                        {time_agg_expr},
-                        {category_group_case},
-                        {agg_expr}
-                    FROM filtered_data
-                    GROUP BY {group_by_cols}
-                    ORDER BY time_agg
-                """
-                return con.execute(query).fetchdf()
-
             # --- グラフ1: レコード数 ---
             top_n_by_count_cats = top_by_count.head(top_n)[agg_col].to_list()
-            summary_by_count = aggregate_for_chart(
-                agg_col, top_n_by_count_cats, time_agg_unit
+            summary_by_count = top_n_other(
+                pyramid.level(time_agg_unit),
+                agg_col,
+                top_n_by_count_cats,
+                "record_count",
             )
             fig1 = px.bar(
-                summary_by_count,
+                timings.to_pandas(summary_by_count, "レコード数トレンド"),
                 x="time_agg",
-                y="value_agg",
+                y="record_count",
+                error_y="record_count_ci" if approximate else None,
                 color="category_group",
                 title=f"{time_agg_label}レコード数（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
                     "time_agg": time_agg_label,
-                    "value_agg": "レコード数",
+                    "record_count": "レコード数",
                     "category_group": "カテゴリ",
                 },
                 category_orders={"category_group": top_n_by_count_cats + ["Other"]},
@@ -311,22 +664,28 @@ if data_loaded:
             fig1.update_traces(
                 hovertemplate="<b>%{x}</b><br>カテゴリ: %{fullData.name}<br>レコード数: %{y}<extra></extra>"
             )
-            st.plotly_chart(fig1, use_container_width=True)
+            st.plotly_chart(
+                fig1, use_container_width=True, key=f"summary_by_count_{fraction}"
+            )
 
             # --- グラフ2: イベント価値合計 ---
             top_n_by_value_cats = top_by_value.head(top_n)[agg_col].to_list()
-            summary_by_value = aggregate_for_chart(
-                agg_col, top_n_by_value_cats, time_agg_unit, value_col="EVENT_VALUE"
+            summary_by_value = top_n_other(
+                pyramid.level(time_agg_unit),
+                agg_col,
+                top_n_by_value_cats,
+                "event_value_sum",
             )
             fig2 = px.bar(
-                summary_by_value,
+                timings.to_pandas(summary_by_value, "価値合計トレンド"),
                 x="time_agg",
-                y="value_agg",
+                y="event_value_sum",
+                error_y="event_value_sum_ci" if approximate else None,
                 color="category_group",
                 title=f"{time_agg_label}イベント価値合計（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
                     "time_agg": time_agg_label,
-                    "value_agg": "価値合計",
+                    "event_value_sum": "価値合計",
                     "category_group": "カテゴリ",
                 },
                 category_orders={"category_group": top_n_by_value_cats + ["Other"]},
@@ -334,24 +693,73 @@ if data_loaded:
             fig2.update_traces(
                 hovertemplate="<b>%{x}</b><br>カテゴリ: %{fullData.name}<br>価値合計: ¥%{y:,.0f}<extra></extra>"
             )
-            st.plotly_chart(fig2, use_container_width=True)
+            st.plotly_chart(
+                fig2, use_container_width=True, key=f"summary_by_value_{fraction}"
+            )
+            return rollup, top_by_count
+
+        # 取引金額の分布の集計は、サマリーと独立しているため先にスレッドプールで
+        # 並列に実行する。スレッドのカーソルからはセッションのビューが見えないため、
+        # 絞り込み結果のテーブルを参照する
+        # ビンごとの件数と箱ひげ図の統計量だけをDuckDBで集計して受け取る。
+        # 少数の外れ値でビンが粗くならないよう、ビンの範囲は0.1%〜99.9%の近似分位点とする
+        dist_task = submit_cached(
+            histogram_query(filtered_table, "EVENT_VALUE", "is_fraud", tail=0.001),
+            data_fingerprint,
+            filter_signature,
+            label="取引金額のヒストグラム",
+        )
+        box_task = submit_cached(
+            box_stats_query(filtered_table, "EVENT_VALUE", "is_fraud"),
+            data_fingerprint,
+            filter_signature,
+            label="取引金額の箱ひげ図",
+        )
 
+        # 近似値を先に表示し、確定値の集計が終わったら同じ場所を置き換える。
+        # 集計中にウィジェットを操作すると再実行されるため、古い条件の集計は打ち切られる
+        passes = [1.0]
+        if approx_fraction and not is_cached(
+            rollup_query(1.0), data_fingerprint, filter_signature
+        ):
+            passes.insert(0, approx_fraction)
+        result_area = st.empty()
+        # 確定値が時間の予算内に終わらない場合に代わりに表示するサンプル率
+        fallback_fraction = min(SAMPLE_FRACTIONS.values())
+        for fraction in passes:
+            try:
+                with result_area.container():
+                    rollup, top_by_count = render_summary(fraction)
+                fallback_fraction = fraction
+            except QueryTimeout as e:
+                if fraction < 1:
+                    # 近似値が間に合わなければ、確定値の集計を待つ
+                    continue
+                with result_area.container():
+                    st.warning(f"{e}。代わりにサンプルからの近似値を表示します。")
+                    try:
+                        rollup, top_by_count = render_summary(
+                            fallback_fraction, final=True
+                        )
+                    except QueryTimeout:
+                        st.error(
+                            "近似値の集計も時間の予算内に終わりませんでした。条件を絞り込んでください。"
+                        )
+                        top_by_count = pl.DataFrame()
+
+        if top_by_count.is_empty():
+            # 表示しない集計は中断する
+            dist_task.cancel()
+            box_task.cancel()
+        else:
             # --- 曜日・時間帯別 ヒートマップ ---
             st.header("曜日・時間帯別 アクティビティヒートマップ")
 
-            # 曜日と時間を抽出して件数をカウントするクエリ
-            heatmap_query = """
-                SELECT
-                    EXTRACT(isodow FROM EVENT_TIME) AS day_of_week, -- 月曜:1, 日曜:7
-                    EXTRACT(hour FROM EVENT_TIME) AS hour_of_day,
-                    COUNT(*) AS record_count
-                FROM filtered_data
-                GROUP BY day_of_week, hour_of_day
-            """
             try:
-                heatmap_df = con.execute(heatmap_query).fetchdf()
+                # 曜日 × 時間帯の件数は1時間単位のロールアップから求める
+                heatmap_df = weekday_hour(rollup, "record_count")
 
-                if not heatmap_df.empty:
+                if not heatmap_df.is_empty():
                     # 曜日名のマッピング
                     day_map = {
                         1: "月",
@@ -362,13 +770,19 @@ if data_loaded:
                         6: "土",
                         7: "日",
                     }
-                    heatmap_df["day_of_week_str"] = heatmap_df["day_of_week"].map(
-                        day_map
+                    heatmap_df = heatmap_df.with_columns(
+                        pl.col("day_of_week")
+                        .replace_strict(day_map)
+                        .alias("day_of_week_str")
                     )
 
                     # ヒートマップの作成
                     fig_heatmap = px.density_heatmap(
-                        heatmap_df,
+                        timings.to_pandas(
+                            heatmap_df,
+                            "ヒートマップ",
+                            ["hour_of_day", "day_of_week_str", "record_count"],
+                        ),
                         x="hour_of_day",
                         y="day_of_week_str",
                         z="record_count",
@@ -408,29 +822,59 @@ if data_loaded:
             # --- 取引金額の分布 ---
             st.header("取引金額の分布")
             try:
-                dist_query = "SELECT EVENT_VALUE, is_fraud FROM filtered_data"
-                dist_df = con.execute(dist_query).fetchdf()
-
-                if not dist_df.empty:
-                    fig_dist = px.histogram(
-                        dist_df,
-                        x="EVENT_VALUE",
-                        color="is_fraud",
-                        marginal="box",  # or "rug", "violin"
-                        barmode="overlay",
-                        title="取引金額の分布（不正利用別）",
-                        labels={
-                            "EVENT_VALUE": "取引金額 (EVENT_VALUE)",
-                            "is_fraud": "不正利用フラグ",
-                        },
-                        color_discrete_map={True: "red", False: "royalblue"},
-                        opacity=0.7,
+                dist_df = wait_result(dist_task)
+                box_df = wait_result(box_task)
+
+                if not dist_df.is_empty():
+                    fig_dist = make_subplots(
+                        rows=2,
+                        cols=1,
+                        shared_xaxes=True,
+                        row_heights=[0.2, 0.8],
+                        vertical_spacing=0.02,
                     )
+                    colors = {True: "red", False: "royalblue"}
+                    for stats in box_df.iter_rows(named=True):
+                        is_fraud = stats["is_fraud"]
+                        fig_dist.add_trace(
+                            go.Box(
+                                y=[str(is_fraud)],
+                                q1=[stats["q1"]],
+                                median=[stats["median"]],
+                                q3=[stats["q3"]],
+                                mean=[stats["mean"]],
+                                lowerfence=[stats["lower_fence"]],
+                                upperfence=[stats["upper_fence"]],
+                                orientation="h",
+                                marker_color=colors[is_fraud],
+                                name=str(is_fraud),
+                                showlegend=False,
+                            ),
+                            row=1,
+                            col=1,
+                        )
+                    for (is_fraud,), bins in dist_df.group_by(
+                        "is_fraud", maintain_order=True
+                    ):
+                        fig_dist.add_trace(
+                            go.Bar(
+                                x=((bins["bin_start"] + bins["bin_end"]) / 2).to_numpy(),
+                                y=bins["count"].to_numpy(),
+                                width=(bins["bin_end"] - bins["bin_start"]).to_numpy(),
+                                marker_color=colors[is_fraud],
+                                opacity=0.7,
+                                name=str(is_fraud),
+                            ),
+                            row=2,
+                            col=1,
+                        )
                     fig_dist.update_layout(
-                        xaxis_title="取引金額",
-                        yaxis_title="件数",
+                        title_text="取引金額の分布（不正利用別）",
+                        barmode="overlay",
                         legend_title_text="不正利用",
                     )
+                    fig_dist.update_xaxes(title_text="取引金額", row=2, col=1)
+                    fig_dist.update_yaxes(title_text="件数", row=2, col=1)
                     st.plotly_chart(fig_dist, use_container_width=True)
                 else:
                     st.warning("取引金額分布の表示用データがありません。")
@@ -444,24 +888,19 @@ if data_loaded:
                 top_n_cats = top_by_count.head(top_n)[agg_col].to_list()
 
                 if top_n_cats:
-                    # カテゴリリストをSQLのIN句で使えるようにフォーマット
-                    cats_in_clause = ", ".join([f"'{cat}'" for cat in top_n_cats])
-
-                    fraud_rate_query = f"""
-                        SELECT
-                            {agg_col},
-                            COUNT(*) AS total_count,
-                            COUNT(*) FILTER (WHERE is_fraud = true) AS fraud_count,
-                            (CAST(fraud_count AS DOUBLE) / total_count) AS fraud_rate
-                        FROM filtered_data
-                        WHERE {agg_col} IN ({cats_in_clause})
-                        GROUP BY {agg_col}
-                    """
-                    fraud_rate_df = con.execute(fraud_rate_query).fetchdf()
-
-                    if not fraud_rate_df.empty:
+                    # カテゴリごとの件数・不正件数もロールアップから求める
+                    fraud_rate_df = category_ratio(
+                        rollup,
+                        agg_col,
+                        top_n_cats,
+                        "fraud_count",
+                        "record_count",
+                        "fraud_rate",
+                    ).rename({"record_count": "total_count"})
+
+                    if not fraud_rate_df.is_empty():
                         fig_scatter = px.scatter(
-                            fraud_rate_df,
+                            timings.to_pandas(fraud_rate_df, "不正利用率"),
                             x="total_count",
                             y="fraud_rate",
                             size="total_count",
@@ -492,3 +931,27 @@ if data_loaded:
         st.info("サイドバーで集計する列を選択してください。")
 else:
     st.info("サイドバーで表示するデータソースを選択してください。")
+
+# --- クエリ時間の内訳・プロファイル ---
+st.sidebar.checkbox(
+    "クエリのプロファイルを記録",
+    key="profile_queries",
+    help="実行したクエリのスキャン行数・バイト数と実行計画（EXPLAIN ANALYZE）を記録します。"
+    "キャッシュから返したクエリは実行しないため記録されません。",
+)
+if timings.records:
+    with st.sidebar.expander("クエリ時間の内訳（ms）"):
+        # 時間のかかった順に並べる。再実行するとキャッシュから返すためプロファイルは
+        # 記録されなくなるので、実行計画は選択させずに全て表示する
+        ranking = timings.ranking()
+        st.dataframe(ranking, use_container_width=True)
+        for label in ranking["label"]:
+            if label in timings.profiles:
+                st.caption(label)
+                st.code(format_profile(timings.profiles[label]))
+        st.download_button(
+            "トレースをダウンロード（JSON）",
+            data=timings.trace(),
+            file_name="query_trace.json",
+            mime="application/json",
+        )
@@ -1,12 +1,17 @@
+import os
 from pathlib import Path
 from typing import List
 
 import pandas as pd
 import plotly.express as px
+import polars as pl
 import streamlit as st
 
-# --- 時間集計単位の定数 ---
-TIME_AGG_OPTIONS = {"月次": "M", "週次": "W", "日次": "D"}
+from dataset import day_range
+from rollups import RollupPyramid, hourly_rollup, rank_categories, top_n_other
+
+# --- 時間集計単位の定数（ロールアップの粒度） ---
+TIME_AGG_OPTIONS = {"月次": "1mo", "週次": "1w", "日次": "1d"}
 
 
 # --- データ読み込みとキャッシュ ---
@@ -36,6 +41,31 @@ def get_unique_values(stores: List[pd.HDFStore], column: str) -> List:
     return sorted(list(unique_values))
 
 
+@st.cache_data
+def get_time_bounds(file_path: Path, mtime_ns: int) -> tuple | None:
+    """
+    HDF5ファイルの EVENT_TIME の最小値・最大値を返す。
+    EVENT_TIME の列だけを読み込み、ファイルの更新時刻（mtime_ns）ごとにキャッシュする。
+    """
+    try:
+        with pd.HDFStore(file_path, "r") as store:
+            times = store.select_column("data", "EVENT_TIME")
+    except (KeyError, ValueError):
+        return None
+    if times.dropna().empty:
+        return None
+    return times.min(), times.max()
+
+
+def time_where(start, end) -> str:
+    """
+    [start, end) の期間を表す HDF5 の where 条件。
+    EVENT_TIME はデータ列（data_columns）としてインデックス化されているため、
+    期間外の行は読み込まれない。
+    """
+    return f"EVENT_TIME >= Timestamp('{start}') & EVENT_TIME < Timestamp('{end}')"
+
+
 # --- メインアプリケーション ---
 st.set_page_config(layout="wide")
 
@@ -124,6 +154,27 @@ if stores:
         "スコアレベル (score_level)", options=level_options, default=level_options
     )
 
+    # 期間フィルタ: 期間外のファイルは読み込まず、残りは where 句で期間内の行だけを読み込む
+    store_bounds = {
+        store.filename: get_time_bounds(
+            Path(store.filename), os.stat(store.filename).st_mtime_ns
+        )
+        for store in stores
+    }
+    known_bounds = [b for b in store_bounds.values() if b is not None]
+    time_range = None
+    if known_bounds:
+        min_date = min(lo for lo, _ in known_bounds).date()
+        max_date = max(hi for _, hi in known_bounds).date()
+        selected_dates = st.sidebar.date_input(
+            "期間 (EVENT_TIME)",
+            value=(min_date, max_date),
+            min_value=min_date,
+            max_value=max_date,
+        )
+        if len(selected_dates) == 2 and tuple(selected_dates) != (min_date, max_date):
+            time_range = day_range(*selected_dates)
+
     # --- 分析実行ボタン ---
     if st.sidebar.button("分析実行", type="primary"):
         # --- データのフィルタリングと読み込み ---
@@ -132,6 +183,19 @@ if stores:
             where_conditions.append(f"is_fraud in {selected_fraud}")
         if selected_levels:
             where_conditions.append(f"score_level in {selected_levels}")
+        read_stores = stores
+        if time_range:
+            where_conditions.append(time_where(*time_range))
+            start, end = time_range
+            read_stores = [
+                store
+                for store in stores
+                if store_bounds[store.filename] is None
+                or (
+                    store_bounds[store.filename][1] >= start
+                    and store_bounds[store.filename][0] < end
+                )
+            ]
 
         where_query = " & ".join(where_conditions) if where_conditions else None
 
@@ -143,7 +207,7 @@ if stores:
         df_list = []
         try:
             with st.spinner("データをHDF5から読み込み中..."):
-                for store in stores:
+                for store in read_stores:
                     df_list.append(
                         store.select("data", where=where_query, columns=required_cols)
                     )
@@ -166,18 +230,25 @@ if stores:
         if agg_col:
             st.header(f"`{agg_col}`別 サマリー")
 
-            top_by_count = (
-                filtered_df.groupby(agg_col)
-                .size()
-                .nlargest(100)
-                .reset_index(name="レコード数")
-            )
-            top_by_value = (
-                filtered_df.groupby(agg_col)["EVENT_VALUE"]
-                .sum()
-                .nlargest(100)
-                .reset_index(name="EVENT_VALUE合計")
-            )
+            # 読み込んだ行を1時間単位のロールアップにまとめ、表とグラフはそこから導出する
+            rollup = hourly_rollup(
+                pl.from_pandas(
+                    filtered_df[[agg_col, "EVENT_TIME", "EVENT_VALUE"]]
+                ).lazy(),
+                [agg_col],
+                [
+                    pl.len().alias("record_count"),
+                    pl.sum("EVENT_VALUE").alias("event_value_sum"),
+                ],
+            ).collect()
+            pyramid = RollupPyramid(rollup, [agg_col])
+
+            top_by_count = rank_categories(
+                rollup, agg_col, "record_count", "レコード数"
+            ).to_pandas()
+            top_by_value = rank_categories(
+                rollup, agg_col, "event_value_sum", "EVENT_VALUE合計"
+            ).to_pandas()
 
             col1, col2 = st.columns(2)
             with col1:
@@ -189,44 +260,23 @@ if stores:
 
             st.header(f"{time_agg_label}トレンド分析")
 
-            # --- 集計用ヘルパー関数 ---
-            def aggregate_for_chart(
-                df: pd.DataFrame,
-                agg_col: str,
-                top_cats: list,
-                time_agg_unit: str,
-                value_col: str = None,
-            ) -> pd.DataFrame:
-                df["category_group"] = df[agg_col].where(
-                    df[agg_col].isin(top_cats), "Other"
-                )
-                df["time_agg"] = (
-                    df["EVENT_TIME"].dt.to_period(time_agg_unit).dt.start_time
-                )
-
-                if value_col:
-                    summary = df.groupby(["time_agg", "category_group"])[
-                        value_col
-                    ].sum()
-                else:
-                    summary = df.groupby(["time_agg", "category_group"]).size()
-
-                return summary.reset_index(name="value")
-
             # --- グラフ1: レコード数 ---
             top_n_by_count_cats = top_by_count.head(top_n)[agg_col].to_list()
-            summary_by_count = aggregate_for_chart(
-                filtered_df, agg_col, top_n_by_count_cats, time_agg_unit
+            summary_by_count = top_n_other(
+                pyramid.level(time_agg_unit),
+                agg_col,
+                top_n_by_count_cats,
+                "record_count",
             )
             fig1 = px.bar(
                 summary_by_count,
                 x="time_agg",
-                y="value",
+                y="record_count",
                 color="category_group",
                 title=f"{time_agg_label}レコード数（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
                     "time_agg": time_agg_label,
-                    "value": "レコード数",
+                    "record_count": "レコード数",
                     "category_group": "カテゴリ",
                 },
                 category_orders={"category_group": top_n_by_count_cats + ["Other"]},
@@ -235,22 +285,21 @@ if stores:
 
             # --- グラフ2: イベント価値合計 ---
             top_n_by_value_cats = top_by_value.head(top_n)[agg_col].to_list()
-            summary_by_value = aggregate_for_chart(
-                filtered_df,
+            summary_by_value = top_n_other(
+                pyramid.level(time_agg_unit),
                 agg_col,
                 top_n_by_value_cats,
-                time_agg_unit,
-                value_col="EVENT_VALUE",
+                "event_value_sum",
             )
             fig2 = px.bar(
                 summary_by_value,
                 x="time_agg",
-                y="value",
+                y="event_value_sum",
                 color="category_group",
                 title=f"{time_agg_label}イベント価値合計（{agg_col} 上位{top_n}カテゴリ別内訳）",
                 labels={
                     "time_agg": time_agg_label,
-                    "value": "価値合計",
+                    "event_value_sum": "価値合計",
                     "category_group": "カテゴリ",
                 },
                 category_orders={"category_group": top_n_by_value_cats + ["Other"]},
@@ -0,0 +1,75 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import polars as pl
+
+from approximate import (
+    Z_95,
+    ci_expr,
+    count_estimate_sql,
+    estimate_aggs,
+    sample_clause_sql,
+    sample_lazy,
+    sum_estimate_sql,
+)
+
+
+def test_sample_estimates_are_close_to_exact_values():
+    """
+    固定シードのサンプルから推定した件数・合計が信頼区間の幅に見合う誤差で確定値に近く、
+    サンプル率1では確定値（分散0）になることを確認する。Polars と DuckDB の両方で確認する。
+    """
+    n = 200_000
+    lf = pl.LazyFrame(
+        {"category": [i % 4 for i in range(n)], "EVENT_VALUE": list(range(n))}
+    )
+    exact = (
+        lf.group_by("category")
+        .agg(pl.len().alias("count"), pl.sum("EVENT_VALUE").alias("value"))
+        .sort("category")
+        .collect()
+    )
+
+    def estimate(fraction: float) -> pl.DataFrame:
+        return (
+            sample_lazy(lf, fraction)
+            .group_by("category")
+            .agg(*estimate_aggs(fraction, "count", {"value": "EVENT_VALUE"}))
+            .with_columns(ci_expr("count_var"), ci_expr("value_var"))
+            .sort("category")
+            .collect()
+        )
+
+    # 95%信頼区間は5%の確率で外れるため、推定誤差が区間の半幅の2倍以内であることを確認する
+    approx = estimate(0.05)
+    for column in ["count", "value"]:
+        error = (approx[column] - exact[column].cast(pl.Float64)).abs()
+        assert (error <= 2 * approx[f"{column}_var"]).all()
+    # 同じシードでは同じサンプルになる
+    assert approx.equals(estimate(0.05))
+
+    full = estimate(1.0)
+    assert full["count"].to_list() == exact["count"].to_list()
+    assert full["value"].to_list() == exact["value"].to_list()
+    assert full["count_var"].to_list() == [0.0] * 4
+
+    con = duckdb.connect()
+    con.register("events", lf.collect().to_arrow())
+    count_sql, count_var_sql = count_estimate_sql(0.05)
+    value_sql, value_var_sql = sum_estimate_sql("EVENT_VALUE", 0.05)
+    query = f"""
+        SELECT category, {count_sql} AS count, {Z_95} * SQRT({count_var_sql}) AS count_ci,
+            {value_sql} AS value, {Z_95} * SQRT({value_var_sql}) AS value_ci
+        FROM events {sample_clause_sql(0.05)}
+        GROUP BY category
+        ORDER BY category
+    """
+    result = pl.from_arrow(con.execute(query).arrow())
+    for column in ["count", "value"]:
+        error = (result[column] - exact[column].cast(pl.Float64)).abs()
+        assert (error <= 2 * result[f"{column}_ci"]).all()
+    assert con.execute(query).fetchall() == con.execute(query).fetchall()
@@ -0,0 +1,301 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import polars as pl
+import pytest
+
+from data_loader import DataLoader, narrowest_int_dtype
+from dataset import list_data_files, list_partition_files, load_sample
+
+
+@pytest.fixture
+def loader(tmp_path: Path) -> DataLoader:
+    """
+    テスト用の一時ディレクトリを使うDataLoaderを作成するフィクスチャ。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    return DataLoader(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=False,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+        compact_types=True,
+    )
+
+
+def write_tsv(path: Path, df: pl.DataFrame) -> None:
+    """
+    テスト用のTSVファイルを書き出す。
+    """
+    df.write_csv(path, separator="\t")
+
+
+def test_narrowest_int_dtype():
+    """
+    値域から最小の整数型が選ばれることを確認する。
+    """
+    assert narrowest_int_dtype(0, 255) == pl.UInt8
+    assert narrowest_int_dtype(0, 1_000_000) == pl.UInt32
+    assert narrowest_int_dtype(-1000, 2500) == pl.Int16
+    assert narrowest_int_dtype(-(2**40), 0) == pl.Int64
+
+
+def test_compact_types_on_ingest(loader: DataLoader):
+    """
+    --compact-types 指定時に、値を保ったまま狭い型で保存されることを確認する。
+    """
+    source = pl.DataFrame(
+        {
+            "SCORE": [-1000, 600, 2500],
+            "EVENT_VALUE": [0, 500_000, 1_000_000],
+            "is_fraud": [True, False, None],
+            "EVENT_TIME": ["2023-01-15 12:00:00.123", "2023-02-20 12:00:00", None],
+            "numeric_col_1": [0, 100, 200],
+            "numeric_col_2": [1.5, 2.25, None],
+            "string_col_0": ["a", None, "c"],
+        }
+    )
+    input_file = loader.input_dir / "test.tsv"
+    write_tsv(input_file, source)
+
+    loader.process_file(input_file)
+    result = pl.read_parquet(loader.output_dir / "test.parquet")
+
+    assert result.schema["SCORE"] == pl.Int16
+    assert result.schema["EVENT_VALUE"] == pl.UInt32
+    assert result.schema["is_fraud"] == pl.Boolean
+    assert result.schema["EVENT_TIME"] == pl.Datetime("ms")
+    assert result.schema["numeric_col_1"] == pl.UInt32
+    # レジストリにない浮動小数点列は元の型のまま
+    assert result.schema["numeric_col_2"] == pl.Float64
+
+    assert result["SCORE"].to_list() == [-1000, 600, 2500]
+    assert result["EVENT_VALUE"].to_list() == [0, 500_000, 1_000_000]
+    assert result["is_fraud"].to_list() == [True, False, False]
+    assert result["numeric_col_2"].to_list() == [1.5, 2.25, None]
+    assert result["EVENT_TIME"][0] == datetime(2023, 1, 15, 12, 0, 0, 123000)
+
+
+def test_compacted_files_can_be_read_together(loader: DataLoader):
+    """
+    値域の異なる複数のファイルを取り込んでも型が揃い、まとめて読み込めることを確認する。
+    """
+    for name, values in [("small", [1, 2]), ("large", [70_000, 5])]:
+        write_tsv(
+            loader.input_dir / f"{name}.tsv",
+            pl.DataFrame(
+                {
+                    "SCORE": [100, 200],
+                    "EVENT_VALUE": [1, 2],
+                    "is_fraud": [False, True],
+                    "EVENT_TIME": ["2023-01-01 00:00:00", "2023-01-02 00:00:00"],
+                    "numeric_col_1": values,
+                }
+            ),
+        )
+        loader.process_file(loader.input_dir / f"{name}.tsv")
+
+    files = sorted(loader.output_dir.glob("*.parquet"))
+    result = pl.read_parquet(files)
+    assert result.schema["numeric_col_1"] == pl.UInt32
+    assert sorted(result["numeric_col_1"].to_list()) == [1, 2, 5, 70_000]
+
+
+def test_compact_types_falls_back_when_registry_type_is_too_narrow(
+    loader: DataLoader,
+):
+    """
+    レジストリの型に収まらない値があっても、値を失わずに保存されることを確認する。
+    """
+    input_file = loader.input_dir / "wide.tsv"
+    write_tsv(
+        input_file,
+        pl.DataFrame(
+            {
+                "SCORE": [100, 40_000],
+                "EVENT_VALUE": [1, 2],
+                "is_fraud": [False, True],
+                "EVENT_TIME": ["2023-01-01 00:00:00", "2023-01-02 00:00:00"],
+            }
+        ),
+    )
+    loader.process_file(input_file)
+
+    result = pl.read_parquet(loader.output_dir / "wide.parquet")
+    assert result["SCORE"].to_list() == [100, 40_000]
+    assert loader.failed_files == []
+
+
+def test_invalid_time_precision_is_rejected(tmp_path: Path):
+    """
+    time_precision に s / ms 以外を指定するとエラーになることを確認する。
+    """
+    with pytest.raises(ValueError):
+        DataLoader(
+            input_dir=tmp_path,
+            output_dir=tmp_path / "output",
+            score_thresholds=[500, 1500],
+            partitioned=False,
+            to_duckdb=False,
+            duckdb_path=tmp_path / "data.duckdb",
+            temp_dir=tmp_path / "temp",
+            time_precision="us",
+        )
+
+
+def test_merge_late_data_into_partitions(tmp_path: Path):
+    """
+    --merge 指定時に、遅れて到着したデータが該当パーティションのみにマージされ、
+    dedup_key で重複排除されることを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    merging_loader = DataLoader(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=True,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+        merge=True,
+        dedup_key=["id"],
+    )
+    input_file = input_dir / "events.tsv"
+    write_tsv(
+        input_file,
+        pl.DataFrame(
+            {
+                "id": [1, 2, 3],
+                "SCORE": [100, 100, 2000],
+                "EVENT_VALUE": [10, 20, 30],
+                "is_fraud": [False, False, True],
+                "EVENT_TIME": [
+                    "2023-01-10 00:00:00",
+                    "2023-01-11 00:00:00",
+                    "2023-02-01 00:00:00",
+                ],
+            }
+        ),
+    )
+    merging_loader.process_file(input_file)
+    feb_dir = next((merging_loader.output_dir / "events").glob("event_month=2023-02*"))
+    feb_files_before = list_partition_files(feb_dir / "score_level=high")
+
+    # id=2 の訂正と id=4 の追加（2023-01 / low パーティション）、
+    # id=1 はSCOREの訂正で 2023-01 / high パーティションへ移る
+    write_tsv(
+        input_file,
+        pl.DataFrame(
+            {
+                "id": [2, 4, 1],
+                "SCORE": [200, 300, 1800],
+                "EVENT_VALUE": [99, 40, 11],
+                "is_fraud": [False, False, True],
+                "EVENT_TIME": [
+                    "2023-01-11 00:00:00",
+                    "2023-01-12 00:00:00",
+                    "2023-01-10 00:00:00",
+                ],
+            }
+        ),
+    )
+    merging_loader.process_file(input_file)
+
+    # パーティション列はファイル内にも残り、Hive形式を解釈しなくても読み込める
+    files = list_data_files(merging_loader.output_dir)
+    result = pl.read_parquet(files).sort("id")
+    assert result["id"].to_list() == [1, 2, 3, 4]
+    assert result["EVENT_VALUE"].to_list() == [11, 99, 30, 40]
+    assert result["score_level"].to_list() == ["high", "low", "high", "low"]
+    # 触れていないパーティションは書き換えられない
+    assert list_partition_files(feb_dir / "score_level=high") == feb_files_before
+    assert not list((merging_loader.output_dir / "events").glob("_staging-*"))
+
+
+def test_merge_without_dedup_key_keeps_write_order(tmp_path: Path):
+    """
+    重複排除なしのマージでは、パーティションのファイル一覧が書き込み順に並ぶことを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    merging_loader = DataLoader(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=True,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+        merge=True,
+    )
+    input_file = input_dir / "events.tsv"
+    for value in [1, 2, 3]:
+        write_tsv(
+            input_file,
+            pl.DataFrame(
+                {
+                    "SCORE": [100],
+                    "EVENT_VALUE": [value],
+                    "is_fraud": [False],
+                    "EVENT_TIME": ["2023-01-10 00:00:00"],
+                }
+            ),
+        )
+        merging_loader.process_file(input_file)
+
+    (partition_dir,) = {p.parent for p in list_data_files(merging_loader.output_dir)}
+    values = [
+        pl.read_parquet(p)["EVENT_VALUE"].item()
+        for p in list_partition_files(partition_dir)
+    ]
+    assert values == [1, 2, 3]
+
+
+def test_stratified_sample_is_written_at_ingest(tmp_path: Path):
+    """
+    取り込み時に is_fraud × event_month ごとの層別サンプルが保存され、
+    少数派の層（不正取引）も含まれることを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for month in [1, 2]:
+        write_tsv(
+            input_dir / f"2023-0{month}.tsv",
+            pl.DataFrame(
+                {
+                    "id": range(month * 1000, month * 1000 + 500),
+                    "SCORE": [100] * 500,
+                    "EVENT_VALUE": [1] * 500,
+                    "is_fraud": [True] * 3 + [False] * 497,
+                    "EVENT_TIME": [f"2023-0{month}-10 00:00:00"] * 500,
+                }
+            ),
+        )
+    sampling_loader = DataLoader(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=False,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+        sample_size=50,
+    )
+    sampling_loader.run()
+
+    sample = load_sample(sampling_loader.output_dir)
+    counts = sample.group_by("is_fraud", "event_month").len().sort("len")
+    assert counts["len"].to_list() == [3, 3, 50, 50]
+    assert sample["id"].n_unique() == sample.height
+    assert "_sample_key" not in sample.columns
+    # サンプルは分析対象のデータファイルに含めない
+    assert all(not p.name.startswith("_") for p in list_data_files(tmp_path / "output"))
@@ -0,0 +1,125 @@
+import sys
+from datetime import date, datetime
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import polars as pl
+
+from data_loader import DataLoader
+from dataset import (
+    HiveDataset,
+    day_range,
+    partition_predicate,
+    time_range_expr,
+    time_range_sql,
+)
+
+
+def test_hive_dataset_prunes_partitions_for_polars_and_duckdb(tmp_path: Path):
+    """
+    --partitioned で保存したデータのパーティション列を検出し、条件に合うディレクトリの
+    ファイルだけを Polars と DuckDB の両方で読み込めることを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    pl.DataFrame(
+        {
+            "SCORE": [100, 2000, 100, 2000],
+            "EVENT_VALUE": [1, 2, 3, 4],
+            "is_fraud": [False, True, False, True],
+            "EVENT_TIME": [
+                "2023-01-10 00:00:00",
+                "2023-01-11 00:00:00",
+                "2023-02-10 00:00:00",
+                "2023-02-11 00:00:00",
+            ],
+        }
+    ).write_csv(input_dir / "events.tsv", separator="\t")
+    DataLoader(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=True,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+    ).run()
+
+    dataset = HiveDataset.from_dir(tmp_path / "output")
+    assert dataset.is_hive
+    assert dataset.partition_columns == ["event_month", "score_level"]
+    assert dataset.partition_values("event_month") == [
+        datetime(2023, 1, 1),
+        datetime(2023, 2, 1),
+    ]
+
+    pruned = dataset.prune(
+        partition_predicate(
+            dataset, {"event_month": [datetime(2023, 2, 1)], "score_level": ["high"]}
+        )
+    )
+    assert len(pruned.files) == 1
+    assert pruned.scan_polars().collect()["EVENT_VALUE"].to_list() == [4]
+
+    result = duckdb.sql(
+        f"SELECT event_month, EVENT_VALUE FROM {pruned.duckdb_source()}"
+    ).fetchall()
+    assert result == [(datetime(2023, 2, 1), 4)]
+
+    # 全ての値を選択した場合は絞り込まない
+    everything = {c: dataset.partition_values(c) for c in dataset.partition_columns}
+    assert partition_predicate(dataset, everything) is None
+
+
+def test_time_range_prunes_files_and_row_groups(tmp_path: Path):
+    """
+    取り込み時に EVENT_TIME 順に並べて保存し、期間フィルタで範囲外のファイル
+    （月パーティション・フッターの統計情報）を読み込まずに済むことを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name, times in {
+        "jan": ["2023-01-20 00:00:00", "2023-01-03 00:00:00", "2023-01-10 00:00:00"],
+        "feb": ["2023-02-05 00:00:00", "2023-02-01 00:00:00", "2023-02-07 00:00:00"],
+    }.items():
+        pl.DataFrame(
+            {
+                "SCORE": [100, 100, 100],
+                "EVENT_VALUE": [1, 2, 3],
+                "is_fraud": [False, False, False],
+                "EVENT_TIME": times,
+            }
+        ).write_csv(input_dir / f"{name}.tsv", separator="\t")
+
+    for partitioned in [False, True]:
+        output_dir = tmp_path / f"output-{partitioned}"
+        DataLoader(
+            input_dir=input_dir,
+            output_dir=output_dir,
+            score_thresholds=[500, 1500],
+            partitioned=partitioned,
+            to_duckdb=False,
+            duckdb_path=tmp_path / "data.duckdb",
+            temp_dir=tmp_path / "temp",
+        ).run()
+        dataset = HiveDataset.from_dir(output_dir)
+        assert dataset.time_bounds() == (datetime(2023, 1, 3), datetime(2023, 2, 7))
+
+        start, end = day_range(date(2023, 1, 5), date(2023, 1, 10))
+        pruned = dataset.prune_time_range(start, end)
+        assert len(pruned.files) == 1
+
+        lf = pruned.scan_polars()
+        # 取り込み時に時刻順に並べ替えている
+        assert lf.collect()["EVENT_VALUE"].to_list() == [2, 3, 1]
+        assert lf.filter(time_range_expr(start, end)).collect()[
+            "EVENT_VALUE"
+        ].to_list() == [3]
+        result = duckdb.sql(
+            f"SELECT EVENT_VALUE FROM {pruned.duckdb_source()} "
+            f"WHERE {time_range_sql(start, end)}"
+        ).fetchall()
+        assert result == [(3,)]
@@ -0,0 +1,62 @@
+import os
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import polars as pl
+
+from dataset import HiveDataset
+from duckdb_catalog import CATALOG_NAME, open_catalog
+
+
+def test_catalog_syncs_only_changed_files(tmp_path: Path):
+    """
+    カタログが追加・更新・削除されたファイルだけを反映し、新しい列を追加でき、
+    別のコネクションから開き直しても内容が残っていることを確認する。
+    """
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+
+    def write(name: str, **columns) -> Path:
+        path = data_dir / name
+        pl.DataFrame(
+            {"EVENT_TIME": ["2023-01-02 00:00:00", "2023-01-01 00:00:00"], **columns}
+        ).with_columns(pl.col("EVENT_TIME").str.to_datetime()).write_parquet(path)
+        return path
+
+    def rows(con, catalog, files: list[Path]) -> list[tuple]:
+        return con.execute(
+            f"SELECT * FROM ({catalog.source_query(files)}) ORDER BY EVENT_VALUE"
+        ).fetchall()
+
+    a = write("a.parquet", EVENT_VALUE=[1, 2])
+    b = write("b.parquet", EVENT_VALUE=[3, 4])
+    con = duckdb.connect()
+    catalog = open_catalog(con, data_dir / CATALOG_NAME)
+    assert catalog.sync(HiveDataset([a, b], data_dir)) == {"added": 2, "removed": 0}
+    assert catalog.sync(HiveDataset([a, b], data_dir)) == {"added": 0, "removed": 0}
+    assert [r[1] for r in rows(con, catalog, [a])] == [1, 2]
+
+    # 更新されたファイルは読み込み直し、新しい列は既存の行では NULL になる
+    write("b.parquet", EVENT_VALUE=[5, 6], SCORE=[10, 20])
+    os.utime(b, ns=(0, 0))
+    assert catalog.sync(HiveDataset([a, b], data_dir)) == {"added": 1, "removed": 1}
+    assert [r[1:] for r in rows(con, catalog, [a, b])] == [
+        (1, None),
+        (2, None),
+        (5, 10),
+        (6, 20),
+    ]
+
+    # ディスクから消えたファイルの行は取り除く
+    b.unlink()
+    assert catalog.sync(HiveDataset([a], data_dir)) == {"added": 0, "removed": 1}
+    con.close()
+
+    con = duckdb.connect()
+    catalog = open_catalog(con, data_dir / CATALOG_NAME)
+    assert catalog.sync(HiveDataset([a], data_dir)) == {"added": 0, "removed": 0}
+    assert [r[1] for r in rows(con, catalog, [a])] == [1, 2]
@@ -0,0 +1,74 @@
+import sys
+import threading
+from concurrent.futures import CancelledError
+from pathlib import Path
+from time import perf_counter
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import pytest
+
+from duckdb_session import ConnectionManager
+from query_budget import QueryTimeout
+
+
+def test_sessions_have_private_views_and_share_tables():
+    """
+    セッションごとのカーソルの TEMP VIEW は同じ名前でも衝突せず、共有のテーブルは
+    スレッドプールのカーソルから並列に参照でき、設定がデータベースに反映されることを確認する。
+    """
+    manager = ConnectionManager(threads=2, memory_limit="1GB", max_workers=2)
+    first = manager.session_cursor()
+    second = manager.session_cursor()
+    first.execute("CREATE OR REPLACE TEMP VIEW source_data AS SELECT 1 AS x")
+    second.execute("CREATE OR REPLACE TEMP VIEW source_data AS SELECT 2 AS x")
+    assert first.execute("SELECT x FROM source_data").fetchone() == (1,)
+    assert second.execute("SELECT x FROM source_data").fetchone() == (2,)
+    assert first.execute("SELECT current_setting('threads')").fetchone() == (2,)
+
+    first.execute("CREATE TABLE shared AS SELECT range AS x FROM range(100)")
+    # 2つのクエリが同時に実行中になることを確認する
+    barrier = threading.Barrier(2, timeout=10)
+
+    def query(sql: str):
+        def task(cursor):
+            barrier.wait()
+            return cursor.execute(sql).fetchone()[0]
+
+        return task
+
+    results = manager.run_parallel(
+        {
+            "count": query("SELECT COUNT(*) FROM shared"),
+            "sum": query("SELECT SUM(x) FROM shared"),
+        }
+    )
+    assert results == {"count": 100, "sum": 4950}
+
+
+def test_query_over_budget_is_interrupted():
+    """
+    時間の予算を超えたクエリは中断されて QueryTimeout になり、待っている間の例外でも
+    クエリが中断され、スレッドのカーソルはその後のクエリに使えることを確認する。
+    """
+    manager = ConnectionManager(max_workers=1, query_timeout=0.2)
+    slow = "SELECT COUNT(*) FROM range(100000000000) t(x) WHERE x % 7 = 3"
+
+    start = perf_counter()
+    with pytest.raises(QueryTimeout):
+        manager.submit(lambda cursor: cursor.execute(slow).fetchone()).result()
+    assert perf_counter() - start < 10
+
+    def abandon(elapsed: float) -> None:
+        raise KeyboardInterrupt
+
+    task = manager.submit(lambda cursor: cursor.execute(slow).fetchone(), timeout=60)
+    with pytest.raises(KeyboardInterrupt):
+        task.result(on_wait=abandon)
+    with pytest.raises((duckdb.InterruptException, CancelledError)):
+        task.future.result(timeout=10)
+
+    task = manager.submit(lambda cursor: cursor.execute("SELECT 42").fetchone())
+    assert task.result() == (42,)
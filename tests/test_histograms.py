@@ -0,0 +1,49 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import numpy as np
+import polars as pl
+
+from histograms import box_stats_query, histogram_query
+
+
+def test_histogram_and_box_stats_match_numpy():
+    """
+    DuckDBで集計したビンごとの件数と四分位数が numpy の計算と一致し、
+    近似分位点を範囲にした場合は範囲外の値が両端のビンに含まれることを確認する。
+    """
+    rng = np.random.default_rng(0)
+    scores = rng.integers(-500, 2500, size=50_000)
+    events = pl.DataFrame({"SCORE": scores, "is_fraud": scores % 7 == 0})
+    con = duckdb.connect()
+    con.register("events", events.to_arrow())
+
+    hist = pl.from_arrow(
+        con.execute(histogram_query("events", "SCORE", "is_fraud", bins=30)).arrow()
+    )
+    edges = np.linspace(scores.min(), scores.max(), 31)
+    for is_fraud in [False, True]:
+        expected, _ = np.histogram(scores[(scores % 7 == 0) == is_fraud], bins=edges)
+        bins = hist.filter(pl.col("is_fraud") == is_fraud)
+        assert bins["count"].to_list() == expected[expected > 0].tolist()
+        np.testing.assert_allclose(bins["bin_start"], edges[:-1][expected > 0])
+
+    clipped = pl.from_arrow(
+        con.execute(histogram_query("events", "SCORE", bins=10, tail=0.05)).arrow()
+    )
+    assert clipped["count"].sum() == len(scores)
+    assert clipped["bin_start"].min() > scores.min()
+
+    stats = con.execute(box_stats_query("events", "SCORE")).fetchdf()
+    q1, median, q3 = np.quantile(scores, [0.25, 0.5, 0.75])
+    # 近似分位点の誤差は値の範囲の1%以内とする
+    tolerance = (scores.max() - scores.min()) * 0.01
+    assert abs(stats["q1"][0] - q1) < tolerance
+    assert abs(stats["median"][0] - median) < tolerance
+    assert abs(stats["q3"][0] - q3) < tolerance
+    assert stats["count"][0] == len(scores)
+    assert stats["lower_fence"][0] == scores.min()
@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+
+from materialized import MaterializedTables
+
+
+def test_tables_are_reused_and_evicted_under_memory_limit():
+    """
+    同じ条件ではテーブルを作り直さずに再利用し、使用メモリが上限を超えると
+    最も長く参照されていない条件のテーブルから削除されることを確認する。
+    """
+    con = duckdb.connect()
+    con.execute("CREATE TABLE source AS SELECT range AS x FROM range(1000000)")
+    tables = MaterializedTables(con, max_bytes=1)
+
+    def query(mod: int) -> str:
+        return f"SELECT x FROM source WHERE x % {mod} = 0"
+
+    first = tables.get("a", query(2))
+    assert con.execute(f"SELECT COUNT(*) FROM {first}").fetchone()[0] == 500000
+    con.execute(f"DELETE FROM {first} WHERE x > 10")
+    # 同じキーでは作り直さない
+    assert tables.get("a", query(2)) == first
+    assert con.execute(f"SELECT COUNT(*) FROM {first}").fetchone()[0] == 6
+
+    second = tables.get("b", query(3))
+    assert second != first
+    assert list(tables.tables) == ["b"]
+    existing = con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE database_name = 'scratch'"
+    ).fetchall()
+    assert existing == [(second.split(".")[1],)]
@@ -0,0 +1,68 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from preprocess_rules import apply_arrow, apply_polars, default_rules, profile_rules
+
+
+@pytest.fixture
+def raw_df() -> pl.DataFrame:
+    """
+    読み込み直後（型変換前）の状態を模したテストデータ。
+    """
+    return pl.DataFrame(
+        {
+            "SCORE": [None, 600.0, 1600.0, None, 100.0],
+            "EVENT_VALUE": [1.0, None, 3.0, None, 5.0],
+            "is_fraud": ["True", "false", None, None, "1"],
+            "EVENT_TIME": [
+                None,
+                "2023-01-15T12:00:00",
+                "not a date",
+                None,
+                "2023-03-01 08:30:00.250",
+            ],
+            "string_col": ["A", None, "C", None, None],
+            "numeric_col_1": [1.0, None, 3.0, None, None],
+        }
+    )
+
+
+def test_polars_and_arrow_paths_agree(raw_df: pl.DataFrame):
+    """
+    同じルールから生成した Polars の計画と Arrow の計算が同じ結果になることを確認する。
+    """
+    rules = default_rules([500, 1500])
+    polars_result = apply_polars(rules, raw_df.lazy()).collect()
+    arrow_result = pl.from_arrow(apply_arrow(rules, raw_df.to_arrow()))
+    assert_frame_equal(
+        polars_result,
+        arrow_result.with_columns(pl.col(pl.Datetime).dt.cast_time_unit("us")),
+    )
+
+    # 全列が欠損値の行は削除される
+    assert polars_result.height == 4
+    assert polars_result["SCORE"].to_list() == [0.0, 600.0, 1600.0, 100.0]
+    assert polars_result["is_fraud"].to_list() == [True, False, False, True]
+    assert polars_result["score_level"].to_list() == ["low", "mid", "high", "low"]
+    assert polars_result["string_col"].to_list() == ["A", "unknown", "C", "unknown"]
+    # 先頭の欠損は直後の値、解釈できない値は直前の値で補完される
+    assert polars_result["EVENT_TIME"].to_list()[:3] == [datetime(2023, 1, 15, 12)] * 3
+    assert polars_result["event_month"].to_list()[-1] == datetime(2023, 3, 1)
+
+
+def test_profile_rules_reports_every_step(raw_df: pl.DataFrame):
+    """
+    ルールごとの処理時間と、融合した計画の処理時間が報告されることを確認する。
+    """
+    rules = default_rules([500, 1500])
+    profile = profile_rules(rules, raw_df)
+    assert profile.height == len(rules) + 1
+    assert (profile["polars_ms"] >= 0).all()
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+
+from query_builder import PreparedConnection, QueryBuilder
+
+
+def test_prepared_statement_is_reused_across_parameters():
+    """
+    パラメータだけが変わる問い合わせは同じ文を再利用し、引用符を含む値や
+    数値の列と文字列の値の比較でも正しい結果になることを確認する。
+    """
+    con = PreparedConnection(duckdb.connect())
+    con.execute(
+        "CREATE TABLE t AS SELECT * FROM (VALUES (1, 'a'), (2, 'O''Brien'), (3, 'c')) v(id, name)"
+    )
+
+    results = []
+    for names in (["a"], ["O'Brien", "c"]):
+        query = QueryBuilder()
+        sql = f"SELECT id FROM t WHERE {query.in_list('name', names)} ORDER BY id"
+        results.append([row[0] for row in con.execute(sql, query.params).fetchall()])
+    assert results == [[1], [2, 3]]
+    assert con.prepared == 1
+
+    query = QueryBuilder()
+    sql = f"SELECT name FROM t WHERE {query.in_list('id', ['2'], 'BIGINT')}"
+    assert con.execute(sql, query.params).fetchall() == [("O'Brien",)]
+
+
+def test_replaced_view_is_prepared_again():
+    """
+    参照するビューを作り直した場合、古い定義を取り込んだ文を再利用しないことを確認する。
+    """
+    con = PreparedConnection(duckdb.connect())
+    sql = "SELECT x FROM v WHERE x >= $1"
+    con.execute("CREATE OR REPLACE TEMP VIEW v AS SELECT 1 AS x")
+    assert con.execute(sql, [0]).fetchall() == [(1,)]
+    con.execute("CREATE OR REPLACE TEMP VIEW v AS SELECT 2 AS x")
+    assert con.execute(sql, [0]).fetchall() == [(2,)]
+    assert con.prepared == 2
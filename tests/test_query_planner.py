@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from query_budget import QueryTimeout
+from query_planner import QueryPlanner, collect_cancellable
+from query_profiler import polars_profile_ranking
+
+
+def test_derived_aggregates_match_direct_queries(tmp_path: Path):
+    """
+    1回のスキャンから導出した集計が、集計ごとに collect した結果と一致することを確認する。
+    """
+    path = tmp_path / "data.parquet"
+    pl.DataFrame(
+        {
+            "category": ["a", "b", "a", "c", "b", "a"],
+            "is_fraud": [False, True, False, False, True, True],
+            "EVENT_VALUE": [10, 20, 30, 40, 50, 60],
+        }
+    ).write_parquet(path)
+    lf = pl.scan_parquet(path)
+
+    planner = QueryPlanner()
+    planner.add(
+        "base",
+        lf.group_by("category", "is_fraud").agg(
+            pl.len().alias("record_count"), pl.sum("EVENT_VALUE")
+        ),
+    )
+    planner.derive(
+        "fraud_options", lambda r: r["base"].select(pl.col("is_fraud").unique().sort())
+    )
+    planner.derive(
+        "by_category",
+        lambda r: r["base"]
+        .group_by("category")
+        .agg(pl.sum("record_count"), pl.sum("EVENT_VALUE"))
+        .sort("category"),
+    )
+    results = planner.execute()
+
+    assert_frame_equal(
+        results["fraud_options"], lf.select(pl.col("is_fraud").unique().sort()).collect()
+    )
+    assert_frame_equal(
+        results["by_category"],
+        lf.group_by("category")
+        .agg(pl.len().cast(pl.UInt32).alias("record_count"), pl.sum("EVENT_VALUE"))
+        .sort("category")
+        .collect(),
+    )
+    assert planner.scans == 1
+    assert planner.scans_saved == 2
+
+    # 実行後に追加した導出集計は、再スキャンせずに計算される
+    planner.derive("total", lambda r: r["base"].select(pl.sum("record_count")))
+    assert planner.execute()["total"].item() == 6
+    assert planner.scans == 1
+
+
+def test_profile_records_each_query():
+    """
+    profile=True の場合、集計ごとのプロファイルが記録され、結果は通常の実行と一致することを確認する。
+    """
+    lf = pl.LazyFrame({"category": ["a", "b", "a"], "EVENT_VALUE": [1, 2, 3]})
+    planner = QueryPlanner(profile=True)
+    planner.add("by_category", lf.group_by("category").agg(pl.sum("EVENT_VALUE")))
+    results = planner.execute()
+
+    assert_frame_equal(
+        results["by_category"].sort("category"),
+        pl.DataFrame({"category": ["a", "b"], "EVENT_VALUE": [4, 2]}),
+    )
+    profile = planner.profiles["by_category"]
+    assert profile["rows"] == 2
+    assert profile["nodes"]
+    assert polars_profile_ranking(planner.profiles)["label"].to_list() == ["by_category"]
+
+
+def test_collect_over_budget_is_cancelled():
+    """
+    時間の予算を超えた集計は取り消されて QueryTimeout になり、
+    予算内に終わる集計は pl.collect_all と同じ結果になることを確認する。
+    """
+    lf = pl.LazyFrame({"x": pl.int_range(0, 1000, eager=True)})
+    assert collect_cancellable([lf.select(pl.sum("x"))], timeout=10)[0].item() == 499500
+
+    slow = (
+        pl.LazyFrame({"x": pl.int_range(0, 30_000_000, eager=True)})
+        .select(pl.col("x").hash(1).sort().sum())
+    )
+    with pytest.raises(QueryTimeout):
+        collect_cancellable([slow], timeout=0.001)
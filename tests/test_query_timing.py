@@ -0,0 +1,61 @@
+import json
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import polars as pl
+
+from query_profiler import format_profile
+from query_timing import QueryTimings
+from result_cache import ResultCache
+
+
+def test_fetch_records_query_and_conversion_times():
+    """
+    結果をPolarsで受け取り、クエリ時間・変換時間・キャッシュヒットが記録され、
+    pandasへの変換では指定した列だけが変換されることを確認する。
+    """
+    con = duckdb.connect()
+    query = "SELECT range AS x, range::VARCHAR AS label FROM range(1000)"
+    cache = ResultCache()
+
+    timings = QueryTimings()
+    frame = timings.fetch_cached(cache, "key", con, query, "range")
+    assert isinstance(frame, pl.DataFrame)
+    assert frame.height == 1000
+    converted = timings.to_pandas(frame, "range", ["x"])
+    assert list(converted.columns) == ["x"]
+
+    record = timings.summary().row(0, named=True)
+    assert record["rows"] == 1000
+    assert not record["cached"]
+    assert record["query_ms"] >= 0 and record["convert_ms"] >= 0
+    assert record["pandas_ms"] >= 0
+
+    timings = QueryTimings()
+    assert timings.fetch_cached(cache, "key", con, query, "range").equals(frame)
+    record = timings.summary().row(0, named=True)
+    assert record["cached"]
+    assert record["query_ms"] is None
+
+
+def test_profile_records_scan_metrics_and_plan():
+    """
+    profile=True の場合、スキャンした行数・バイト数と実行計画が記録され、
+    時間のかかった順の表とトレースのJSONが作れることを確認する。
+    """
+    con = duckdb.connect()
+    con.execute("CREATE TABLE t AS SELECT range AS x FROM range(10000)")
+    timings = QueryTimings(profile=True)
+    frame = timings.fetch(con, "SELECT SUM(x) AS total FROM t WHERE x % 2 = 0", "sum")
+    assert frame["total"][0] == sum(range(0, 10000, 2))
+
+    record = timings.ranking().row(0, named=True)
+    assert record["rows_scanned"] == 10000
+    assert record["scan_bytes"] > 0
+    assert record["total_ms"] > 0
+    assert "SEQ_SCAN" in format_profile(timings.profiles["sum"])
+    assert json.loads(timings.trace())[0]["profile"]["cumulative_rows_scanned"] == 10000
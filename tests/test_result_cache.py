@@ -0,0 +1,73 @@
+import os
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import pandas as pd
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from query_planner import QueryPlanner
+from result_cache import ResultCache, dataset_fingerprint, frame_nbytes, result_key
+
+
+def test_lru_eviction_and_disk_persistence(tmp_path: Path):
+    """
+    バイト数の上限を超えると古い結果から破棄され、ディスクに保存した結果は
+    別のキャッシュ（アプリの再起動後）からも読み込めることを確認する。
+    """
+    frames = {
+        name: pl.DataFrame({"value": list(range(1000))}) for name in ["a", "b", "c"]
+    }
+    budget = frame_nbytes(frames["a"]) * 2
+    cache = ResultCache(max_bytes=budget, persist_dir=tmp_path)
+    for name, frame in frames.items():
+        cache.put(name, frame)
+
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.nbytes <= budget
+
+    restarted = ResultCache(max_bytes=budget, persist_dir=tmp_path)
+    assert_frame_equal(restarted.get("a"), frames["a"])
+    assert restarted.get("missing") is None
+    assert (restarted.hits, restarted.misses) == (1, 1)
+
+    # pandas の結果は呼び出し側で変更してもキャッシュに影響しない
+    cache.put("pandas", pd.DataFrame({"x": [1, 2]}))
+    cache.get("pandas")["x"] = 0
+    assert cache.get("pandas")["x"].tolist() == [1, 2]
+
+
+def test_key_changes_with_data_and_ignores_whitespace(tmp_path: Path):
+    """
+    ファイルが更新されるとキーが変わり、SQLの空白の違いではキーが変わらないことを確認する。
+    """
+    path = tmp_path / "data.parquet"
+    pl.DataFrame({"value": [1]}).write_parquet(path)
+    before = dataset_fingerprint([path])
+
+    assert result_key(before, "SELECT  1\n FROM t") == result_key(before, "SELECT 1 FROM t")
+
+    pl.DataFrame({"value": [1, 2]}).write_parquet(path)
+    os.utime(path, ns=(0, 1))
+    assert dataset_fingerprint([path]) != before
+
+
+def test_planner_reuses_cached_aggregates(tmp_path: Path):
+    """
+    同じデータ・同じ集計は、2回目以降スキャンせずにキャッシュから返されることを確認する。
+    """
+    path = tmp_path / "data.parquet"
+    pl.DataFrame({"category": ["a", "b", "a"]}).write_parquet(path)
+    cache = ResultCache()
+
+    for expected_scans in [1, 0]:
+        planner = QueryPlanner(cache=cache, fingerprint=dataset_fingerprint([path]))
+        planner.add(
+            "base", pl.scan_parquet(path).group_by("category").len().sort("category")
+        )
+        result = planner.execute()["base"]
+        assert planner.scans == expected_scans
+        assert result["len"].to_list() == [2, 1]
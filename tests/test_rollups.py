@@ -0,0 +1,113 @@
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from rollups import (
+    RollupPyramid,
+    category_ratio,
+    hourly_rollup,
+    rank_categories,
+    top_n_other,
+    weekday_hour,
+)
+
+
+def test_pyramid_levels_match_raw_aggregation():
+    """
+    1時間単位のロールアップから導出した日・週・月単位の集計と上位カテゴリ + Other の集計が、
+    生データを直接集計した結果と一致することを確認する。
+    """
+    n = 5000
+    raw = pl.DataFrame(
+        {
+            "EVENT_TIME": [
+                datetime(2023, 1, 1) + timedelta(minutes=13 * i) for i in range(n)
+            ],
+            "category": [["a", "b", "c", "d"][i * 7 % 4] for i in range(n)],
+            "EVENT_VALUE": [i % 97 for i in range(n)],
+        }
+    )
+    hourly = hourly_rollup(
+        raw.lazy(),
+        ["category"],
+        [pl.len().alias("record_count"), pl.sum("EVENT_VALUE").alias("event_value_sum")],
+    ).collect()
+    assert hourly.height < n
+    pyramid = RollupPyramid(hourly, ["category"])
+
+    for every in ["1d", "1w", "1mo"]:
+        expected = (
+            raw.group_by(
+                pl.col("EVENT_TIME").dt.truncate(every).alias("time_agg"), "category"
+            )
+            .agg(
+                pl.len().alias("record_count"),
+                pl.sum("EVENT_VALUE").alias("event_value_sum"),
+            )
+            .sort("time_agg", "category")
+        )
+        assert_frame_equal(
+            pyramid.level(every).sort("time_agg", "category"),
+            expected,
+            check_dtypes=False,
+        )
+
+    top_by_value = rank_categories(hourly, "category", "event_value_sum", "合計")
+    assert top_by_value["合計"].sum() == raw["EVENT_VALUE"].sum()
+
+    top_cats = top_by_value.head(2)["category"].to_list()
+    summary = top_n_other(pyramid.level("1mo"), "category", top_cats, "event_value_sum")
+    assert set(summary["category_group"]) == {*top_cats, "Other"}
+    assert summary["event_value_sum"].sum() == raw["EVENT_VALUE"].sum()
+
+
+def test_weekday_hour_and_ratio_match_raw_aggregation():
+    """
+    1時間単位のロールアップから求めた曜日 × 時間帯の件数とカテゴリ別の比率が、
+    生データを直接集計した結果と一致することを確認する。
+    """
+    n = 3000
+    raw = pl.DataFrame(
+        {
+            "EVENT_TIME": [
+                datetime(2023, 1, 1) + timedelta(minutes=37 * i) for i in range(n)
+            ],
+            "category": [["a", "b", "c"][i * 5 % 3] for i in range(n)],
+            "is_fraud": [i % 11 == 0 for i in range(n)],
+        }
+    )
+    hourly = hourly_rollup(
+        raw.lazy(),
+        ["category"],
+        [pl.len().alias("record_count"), pl.sum("is_fraud").alias("fraud_count")],
+    ).collect()
+
+    expected = (
+        raw.group_by(
+            pl.col("EVENT_TIME").dt.weekday().alias("day_of_week"),
+            pl.col("EVENT_TIME").dt.hour().alias("hour_of_day"),
+        )
+        .agg(pl.len().alias("record_count"))
+        .sort("day_of_week", "hour_of_day")
+    )
+    assert_frame_equal(
+        weekday_hour(hourly, "record_count"), expected, check_dtypes=False
+    )
+
+    rates = category_ratio(
+        hourly, "category", ["a", "b"], "fraud_count", "record_count", "rate"
+    ).sort("category")
+    expected = (
+        raw.filter(pl.col("category").is_in(["a", "b"]))
+        .group_by("category")
+        .agg(pl.len().alias("record_count"), pl.sum("is_fraud").alias("fraud_count"))
+        .with_columns((pl.col("fraud_count") / pl.col("record_count")).alias("rate"))
+        .sort("category")
+    )
+    assert_frame_equal(rates, expected, check_dtypes=False)
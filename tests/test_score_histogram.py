@@ -0,0 +1,65 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from histograms import histogram_query
+from score_histogram import ScoreHistogram, score_counts, score_counts_query
+
+
+def test_confusion_and_bins_match_direct_aggregation():
+    """
+    スコアごとの件数から求めた混合行列とヒストグラムが、全行を直接集計した結果と
+    一致することを確認する。
+    """
+    rng = np.random.default_rng(0)
+    scores = rng.integers(-500, 2500, size=50_000)
+    events = pl.DataFrame({"SCORE": scores, "is_fraud": rng.random(50_000) < 0.1})
+    con = duckdb.connect()
+    con.register("events", events.to_arrow())
+
+    counts = pl.from_arrow(con.execute(score_counts_query("events")).arrow())
+    assert counts.height == len(np.unique(scores))
+    histogram = ScoreHistogram(counts)
+
+    for threshold, adjustment in [(1500, 0), (1500, 120), (0, -37), (-10_000, 0)]:
+        predicted = events["SCORE"] + adjustment >= threshold
+        actual = events["is_fraud"]
+        assert histogram.confusion(threshold, adjustment) == {
+            "tp": (predicted & actual).sum(),
+            "fp": (predicted & ~actual).sum(),
+            "tn": (~predicted & ~actual).sum(),
+            "fn": (~predicted & actual).sum(),
+        }
+
+    expected = pl.from_arrow(
+        con.execute(histogram_query("events", "SCORE", "is_fraud", bins=40)).arrow()
+    )
+    assert_frame_equal(histogram.binned(bins=40), expected, check_dtypes=False)
+
+
+def test_score_counts_from_pre_aggregated_counts():
+    """
+    集計済みの件数（weight）から求めたスコアごとの件数が、行から直接求めた件数と
+    一致することを確認する。
+    """
+    rng = np.random.default_rng(1)
+    events = pl.DataFrame(
+        {
+            "SCORE": rng.integers(0, 100, size=5_000),
+            "is_fraud": rng.random(5_000) < 0.2,
+            "score_level": rng.choice(["low", "mid", "high"], size=5_000),
+        }
+    )
+    aggregated = events.group_by("SCORE", "is_fraud", "score_level").agg(
+        pl.len().alias("count")
+    )
+    assert_frame_equal(
+        score_counts(aggregated, weight="count"), score_counts(events)
+    )
@@ -0,0 +1,68 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from segment_metrics import ALL_SEGMENTS, segment_metrics, segment_score_counts_query
+
+
+def test_segment_metrics_match_per_segment_evaluation():
+    """
+    1回の集計から求めたセグメントごとの混合行列が、セグメントごとに全行を
+    絞り込んで評価した結果と一致し、軸の組み合わせと全体を含むことを確認する。
+    """
+    rng = np.random.default_rng(0)
+    events = pl.DataFrame(
+        {
+            "channel": rng.choice(["web", "app", "pos"], size=10_000),
+            "region": rng.integers(0, 4, size=10_000),
+            "SCORE": rng.integers(0, 2000, size=10_000),
+            "is_fraud": rng.random(10_000) < 0.1,
+        }
+    )
+    con = duckdb.connect()
+    con.register("events", events.to_arrow())
+    dims = ["channel", "region"]
+    counts = pl.from_arrow(
+        con.execute(segment_score_counts_query("events", dims)).arrow()
+    )
+
+    threshold, adjustment = 1500, 100
+    metrics = segment_metrics(counts, dims, threshold, adjustment)
+    assert metrics.height == 1 + 3 + 4 + 3 * 4
+    assert metrics["segment"][0] == ALL_SEGMENTS
+
+    def expected(keys: list[str]) -> pl.DataFrame:
+        predicted = pl.col("SCORE") + adjustment >= threshold
+        actual = pl.col("is_fraud")
+        return (
+            events.group_by(keys)
+            .agg(
+                (predicted & actual).sum().alias("tp"),
+                (predicted & ~actual).sum().alias("fp"),
+                (~predicted & ~actual).sum().alias("tn"),
+                (~predicted & actual).sum().alias("fn"),
+            )
+            .sort(keys)
+        )
+
+    assert_frame_equal(
+        metrics.filter(segment="channel × region")
+        .select(*dims, "tp", "fp", "tn", "fn")
+        .sort(dims),
+        expected(dims),
+        check_dtypes=False,
+    )
+    assert_frame_equal(
+        metrics.filter(segment="region")
+        .select("region", "tp", "fp", "tn", "fn")
+        .sort("region"),
+        expected(["region"]),
+        check_dtypes=False,
+    )
@@ -0,0 +1,64 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import numpy as np
+import polars as pl
+from sklearn.metrics import (
+    average_precision_score,
+    f1_score,
+    precision_score,
+    recall_score,
+    roc_auc_score,
+)
+
+from score_histogram import ScoreHistogram, score_counts
+from threshold_sweep import (
+    OBJECTIVE_COST,
+    OBJECTIVE_F1,
+    average_precision,
+    best_threshold,
+    roc_auc,
+    threshold_sweep,
+)
+
+
+def test_sweep_matches_per_threshold_evaluation():
+    """
+    全閾値を一度に求めた評価指標・AUC・最適な閾値が、閾値ごとに全行で評価した結果と
+    一致することを確認する。
+    """
+    rng = np.random.default_rng(0)
+    is_fraud = rng.random(20_000) < 0.05
+    scores = rng.integers(0, 1000, size=20_000) + is_fraud * 300
+    events = pl.DataFrame({"SCORE": scores, "is_fraud": is_fraud})
+
+    adjustment = 25
+    sweep = threshold_sweep(
+        ScoreHistogram(score_counts(events)), adjustment, fp_cost=1.0, fn_cost=20.0
+    )
+    assert sweep.height == len(np.unique(scores)) + 1
+
+    adjusted = scores + adjustment
+    for row in sweep.filter(pl.col("threshold").is_finite()).gather_every(97).iter_rows(
+        named=True
+    ):
+        predicted = adjusted >= row["threshold"]
+        assert np.isclose(row["precision"], precision_score(is_fraud, predicted))
+        assert np.isclose(row["recall"], recall_score(is_fraud, predicted))
+        assert np.isclose(row["f1"], f1_score(is_fraud, predicted))
+        assert row["cost"] == (predicted & ~is_fraud).sum() + 20 * (~predicted & is_fraud).sum()
+
+    assert np.isclose(roc_auc(sweep), roc_auc_score(is_fraud, scores))
+    assert np.isclose(average_precision(sweep), average_precision_score(is_fraud, scores))
+
+    candidates = np.append(np.unique(adjusted), np.inf)
+    costs = [
+        ((adjusted >= t) & ~is_fraud).sum() + 20 * ((adjusted < t) & is_fraud).sum()
+        for t in candidates
+    ]
+    f1s = [f1_score(is_fraud, adjusted >= t) for t in candidates]
+    assert best_threshold(sweep, OBJECTIVE_COST)["cost"] == min(costs)
+    assert np.isclose(best_threshold(sweep, OBJECTIVE_F1)["f1"], max(f1s))
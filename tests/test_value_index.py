@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import duckdb
+import numpy as np
+import polars as pl
+
+from value_index import ValueIndexes
+
+
+def test_prefix_search_and_top_values(tmp_path):
+    """
+    インデックスの前方一致の検索と出現頻度の上位の値が、全件を直接集計した結果と一致し、
+    2回目以降は作成し直さずに同じファイルを使うことを確認する。
+    """
+    rng = np.random.default_rng(0)
+    users = pl.Series("user", [f"user_{i}" for i in rng.integers(0, 5000, size=50_000)])
+    events = pl.DataFrame([users, pl.Series("n", rng.integers(0, 50, size=50_000))])
+    con = duckdb.connect()
+    con.register("events", events.to_arrow())
+    indexes = ValueIndexes(tmp_path)
+
+    index = indexes.get(con, "events", "user", "fingerprint")
+    counts = events["user"].value_counts()
+    assert index.size() == counts.height
+
+    expected = sorted(u for u in counts["user"] if u.startswith("user_12"))
+    assert index.search("user_12", limit=1000)["value"].to_list() == expected
+    assert index.search("user_12", limit=5)["value"].to_list() == expected[:5]
+    assert index.search("nobody").is_empty()
+
+    top = counts.sort(["count", "user"], descending=[True, False]).head(10)
+    assert index.top(10)["value"].to_list() == top["user"].to_list()
+    assert index.top(10)["count"].to_list() == top["count"].to_list()
+
+    # 数値の列は値の型を保ち、文字列表現の前方一致で検索する
+    numbers = indexes.get(con, "events", "n", "fingerprint")
+    assert numbers.search("4")["value"].to_list() == [4, *range(40, 50)]
+
+    built = index.path.stat().st_mtime_ns
+    con.execute("DROP VIEW events")
+    assert indexes.get(con, "events", "user", "fingerprint").path == index.path
+    assert index.path.stat().st_mtime_ns >= built
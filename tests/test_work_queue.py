@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+# プロジェクトルートをsys.pathに追加
+sys.path.append(str(Path(__file__).parent.parent))
+
+import polars as pl
+
+from data_loader import DataLoader, run_local_worker
+from dataset import list_data_files
+from work_queue import LeaseQueue
+
+
+def test_claim_is_exclusive_and_stale_lease_is_reclaimed(tmp_path: Path):
+    """
+    リースは1ワーカーのみが取得でき、期限切れのリースは他のワーカーが回収できることを確認する。
+    """
+    worker_a = LeaseQueue(tmp_path, "worker-a", lease_ttl=60)
+    worker_b = LeaseQueue(tmp_path, "worker-b", lease_ttl=60)
+
+    assert worker_a.try_claim("input/a.tsv")
+    assert not worker_b.try_claim("input/a.tsv")
+
+    # worker-a のハートビートが途絶えたものとして mtime を過去にずらす
+    stale_time = time.time() - 120
+    os.utime(worker_a.lease_path("input/a.tsv"), (stale_time, stale_time))
+    assert worker_b.try_claim("input/a.tsv")
+    assert worker_b.owns("input/a.tsv")
+    assert not worker_a.renew("input/a.tsv")
+
+    # リースを失ったワーカーは結果を記録できない
+    assert not worker_a.complete("input/a.tsv")
+    assert not worker_a.is_finished("input/a.tsv")
+
+    assert worker_b.complete("input/a.tsv")
+    assert worker_a.is_finished("input/a.tsv")
+    assert not worker_a.try_claim("input/a.tsv")
+
+
+def test_local_worker_processes_share_queue(tmp_path: Path):
+    """
+    複数のローカルワーカープロセスが、各入力ファイルをちょうど1回ずつ処理することを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    num_files = 6
+    for i in range(num_files):
+        pl.DataFrame(
+            {
+                "SCORE": [i, 1000 + i],
+                "EVENT_VALUE": [1, 2],
+                "is_fraud": [False, True],
+                "EVENT_TIME": ["2023-01-01 00:00:00", "2023-01-02 00:00:00"],
+            }
+        ).write_csv(input_dir / f"part_{i}.tsv", separator="\t")
+
+    loader_kwargs = dict(
+        input_dir=input_dir,
+        output_dir=tmp_path / "output",
+        score_thresholds=[500, 1500],
+        partitioned=False,
+        to_duckdb=False,
+        duckdb_path=tmp_path / "data.duckdb",
+        temp_dir=tmp_path / "temp",
+        queue_dir=tmp_path / "queue",
+        lease_ttl=30.0,
+    )
+    processes = [
+        multiprocessing.get_context("spawn").Process(
+            target=run_local_worker, args=(loader_kwargs, f"worker-{i}")
+        )
+        for i in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    files = list_data_files(tmp_path / "output")
+    assert sorted(f.name for f in files) == [
+        f"part_{i}.parquet" for i in range(num_files)
+    ]
+    assert pl.read_parquet(files).height == num_files * 2
+    assert len(list((tmp_path / "queue" / "done").glob("*.done"))) == num_files
+    assert not list((tmp_path / "queue" / "leases").iterdir())
+
+
+def test_hold_waits_for_other_worker(tmp_path: Path):
+    """
+    出力先のロックは、他のワーカーが解放するまで取得できないことを確認する。
+    """
+    worker_a = LeaseQueue(tmp_path, "worker-a", lease_ttl=60)
+    worker_b = LeaseQueue(tmp_path, "worker-b", lease_ttl=60)
+    events = []
+
+    def hold_b():
+        with worker_b.hold("output:events", poll_interval=0.01):
+            events.append("b")
+
+    with worker_a.hold("output:events"):
+        thread = threading.Thread(target=hold_b)
+        thread.start()
+        time.sleep(0.2)
+        events.append("a")
+    thread.join(timeout=10)
+
+    assert events == ["a", "b"]
+    assert not list((tmp_path / "leases").iterdir())
+
+
+def test_changed_and_failed_inputs_are_retried(tmp_path: Path):
+    """
+    内容が差し替えられた入力は再処理され、失敗した入力は --retry-failed で再試行されることを確認する。
+    """
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    input_file = input_dir / "events.tsv"
+    pl.DataFrame(
+        {
+            "SCORE": [100],
+            "EVENT_VALUE": [1],
+            "is_fraud": [False],
+            "EVENT_TIME": ["2023-01-01 00:00:00"],
+        }
+    ).write_csv(input_file, separator="\t")
+    (input_dir / "broken.tar.gz").write_bytes(b"not a tar file")
+
+    def run_worker(**kwargs) -> DataLoader:
+        loader = DataLoader(
+            input_dir=input_dir,
+            output_dir=tmp_path / "output",
+            score_thresholds=[500, 1500],
+            partitioned=False,
+            to_duckdb=False,
+            duckdb_path=tmp_path / "data.duckdb",
+            temp_dir=tmp_path / "temp",
+            queue_dir=tmp_path / "queue",
+            worker_id="worker-a",
+            **kwargs,
+        )
+        loader.run()
+        return loader
+
+    first = run_worker()
+    assert first.failed_files == [input_dir / "broken.tar.gz"]
+    assert not (tmp_path / "temp").exists()
+
+    # 失敗した入力は再試行しない。内容が変わった入力は別名で公開する
+    pl.DataFrame(
+        {
+            "SCORE": [200, 300],
+            "EVENT_VALUE": [2, 3],
+            "is_fraud": [False, True],
+            "EVENT_TIME": ["2023-01-02 00:00:00", "2023-01-03 00:00:00"],
+        }
+    ).write_csv(input_file, separator="\t")
+    second = run_worker()
+    assert second.failed_files == []
+    files = list_data_files(tmp_path / "output")
+    assert len(files) == 2
+    assert pl.read_parquet(files).height == 3
+
+    third = run_worker(retry_failed=True)
+    assert third.failed_files == [input_dir / "broken.tar.gz"]
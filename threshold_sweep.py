@@ -0,0 +1,105 @@
+import polars as pl
+
+from score_histogram import ScoreHistogram
+
+# 最適な閾値を選ぶ基準
+OBJECTIVE_F1 = "F1スコア最大"
+OBJECTIVE_COST = "コスト最小"
+
+
+def with_metrics(
+    confusion: pl.DataFrame, fp_cost: float = 1.0, fn_cost: float = 1.0
+) -> pl.DataFrame:
+    """
+    tp, fp, tn, fn の列を持つ表に precision, recall, fpr, f1, cost の列を加える。
+    分母が0になる指標（陽性と予測した行がない場合の precision など）は null にする。
+    cost は誤検出1件あたり fp_cost、見逃し1件あたり fn_cost とした損失の合計。
+    """
+    tp, fp, tn, fn = (pl.col(c) for c in ("tp", "fp", "tn", "fn"))
+
+    def ratio(numerator: pl.Expr, denominator: pl.Expr) -> pl.Expr:
+        return pl.when(denominator > 0).then(numerator / denominator)
+
+    return confusion.with_columns(
+        ratio(tp, tp + fp).alias("precision"),
+        ratio(tp, tp + fn).alias("recall"),
+        ratio(fp, fp + tn).alias("fpr"),
+        ratio(2 * tp, 2 * tp + fp + fn).alias("f1"),
+        (fp * fp_cost + fn * fn_cost).alias("cost"),
+    )
+
+
+def threshold_sweep(
+    histogram: ScoreHistogram,
+    adjustment: float = 0,
+    fp_cost: float = 1.0,
+    fn_cost: float = 1.0,
+) -> pl.DataFrame:
+    """
+    調整後スコアが threshold 以上を陽性と予測する場合の混合行列と評価指標を、
+    候補となる全ての閾値について求める（閾値の降順）。
+
+    予測が変わるのはスコアの値の境目だけなので、候補はスコアの値（に調整値を加えた値）と、
+    全件を陰性と予測する inf。ScoreHistogram の累積件数をそのまま並べるだけで求まり、
+    閾値を1つずつ変えて集計し直す必要がない。
+    """
+    fn = histogram.positives_below
+    tn = histogram.negatives_below
+    thresholds = pl.concat(
+        [
+            histogram.scores.cast(pl.Float64) + adjustment,
+            pl.Series([float("inf")]),
+        ]
+    )
+    sweep = pl.DataFrame(
+        {
+            "threshold": thresholds,
+            "tp": histogram.total_positives - fn,
+            "fp": histogram.total_negatives - tn,
+            "tn": tn,
+            "fn": fn,
+        }
+    ).sort("threshold", descending=True)
+    return with_metrics(sweep, fp_cost, fn_cost)
+
+
+def best_threshold(sweep: pl.DataFrame, objective: str = OBJECTIVE_F1) -> dict | None:
+    """
+    threshold_sweep の結果から、objective（F1スコア最大またはコスト最小）の基準で
+    最もよい閾値の行を返す。同点の場合は高い閾値（陽性と予測する件数が少ない方）を選ぶ。
+    """
+    if objective == OBJECTIVE_COST:
+        ranked = sweep.sort("cost", "threshold", descending=[False, True])
+    else:
+        ranked = sweep.drop_nulls("f1").sort(
+            "f1", "threshold", descending=[True, True]
+        )
+    if ranked.is_empty():
+        return None
+    return ranked.row(0, named=True)
+
+
+def roc_auc(sweep: pl.DataFrame) -> float | None:
+    """
+    ROC曲線（fpr に対する recall）の下の面積を台形公式で求める。
+    正例・負例のどちらかがない場合は定義できないため None を返す。
+    """
+    curve = sweep.sort("threshold", descending=True).drop_nulls(["fpr", "recall"])
+    if curve.is_empty():
+        return None
+    fpr = curve["fpr"]
+    tpr = curve["recall"]
+    return float(((fpr - fpr.shift(1)) * (tpr + tpr.shift(1)) / 2).sum())
+
+
+def average_precision(sweep: pl.DataFrame) -> float | None:
+    """
+    PR曲線の要約（平均適合率）。閾値を下げて recall が増えた分に、その閾値の
+    precision を掛けた和（scikit-learn の average_precision_score と同じ定義）。
+    """
+    curve = sweep.sort("threshold", descending=True).drop_nulls("recall")
+    if curve.is_empty():
+        return None
+    recall = curve["recall"]
+    precision = curve["precision"].fill_null(0.0)
+    return float(((recall - recall.shift(1, fill_value=0.0)) * precision).sum())
@@ -0,0 +1,152 @@
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import polars as pl
+
+from query_builder import quote_ident, sql_literal
+from result_cache import result_key
+
+# インデックスの行グループの行数。前方一致の検索では、範囲に重なる行グループだけを読む
+ROW_GROUP_SIZE = 64 * 1024
+
+# 作成時に保存しておく、出現頻度の上位の値の件数
+TOP_VALUES = 100
+
+# 前方一致の範囲の上限に使う文字（Unicodeの最大の符号位置）
+_MAX_CHAR = "\U0010ffff"
+
+
+class ValueIndex:
+    """
+    列の値の一覧（列 key, value, count）を、値の文字列表現 key の昇順に並べたParquetファイル。
+
+    前方一致の検索は key の範囲の条件になり、行グループごとの最小値・最大値の統計から
+    範囲に重なる行グループだけを読むため、値の種類数によらず短い時間で終わる。
+    出現頻度の上位の値は、作成時に別のファイル（.top.parquet）に保存しておく。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.top_path = path.with_name(f"{path.stem}.top.parquet")
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def build(self, con, source: str, column: str) -> None:
+        """
+        con で source の column 列の値ごとの件数を集計し、インデックスを作成する。
+        集計結果はPythonに取り込まずに、DuckDBから直接Parquetに書き出す。
+        """
+        tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_top = self.top_path.with_name(f"{self.top_path.name}.{uuid.uuid4().hex}.tmp")
+        col = quote_ident(column)
+        try:
+            con.execute(
+                f"""
+                COPY (
+                    SELECT CAST({col} AS VARCHAR) AS key, {col} AS value, COUNT(*) AS count
+                    FROM {source}
+                    WHERE {col} IS NOT NULL
+                    GROUP BY ALL
+                    ORDER BY key
+                ) TO {sql_literal(str(tmp))} (FORMAT parquet, ROW_GROUP_SIZE {ROW_GROUP_SIZE})
+                """
+            )
+            con.execute(
+                f"""
+                COPY (
+                    SELECT * FROM read_parquet({sql_literal(str(tmp))})
+                    ORDER BY count DESC, key
+                    LIMIT {TOP_VALUES}
+                ) TO {sql_literal(str(tmp_top))} (FORMAT parquet)
+                """
+            )
+            # インデックスの有無は本体のファイルで判定するため、上位の値を先に置き換える
+            os.replace(tmp_top, self.top_path)
+            os.replace(tmp, self.path)
+        finally:
+            for path in (tmp, tmp_top):
+                if path.exists():
+                    path.unlink()
+
+    def size(self) -> int:
+        """
+        値の種類数（Parquetのメタデータから求める）。
+        """
+        return pl.scan_parquet(self.path).select(pl.len()).collect().item()
+
+    def search(self, prefix: str, limit: int = 100) -> pl.DataFrame:
+        """
+        文字列表現が prefix で始まる値を、key の昇順に最大 limit 件返す。
+        """
+        lf = pl.scan_parquet(self.path)
+        if prefix:
+            lf = lf.filter(
+                (pl.col("key") >= prefix) & (pl.col("key") < prefix + _MAX_CHAR)
+            )
+        return lf.head(limit).collect()
+
+    def top(self, limit: int = TOP_VALUES) -> pl.DataFrame:
+        """
+        出現頻度の上位 limit 件の値を、件数の多い順に返す。
+        """
+        return pl.read_parquet(self.top_path).head(limit)
+
+
+class ValueIndexes:
+    """
+    列ごとの ValueIndex を directory に置き、初回の利用時に作成する。
+
+    インデックスはデータセットの指紋・データソース・列名ごとに作り、全セッションで共有する。
+    同じ列のインデックスを重複して作らないよう、作成は列ごとのロックの中で行う。
+    ディレクトリ内のインデックスの合計が max_disk_bytes を超えた場合は、
+    最も長く使われていないものから削除する。
+    """
+
+    def __init__(self, directory: Path, max_disk_bytes: int = 1024**3):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # 作成中の列ごとのロック
+        self.creating: dict[str, threading.Lock] = {}
+
+    def get(self, con, source: str, column: str, fingerprint: str) -> ValueIndex:
+        """
+        column 列のインデックスを返す。なければ con で source を集計して作成する。
+        source がセッションの TEMP VIEW の場合は、そのセッションのカーソルを渡す。
+        """
+        key = result_key(fingerprint, source, column)
+        index = ValueIndex(self.directory / f"{key}.parquet")
+        with self.lock:
+            key_lock = self.creating.setdefault(key, threading.Lock())
+        with key_lock:
+            if index.exists():
+                # 最後に使った時刻として更新時刻を更新する
+                index.path.touch()
+            else:
+                index.build(con, source, column)
+                self._evict(keep=index)
+        return index
+
+    def _evict(self, keep: ValueIndex) -> None:
+        indexes = sorted(
+            (
+                path
+                for path in self.directory.glob("*.parquet")
+                if not path.name.endswith(".top.parquet")
+            ),
+            key=lambda path: path.stat().st_mtime,
+        )
+        total = sum(path.stat().st_size for path in indexes)
+        for path in indexes:
+            if total <= self.max_disk_bytes:
+                break
+            if path == keep.path:
+                continue
+            total -= path.stat().st_size
+            evicted = ValueIndex(path)
+            path.unlink(missing_ok=True)
+            evicted.top_path.unlink(missing_ok=True)
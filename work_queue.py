@@ -0,0 +1,224 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+
+def default_worker_id() -> str:
+    """
+    ホスト名とプロセスIDからワーカーIDを生成する。
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseQueue:
+    """
+    共有ディレクトリ（NFSなど）上のリースファイルで、入力ファイルの処理権を
+    複数のプロセス・ホスト間で調停するワークキュー。
+
+    - leases/<item>.lease: 処理中の印。O_EXCL で作成できたワーカーだけが処理する。
+      処理中はハートビートで mtime を更新し、lease_ttl 秒以上更新されていない
+      リースは放棄されたものとして他のワーカーが回収する。
+    - done/<item>.done, done/<item>.failed: 処理済み（成功・失敗）の印。
+      リースを失ったワーカーは印を書かない。
+    """
+
+    def __init__(
+        self,
+        queue_dir: Path,
+        worker_id: str | None = None,
+        lease_ttl: float = 300.0,
+        heartbeat_interval: float | None = None,
+    ):
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval or lease_ttl / 4
+
+        self.lease_dir = queue_dir / "leases"
+        self.done_dir = queue_dir / "done"
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.done_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def item_name(key: str) -> str:
+        """
+        アイテムのキー（入力ファイルの相対パスなど）からファイル名に使える名前を作る。
+        """
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def lease_path(self, key: str) -> Path:
+        return self.lease_dir / f"{self.item_name(key)}.lease"
+
+    def is_finished(self, key: str) -> bool:
+        """
+        アイテムが処理済み（成功または失敗）かどうかを返す。
+        """
+        name = self.item_name(key)
+        return (self.done_dir / f"{name}.done").exists() or (
+            self.done_dir / f"{name}.failed"
+        ).exists()
+
+    def try_claim(self, key: str) -> bool:
+        """
+        アイテムのリースの取得を試みる。取得できた場合はTrueを返す。
+        放棄されたリースは回収してから取得を試みる。
+        """
+        if self.is_finished(key):
+            return False
+        lease_path = self.lease_path(key)
+        if not self._create_lease(lease_path, key):
+            if not self._reclaim_if_stale(lease_path):
+                return False
+            if not self._create_lease(lease_path, key):
+                return False
+        # リース取得までの間に他のワーカーが完了させていた場合は手放す
+        if self.is_finished(key):
+            self.release(key)
+            return False
+        return True
+
+    def _create_lease(self, lease_path: Path, key: str) -> bool:
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(f"{self.worker_id}\n{key}\n")
+        return True
+
+    def _reclaim_if_stale(self, lease_path: Path) -> bool:
+        """
+        期限切れのリースを回収する。回収した（または既に消えていた）場合はTrueを返す。
+        rename は原子的なため、同じリースを回収できるのは1ワーカーのみ。
+        """
+        try:
+            age = time.time() - lease_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age <= self.lease_ttl:
+            return False
+
+        tombstone = lease_path.with_name(
+            f"{lease_path.name}.reclaimed-{uuid.uuid4().hex}"
+        )
+        try:
+            os.rename(lease_path, tombstone)
+        except FileNotFoundError:
+            return True
+        # stat から rename までの間に他のワーカーが新しいリースを作っていた場合は戻す
+        if time.time() - tombstone.stat().st_mtime <= self.lease_ttl:
+            try:
+                os.link(tombstone, lease_path)
+            except FileExistsError:
+                pass
+            tombstone.unlink()
+            return False
+        tombstone.unlink()
+        return True
+
+    def owns(self, key: str) -> bool:
+        """
+        現在のリースをこのワーカーが保持しているかどうかを返す。
+        """
+        try:
+            owner = self.lease_path(key).read_text(encoding="utf-8").split("\n")[0]
+        except FileNotFoundError:
+            return False
+        return owner == self.worker_id
+
+    def renew(self, key: str) -> bool:
+        """
+        リースの mtime を更新する。リースを失っていた場合はFalseを返す。
+        """
+        if not self.owns(key):
+            return False
+        os.utime(self.lease_path(key))
+        return True
+
+    @contextmanager
+    def heartbeat(self, key: str) -> Iterator[None]:
+        """
+        ブロック内の処理中、バックグラウンドスレッドでリースを定期的に更新する。
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                if not self.renew(key):
+                    break
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    @contextmanager
+    def hold(self, key: str, poll_interval: float | None = None) -> Iterator[None]:
+        """
+        キーのリースを取得できるまで待ち、ブロック内の処理中は保持し続ける。
+        処理済みの印は使わないため、同じ出力先への書き込みの排他ロックとして使える。
+        """
+        lease_path = self.lease_path(key)
+        poll_interval = poll_interval or min(self.lease_ttl / 4, 1.0)
+        while not self._create_lease(lease_path, key):
+            if not self._reclaim_if_stale(lease_path):
+                time.sleep(poll_interval)
+        try:
+            with self.heartbeat(key):
+                yield
+        finally:
+            self.release(key)
+
+    def _write_marker(self, key: str, suffix: str, message: str = "") -> None:
+        marker = self.done_dir / f"{self.item_name(key)}.{suffix}"
+        tmp_path = marker.with_name(f"{marker.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_text(f"{self.worker_id}\n{key}\n{message}", encoding="utf-8")
+        os.replace(tmp_path, marker)
+
+    def complete(self, key: str) -> bool:
+        """
+        アイテムを処理済みにしてリースを解放する。
+        リースを既に失っていた場合は何もせずFalseを返す（回収したワーカーが処理する）。
+        """
+        if not self.owns(key):
+            return False
+        self._write_marker(key, "done")
+        self.release(key)
+        return True
+
+    def fail(self, key: str, message: str = "") -> bool:
+        """
+        アイテムを失敗として記録してリースを解放する（clear_failed するまで再試行しない）。
+        リースを既に失っていた場合は何もせずFalseを返す。
+        """
+        if not self.owns(key):
+            return False
+        self._write_marker(key, "failed", message)
+        self.release(key)
+        return True
+
+    def clear_failed(self) -> int:
+        """
+        失敗の印を全て削除し、失敗したアイテムを再び処理対象にする。削除した数を返す。
+        """
+        count = 0
+        for marker in self.done_dir.glob("*.failed"):
+            marker.unlink(missing_ok=True)
+            count += 1
+        return count
+
+    def release(self, key: str) -> None:
+        """
+        このワーカーが保持しているリースを解放する。
+        """
+        if self.owns(key):
+            self.lease_path(key).unlink(missing_ok=True)